@@ -0,0 +1,357 @@
+import argparse
+import http.client
+import itertools
+import json
+import random
+import re
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import main
+from main import app, fix_svg_urls, render_cache, SvgLinkRewriter
+
+ROUTES = ('render', 'lint', 'download-svg')
+
+def linked_svg(nodes):
+    """
+    Builds an SVG shaped like Graphviz output for a chain of `nodes` nodes that all carry a URL.
+    """
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n',
+             f'<svg width="{nodes * 60}pt" height="100pt" viewBox="0 0 {nodes * 60} 100" '
+             'xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+             '<g id="graph0" class="graph" transform="scale(1 1) rotate(0) translate(4 96)">\n']
+    for i in range(nodes):
+        parts.append(
+            f'<!-- n{i} -->\n<g id="node{i + 1}" class="node">\n<title>n{i}</title>\n'
+            f'<g id="a_node{i + 1}"><a xlink:href="example.com/n{i}" xlink:title="n{i}">\n'
+            f'<ellipse fill="none" stroke="black" cx="{i * 60 + 27}" cy="-18" rx="27" ry="18"/>\n'
+            f'<text text-anchor="middle" x="{i * 60 + 27}" y="-14.3" font-family="Times,serif" '
+            f'font-size="14.00">n{i}</text>\n</a>\n</g>\n</g>\n')
+        if i:
+            parts.append(
+                f'<!-- n{i - 1}&#45;&gt;n{i} -->\n<g id="edge{i}" class="edge">\n<title>n{i - 1}&#45;&gt;n{i}</title>\n'
+                f'<path fill="none" stroke="black" d="M{i * 60 - 6},-18C{i * 60 - 4},-18 {i * 60 - 2},-18 {i * 60},-18"/>\n</g>\n')
+    parts.append('</g>\n</svg>\n')
+    return ''.join(parts)
+
+def chain_graph(nodes):
+    return 'digraph chain {\n' + ''.join(f'    n{i} -> n{i + 1};\n' for i in range(nodes - 1)) + '}\n'
+
+def tree_graph(nodes, branching=3):
+    return 'digraph tree {\n' + ''.join(f'    n{(i - 1) // branching} -> n{i};\n' for i in range(1, nodes)) + '}\n'
+
+def dense_dag_graph(nodes, edges_per_node=4):
+    """
+    A DAG where every node points to a few random later nodes. Seeded, so runs are comparable.
+    """
+    rng = random.Random(nodes)
+    edges = []
+    for i in range(nodes - 1):
+        for j in rng.sample(range(i + 1, nodes), min(edges_per_node, nodes - 1 - i)):
+            edges.append(f'    n{i} -> n{j};\n')
+    return 'digraph dag {\n' + ''.join(edges) + '}\n'
+
+def clustered_graph(nodes, cluster_size=20):
+    """
+    Chains of cluster_size nodes, each in its own cluster, with the clusters linked in a ring.
+    """
+    parts = ['digraph clusters {\n']
+    clusters = max(nodes // cluster_size, 1)
+    for c in range(clusters):
+        members = ' -> '.join(f'c{c}_{i}' for i in range(cluster_size))
+        parts.append(f'    subgraph cluster_{c} {{\n        label="cluster {c}";\n        {members};\n    }}\n')
+    for c in range(clusters):
+        parts.append(f'    c{c}_{cluster_size - 1} -> c{(c + 1) % clusters}_0;\n')
+    parts.append('}\n')
+    return ''.join(parts)
+
+def linked_graph(nodes):
+    """
+    A chain whose nodes all carry a relative URL, which fix_svg_urls has to rewrite.
+    """
+    parts = ['digraph links {\n']
+    parts.extend(f'    n{i} [URL="example.com/n{i}", tooltip="node {i}"];\n' for i in range(nodes))
+    parts.extend(f'    n{i} -> n{i + 1};\n' for i in range(nodes - 1))
+    parts.append('}\n')
+    return ''.join(parts)
+
+SHAPES = {
+    'chain': chain_graph,
+    'tree': tree_graph,
+    'dag': dense_dag_graph,
+    'clusters': clustered_graph,
+    'links': linked_graph,
+}
+
+def generate_corpus(shapes, sizes):
+    """
+    Returns {'<shape>/<nodes>': code} for every combination of shape and size.
+    """
+    return {f'{shape}/{nodes}': SHAPES[shape](nodes) for shape in shapes for nodes in sizes}
+
+def fix_svg_urls_three_pass(svg_text):
+    """
+    The original fix_svg_urls, one regex pass per rewrite, kept here to compare against.
+    """
+    def add_target(match):
+        tag = match.group(0)
+        if 'target=' in tag:
+            return tag
+        return tag[:-1] + ' target="_blank">'
+    svg_text = re.sub(r'(xlink:href)="(?!https?://)([^"]+)"', r'\1="http://\2"', svg_text)
+    svg_text = re.sub(r'(href)="(?!https?://)([^"]+)"', r'\1="http://\2"', svg_text)
+    return re.sub(r'<a\b[^>]*>', add_target, svg_text)
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def percentile(times, fraction):
+    """
+    The nearest-rank percentile of a list of timings.
+    """
+    ordered = sorted(times)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def summarize(name, times, errors, elapsed=None):
+    result = {
+        'name': name,
+        'requests': len(times),
+        'errors': errors,
+        'p50_s': percentile(times, 0.5),
+        'p99_s': percentile(times, 0.99),
+        'mean_s': sum(times) / len(times),
+    }
+    if elapsed:
+        result['throughput_rps'] = len(times) / elapsed
+    return result
+
+def peak_rss():
+    """
+    Peak resident memory in KB of this process and of the Graphviz processes that have exited.
+    The worker pool is closed first, so its long-lived workers count too.
+    """
+    main.dot_pool.close()
+    return {
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_children_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+def request_for(route, code):
+    """
+    The method, path, headers and body the editor sends to route for code.
+    """
+    return 'POST', f'/{route}', {'Content-Type': 'application/json'}, json.dumps({'code': code})
+
+def succeeded(route, status, body):
+    """
+    Whether the response is a rendered graph rather than an error, which most routes still send
+    with a 200.
+    """
+    if status != 200:
+        return False
+    if route == 'lint':
+        return json.loads(body)['annotations'] == []
+    if route == 'render':
+        return 'Error: syntax error' not in json.loads(body)['svg']
+    return True
+
+def bench_fix_svg_urls(sizes, repeat):
+    """
+    Times fix_svg_urls against the original three-pass version on SVGs with increasing numbers
+    of linked nodes, on str, on bytes straight from Graphviz, and fed to SvgLinkRewriter in chunks.
+    """
+    results = []
+    for nodes in sizes:
+        svg_text = linked_svg(nodes)
+        svg_bytes = svg_text.encode('utf-8')
+        assert fix_svg_urls(svg_text) == fix_svg_urls_three_pass(svg_text)
+
+        def chunked():
+            rewriter = SvgLinkRewriter()
+            for i in range(0, len(svg_bytes), 65536):
+                rewriter.feed(svg_bytes[i:i + 65536])
+            rewriter.close()
+
+        results.append({
+            'name': f'fix_svg_urls/{nodes}',
+            'nodes': nodes,
+            'svg_bytes': len(svg_bytes),
+            'three_pass_str_s': best_time(lambda: fix_svg_urls_three_pass(svg_text), repeat),
+            'fix_svg_urls_str_s': best_time(lambda: fix_svg_urls(svg_text), repeat),
+            'fix_svg_urls_bytes_s': best_time(lambda: fix_svg_urls(svg_bytes), repeat),
+            'rewriter_chunked_s': best_time(chunked, repeat),
+        })
+    return {'benchmark': 'svg', 'results': results}
+
+def bench_app(corpus, routes, repeat, warm=False):
+    """
+    Sends every graph in the corpus to every route through Flask's test client, one request at
+    a time. Unless warm is set the render cache is cleared before each request, so every one
+    of them runs Graphviz.
+    """
+    client = app.test_client()
+    results = []
+    for name, code in corpus.items():
+        for route in routes:
+            method, path, headers, body = request_for(route, code)
+            times, errors = [], 0
+            for _ in range(repeat):
+                if not warm:
+                    render_cache.clear()
+                start = time.perf_counter()
+                response = client.open(path, method=method, headers=headers, data=body)
+                times.append(time.perf_counter() - start)
+                errors += not succeeded(route, response.status_code, response.get_data())
+            results.append(summarize(f'{route}/{name}', times, errors))
+    return dict({'benchmark': 'app', 'results': results}, **peak_rss())
+
+def serve_in_background():
+    """
+    Starts the app on a free local port in a real threaded HTTP server and returns it.
+    """
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_load(corpus, routes, requests, concurrency, url=None, unique=True):
+    """
+    Fires requests over HTTP from `concurrency` clients at once and reports latency and throughput
+    per route. Without a url the app is served in this process. With unique set every request's
+    code gets its own trailing comment, so nothing is answered from the render cache.
+    """
+    server = None
+    if url is None:
+        server = serve_in_background()
+        host, port = '127.0.0.1', server.server_port
+    else:
+        parts = urlsplit(url)
+        host, port = parts.hostname, parts.port or 80
+    jobs = itertools.islice(itertools.cycle(itertools.product(routes, corpus.items())), requests)
+    counter = itertools.count()
+    lock = threading.Lock()
+    timings = {route: ([], [0]) for route in routes}
+
+    def client():
+        while True:
+            with lock:
+                job = next(jobs, None)
+                n = next(counter)
+            if job is None:
+                return
+            route, (_, code) = job
+            method, path, headers, body = request_for(route, code + (f'// request {n}\n' if unique else ''))
+            connection = http.client.HTTPConnection(host, port, timeout=120)
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                status, data = response.status, response.read()
+            except OSError:
+                status, data = None, b''
+            finally:
+                connection.close()
+            elapsed = time.perf_counter() - start
+            times, errors = timings[route]
+            with lock:
+                times.append(elapsed)
+                errors[0] += not (status and succeeded(route, status, data))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(client)
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.shutdown()
+    results = [summarize(route, times, errors[0], elapsed) for route, (times, errors) in timings.items() if times]
+    all_times = [t for times, _ in timings.values() for t in times]
+    results.append(summarize('all', all_times, sum(errors[0] for _, errors in timings.values()), elapsed))
+    return dict({'benchmark': 'load', 'concurrency': concurrency, 'results': results}, **peak_rss())
+
+def compare(report, baseline, tolerance):
+    """
+    Compares every timing (*_s, lower is better) and throughput (higher is better) of report with
+    the entry of the same name in baseline. Returns the ones that got worse by more than tolerance.
+    """
+    previous = {entry['name']: entry for entry in baseline.get('results', [])}
+    regressions = []
+    for entry in report['results']:
+        old = previous.get(entry['name'])
+        if old is None:
+            continue
+        for key, value in entry.items():
+            if key not in old or not isinstance(value, (int, float)) or not old[key]:
+                continue
+            if key.endswith('_s'):
+                change = value / old[key] - 1
+            elif key == 'throughput_rps':
+                change = old[key] / value - 1 if value else float('inf')
+            else:
+                continue
+            if change > tolerance:
+                regressions.append({'name': entry['name'], 'metric': key, 'baseline': old[key],
+                                    'current': value, 'change': round(change, 3)})
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TechLines benchmarks')
+    parser.add_argument('--save', help='Write the report to this file, e.g. to use as a baseline later')
+    parser.add_argument('--baseline', help='Compare against a report saved with --save, and exit with '
+                                           'status 1 if anything got slower')
+    parser.add_argument('--tolerance', default=0.2, type=float,
+                        help='How much slower than the baseline still counts as no change (0.2 = 20%%)')
+    subcommands = parser.add_subparsers(dest='benchmark', required=True)
+    svg_parser = subcommands.add_parser('svg', help='Microbenchmark of fix_svg_urls on generated SVGs')
+    svg_parser.add_argument('--sizes', default='1000,10000,50000',
+                            help='Comma separated numbers of linked nodes to generate')
+    svg_parser.add_argument('--repeat', default=5, type=int, help='Runs per size, the best one counts')
+    for name, help_text in (('app', 'Requests one at a time through the Flask test client'),
+                            ('load', 'Concurrent HTTP requests against a running server')):
+        sub = subcommands.add_parser(name, help=help_text)
+        sub.add_argument('--shapes', default=','.join(SHAPES), help='Comma separated graph shapes: ' + ', '.join(SHAPES))
+        sub.add_argument('--sizes', default='10,100,1000', help='Comma separated numbers of nodes')
+        sub.add_argument('--routes', default=','.join(ROUTES), help='Comma separated routes to request')
+    subcommands.choices['app'].add_argument('--repeat', default=5, type=int, help='Requests per graph and route')
+    subcommands.choices['app'].add_argument('--warm', action='store_true',
+                                            help='Keep the render cache between requests')
+    subcommands.choices['load'].add_argument('--requests', default=200, type=int, help='Total number of requests')
+    subcommands.choices['load'].add_argument('--concurrency', default=8, type=int, help='Requests in flight at once')
+    subcommands.choices['load'].add_argument('--url', help='Server to load, e.g. http://localhost:5000 '
+                                                           '(by default the app is served in this process)')
+    subcommands.choices['load'].add_argument('--cached', action='store_true',
+                                             help='Send identical code repeatedly, so the render cache answers')
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.benchmark == 'svg':
+        report = bench_fix_svg_urls(sizes, args.repeat)
+    else:
+        corpus = generate_corpus(args.shapes.split(','), sizes)
+        routes = args.routes.split(',')
+        if args.benchmark == 'app':
+            report = bench_app(corpus, routes, args.repeat, args.warm)
+        else:
+            report = bench_load(corpus, routes, args.requests, args.concurrency, args.url, not args.cached)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            report['regressions'] = compare(report, json.load(f), args.tolerance)
+    print(json.dumps(report, indent=2))
+    if report.get('regressions'):
+        sys.exit(1)
@@ -1,414 +1,3296 @@
-from flask import Flask, request, jsonify, make_response, render_template_string
-import graphviz
+from flask import Flask, request, jsonify, make_response, stream_with_context, \
+    g, has_request_context
+from werkzeug.http import parse_cookie
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+from urllib.parse import parse_qs
+import asyncio
+import atexit
+import base64
+import bisect
+import fcntl
+import gzip
+import hashlib
+import html
+import importlib.util
+import selectors
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
 import re
+import zlib
 import os
+import resource
 import argparse
+import json
+import math
+import secrets
+import sys
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+# The single file editor code used to be saved to. It is only read now, to seed the
+# default user's first document in the workspace.
 BACKUP_FILE = 'editor_backup.txt'
 
-app = Flask(__name__)
+# Documents are stored under WORKSPACE_DIR, one directory per user. A document's log of edits
+# is folded into a fresh snapshot every WORKSPACE_COMPACT_EVERY saves.
+WORKSPACE_DIR = 'workspace'
+WORKSPACE_COMPACT_EVERY = 100
+WORKSPACE_USER_COOKIE = 'techlines_user'
+
+# Part of every ETag. Bump it whenever the post-processing of rendered graphs changes,
+# so clients don't hold on to stale copies.
+RESPONSE_VERSION = '1'
+
+# Rendered output is cached in memory up to this many bytes. Set RENDER_CACHE_DIR
+# to also keep every rendered graph on disk across restarts.
+RENDER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RENDER_CACHE_DIR = None
+
+# Graphviz runs in a pool of long-lived worker processes, one per core by default.
+# Jobs are killed after DOT_JOB_TIMEOUT seconds, and requests that can't get a worker
+# within DOT_QUEUE_TIMEOUT seconds are turned away with a 503.
+DOT_POOL_SIZE = os.cpu_count() or 1
+DOT_JOB_TIMEOUT = 30
+DOT_QUEUE_TIMEOUT = 10
+# Every Graphviz process may use at most DOT_MEMORY_LIMIT MB of memory (0 for no limit).
+DOT_MEMORY_LIMIT = 2048
+# Renders are admitted by an estimate of the graph's size, its nodes plus edges. Graphs bigger
+# than HEAVY_RENDER_COST wait in a low-priority lane that gets at most HEAVY_RENDER_SHARE of the
+# workers, so they can't crowd out everybody else's. Graphs bigger than MAX_RENDER_COST are refused.
+HEAVY_RENDER_COST = 5000
+HEAVY_RENDER_SHARE = 0.5
+MAX_RENDER_COST = 200000
+
+# The Graphviz layout engines a request may ask for. With 'auto', previews of graphs bigger than
+# AUTO_ENGINE_MIN_COST (estimated nodes plus edges) get a quick draft layout from DRAFT_ENGINE,
+# sfdp with straight edges, while everything else, exports included, is laid out with dot.
+ENGINES = ('dot', 'neato', 'fdp', 'sfdp', 'twopi', 'circo', 'osage')
+AUTO_ENGINE_MIN_COST = 2000
+DRAFT_ENGINE = ('sfdp', ('-Gsplines=false',))
+
+# Editor previews of graphs bigger than TILED_PREVIEW_MIN_COST (estimated nodes plus edges) are
+# shown as TILE_SIZE pixel tiles cut from one layout, fetched as the viewer pans and zooms. At the
+# deepest zoom level a point is TILE_MAX_SCALE pixels. Zoomed out below TILE_TEXT_MIN_SCALE
+# pixels per point labels are dropped, and so are elements smaller than TILE_MIN_ELEMENT_PX.
+TILED_PREVIEW_MIN_COST = 5000
+TILE_SIZE = 256
+TILE_MAX_SCALE = 2
+TILE_TEXT_MIN_SCALE = 0.35
+TILE_MIN_ELEMENT_PX = 1
+TILE_GRID = 64
+MAX_TILE_SETS = 32
+# Tile sets live in one server process, so tiled previews are off with --workers.
+TILED_PREVIEW = True
+
+# How often a queued or running render checks whether it has been superseded, in seconds.
+CANCEL_POLL_INTERVAL = 0.05
+# How many editor sessions to remember the latest revision for.
+MAX_EDITOR_SESSIONS = 10000
+# Editor previews of graphs with at least this many nodes reuse the previous layout
+# when an edit only changes labels or styling.
+INCREMENTAL_LAYOUT_MIN_NODES = 300
+# The live preview renders once edits to a document have paused for this many seconds.
+PREVIEW_DEBOUNCE = 0.15
+# Seconds between keepalive comments on an idle /events stream.
+PREVIEW_KEEPALIVE = 15
+# How many documents to keep a live preview channel for.
+MAX_PREVIEW_CHANNELS = 1000
+# Push previews over /events. Channels live in one server process, so this is off with --workers.
+LIVE_PREVIEW = True
+
+# In --async mode, each server process runs at most this many Graphviz processes at once.
+ASYNC_MAX_RENDERS = 64
+# In --async mode, each server process runs the Flask side of requests on this many threads.
+ASYNC_WSGI_THREADS = 32
+
+# Upper bounds of the latency histograms on /metrics, in seconds, and of the output size ones, in bytes.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760)
+# Send a Server-Timing header with every response, so browser devtools show where the time went.
+SERVER_TIMING = False
+
+# Third-party code the page uses, kept in vendor/ next to this file and bundled into the page's
+# own script and stylesheet, so the editor never has to reach a CDN.
+VENDOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vendor')
+VENDOR_SCRIPTS = ('codemirror/lib/codemirror.js', 'codemirror/addon/mode/simple.js', 'codemirror/addon/lint/lint.js')
+VENDOR_STYLES = ('codemirror/lib/codemirror.css', 'codemirror/theme/dracula.css', 'codemirror/addon/lint/lint.css')
+# The notice put at the top of the bundles. The version is read from the vendored codemirror.js,
+# so replacing the files is all an upgrade takes; vendor/codemirror/SOURCE says where they came from.
+VENDOR_NOTICE = 'CodeMirror {version}, (c) Marijn Haverbeke and others, MIT license: https://codemirror.net/LICENSE'
+VENDOR_VERSION_RE = re.compile(r'CodeMirror\.version = "([^"]+)"')
+# Put the stylesheet into the page itself, which saves a round trip before the editor first shows.
+INLINE_CSS = False
+
+app = Flask(__name__)
+
+class Metrics:
+    """
+    Counters and histograms for /metrics, written out in the Prometheus text format.
+    A series is a metric name plus its labels, given as keyword arguments. Every server process
+    keeps its own.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=None, **labels):
+        """
+        Adds value to a histogram. buckets are the upper bounds; the first observation of a
+        series decides them.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                bounds = buckets or self.buckets
+                histogram = self._histograms[key] = {'bounds': bounds, 'counts': [0] * (len(bounds) + 1),
+                                                     'sum': 0.0}
+            histogram['counts'][bisect.bisect_left(histogram['bounds'], value)] += 1
+            histogram['sum'] += value
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self, gauges=()):
+        """
+        Returns the text for /metrics. gauges are extra (name, value, labels) readings taken
+        at scrape time.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, dict(h, counts=list(h['counts']))) for key, h in self._histograms.items())
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f'{name}{metric_labels(labels)} {value}')
+        for name, value, labels in gauges:
+            declare(name, 'gauge')
+            lines.append(f'{name}{metric_labels(tuple(sorted(labels.items())))} {value}')
+        for (name, labels), histogram in histograms:
+            declare(name, 'histogram')
+            total = 0
+            for bound, count in zip(histogram['bounds'] + ('+Inf',), histogram['counts']):
+                total += count
+                lines.append(f'{name}_bucket{metric_labels(labels + (("le", str(bound)),))} {total}')
+            lines.append(f'{name}_sum{metric_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{metric_labels(labels)} {total}')
+        return '\n'.join(lines) + '\n'
+
+def metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+metrics = Metrics()
+
+@contextmanager
+def span(phase, **labels):
+    """
+    Times a phase of the work, such as running Graphviz or post-processing its output, into the
+    techlines_phase_seconds histogram and, during a request, into its Server-Timing header.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('techlines_phase_seconds', elapsed, phase=phase, **labels)
+        if has_request_context():
+            g.setdefault('timings', []).append((phase, elapsed))
+
+
+class RenderCache:
+    """
+    A content-addressed cache of Graphviz output, keyed by a hash of (code, engine, format).
+    The in-memory copy is bounded by max_bytes and evicts the least recently used entries first.
+    If cache_dir is set, every entry is also written there and read back on a memory miss.
+    The error messages of the last MAX_ERRORS graphs that failed to render are kept as well.
+    """
+    MAX_ERRORS = 1024
+
+    def __init__(self, max_bytes=RENDER_CACHE_MAX_BYTES, cache_dir=RENDER_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._errors = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(code, engine, fmt):
+        digest = hashlib.sha256()
+        for part in (engine, fmt, code):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        if self.cache_dir:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                self._remember(key, data)
+                with self._lock:
+                    self.hits += 1
+                return data
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.cache_dir:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key, data):
+        # Entries bigger than the whole cache are only kept on disk.
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_error(self, key):
+        """
+        Returns the Graphviz error message remembered for key, if rendering it failed before.
+        """
+        with self._lock:
+            return self._errors.get(key)
+
+    def put_error(self, key, message):
+        with self._lock:
+            self._errors[key] = message
+            while len(self._errors) > self.MAX_ERRORS:
+                self._errors.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._errors.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+render_cache = RenderCache()
+
+class RenderError(Exception):
+    """
+    Raised when Graphviz fails to render a graph. The message is whatever Graphviz reported.
+    """
+
+class RenderSyntaxError(RenderError):
+    """
+    Raised when Graphviz rejects the graph itself, with the diagnostics it printed. Only these
+    errors say something about the code, so only these are cached.
+    """
+
+def graphviz_failure(err, returncode):
+    """
+    The error for a Graphviz process that failed: a RenderSyntaxError if it printed why, otherwise
+    a plain RenderError, since it may just have been killed for running out of memory.
+    """
+    message = err.decode('utf-8', 'replace').strip()
+    if message:
+        return RenderSyntaxError(message)
+    return RenderError(f"Graphviz exited with status {returncode}")
+
+class RenderTimeout(RenderError):
+    """
+    Raised when a render runs longer than its timeout. The worker running it is killed.
+    """
+
+class RenderCancelled(RenderError):
+    """
+    Raised when a render is abandoned because its editor session has moved on to a newer revision.
+    """
+
+class PoolBusyError(RenderError):
+    """
+    Raised when every Graphviz worker stayed busy for longer than the pool's queue timeout.
+    """
+
+class GraphTooLarge(RenderError):
+    """
+    Raised instead of rendering a graph whose estimated size is over the pool's max_cost.
+    """
+
+class DotWorker:
+    """
+    A long-lived Graphviz process for one engine, format and set of extra arguments.
+    Graphs are written to its stdin one after another and each result is read back from stdout,
+    so the process is only started once instead of once per request.
+    """
+    # Graphviz reads its input in large blocks. Padding every job with whitespace makes sure the
+    # read that contains the closing brace returns right away instead of waiting for the next job.
+    PADDING = b' ' * 65536 + b'\n'
+
+    def __init__(self, engine, fmt, args=(), memory_limit=DOT_MEMORY_LIMIT):
+        self.key = (engine, fmt, args)
+        self.process = subprocess.Popen(graphviz_command(engine, fmt, args), stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        limit_dot_process(self.process.pid, memory_limit)
+        for pipe in (self.process.stdin, self.process.stdout, self.process.stderr):
+            os.set_blocking(pipe.fileno(), False)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def has_stray_output(self):
+        """
+        Tells whether the process wrote anything nobody asked for, e.g. a second graph from the last job.
+        """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.process.stdout, selectors.EVENT_READ)
+            return bool(selector.select(0))
+
+    def close(self):
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout, self.process.stderr):
+            pipe.close()
+
+    def run(self, code, timeout, cancel=None):
+        """
+        Renders one graph and returns the output bytes.
+        Raises RenderError if Graphviz reports an error or exits, RenderTimeout if it takes
+        longer than timeout seconds and RenderCancelled once the cancel event is set.
+        In all of those cases the worker should be closed afterwards.
+        """
+        # The line directive resets Graphviz's line counter, so errors point at the job's own lines.
+        payload = memoryview(b'#line 1\n' + code.encode('utf-8') + b'\n' + self.PADDING)
+        stdin, stdout, stderr = self.process.stdin, self.process.stdout, self.process.stderr
+        out = bytearray()
+        err = bytearray()
+        sent = 0
+        deadline = time.monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(stdin, selectors.EVENT_WRITE)
+            selector.register(stdout, selectors.EVENT_READ)
+            selector.register(stderr, selectors.EVENT_READ)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RenderTimeout(f"Graphviz did not finish within {timeout} seconds")
+                if cancel is not None:
+                    if cancel.is_set():
+                        raise RenderCancelled("Render superseded by a newer revision")
+                    remaining = min(remaining, CANCEL_POLL_INTERVAL)
+                for key, _ in selector.select(remaining):
+                    if key.fileobj is stdin:
+                        try:
+                            sent += os.write(stdin.fileno(), payload[sent:sent + 65536])
+                        except BrokenPipeError:
+                            # The process died; stderr or EOF on stdout will say why.
+                            sent = len(payload)
+                        if sent == len(payload):
+                            selector.unregister(stdin)
+                        continue
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        if key.fileobj is stdout:
+                            self.process.wait()
+                            raise graphviz_failure(err, self.process.returncode)
+                    elif key.fileobj is stdout:
+                        out += chunk
+                    else:
+                        err += chunk
+                # Warnings are fine, but after an error the process can't be trusted with another job.
+                if re.search(rb'Error.*\n', err):
+                    raise RenderSyntaxError(err.decode('utf-8', 'replace').strip())
+                if sent == len(payload) and output_complete(self.key[1], out):
+                    return bytes(out)
+
+def graphviz_command(engine, fmt, args=()):
+    """
+    Builds the Graphviz command line. fmt may name several formats joined with '+', such as
+    'svg+dot', to get all of them from one layout.
+    """
+    return [engine, *args, *(f'-T{part}' for part in fmt.split('+'))]
+
+def limit_dot_process(pid, memory_limit, cpu_seconds=None):
+    """
+    Caps the memory (in MB) and optionally the CPU time of a Graphviz process. It is called right
+    after the process starts, while it is still waiting for its input, which avoids running
+    Python code between fork and exec in a threaded server.
+    Long-lived workers get no CPU limit: it would add up over all their jobs, and the job timeout
+    already bounds the CPU time of a single-threaded layout.
+    """
+    if not hasattr(resource, 'prlimit'):
+        return
+    try:
+        if memory_limit:
+            resource.prlimit(pid, resource.RLIMIT_AS, (memory_limit * 1024 * 1024,) * 2)
+        if cpu_seconds:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (int(cpu_seconds) + 1, int(cpu_seconds) + 2))
+    except (OSError, ValueError):
+        # The process is already gone; reading its output will tell why.
+        pass
+
+# Edge operators, and anything that can name a node: IDs, numbers and quoted strings.
+DOT_EDGEOP_RE = re.compile(r'->|--')
+DOT_NAME_RE = re.compile(r'[A-Za-z_\x80-\U0010ffff][\w\x80-\U0010ffff]*|"(?:[^"\\]|\\.)*"|-?(?:\.\d+|\d+(?:\.\d*)?)')
+
+def estimate_graph_cost(code):
+    """
+    A quick estimate of the size of a graph, without parsing it: the number of edge operators plus
+    the number of distinct names. Attribute names and values count as names too, so this errs on
+    the high side.
+    """
+    return len(DOT_EDGEOP_RE.findall(code)) + len(set(DOT_NAME_RE.findall(code)))
+
+def output_complete(fmt, data):
+    """
+    Tells whether data holds one whole Graphviz output document of the given format.
+    """
+    if fmt == 'svg+dot':
+        # Both documents come out one after the other, the SVG first.
+        end = data.find(b'</svg>')
+        return end != -1 and output_complete('dot', data[end:])
+    if fmt == 'svg':
+        return data.rstrip().endswith(b'</svg>')
+    if fmt == 'png':
+        return data.endswith(b'IEND\xaeB`\x82')
+    if fmt in ('plain', 'plain-ext'):
+        return data.endswith(b'stop\n')
+    # dot, xdot and json output all close with an unindented brace.
+    return data.endswith(b'\n}\n')
+
+class DotWorkerPool:
+    """
+    A pool of DotWorker processes shared by every request.
+    At most `size` jobs run at once. Further callers wait up to queue_timeout seconds for a free
+    worker and then get PoolBusyError. Workers that crash, time out or report an error are thrown
+    away and replaced on demand.
+    """
+    FORMATS = ('svg', 'png', 'dot', 'xdot', 'json', 'plain', 'plain-ext', 'svg+dot')
+
+    def __init__(self, size=DOT_POOL_SIZE, job_timeout=DOT_JOB_TIMEOUT, queue_timeout=DOT_QUEUE_TIMEOUT,
+                 memory_limit=DOT_MEMORY_LIMIT, heavy_cost=HEAVY_RENDER_COST, max_cost=MAX_RENDER_COST):
+        self.job_timeout = job_timeout
+        self.queue_timeout = queue_timeout
+        self.memory_limit = memory_limit
+        self.heavy_cost = heavy_cost
+        self.max_cost = max_cost
+        self.busy = 0
+        self.waiting = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self.resize(size)
+
+    def resize(self, size):
+        self.size = size
+        self._slots = threading.BoundedSemaphore(max(size, 1))
+        # Heavy jobs leave at least one worker free for everybody else, when there is more than one.
+        self._heavy_slots = threading.BoundedSemaphore(max(min(int(size * HEAVY_RENDER_SHARE), size - 1), 1))
+
+    def admit(self, code):
+        """
+        Tells whether code is a heavy job, or raises GraphTooLarge if it shouldn't be rendered at all.
+        """
+        cost = estimate_graph_cost(code)
+        if cost > self.max_cost:
+            raise GraphTooLarge(f"The graph is too large to render here (about {cost} nodes and edges, "
+                                f"the limit is {self.max_cost})")
+        return cost > self.heavy_cost
+
+    def pipe(self, code, engine='dot', fmt='svg', timeout=None, cancel=None, args=()):
+        """
+        Renders code with the given engine, format and extra command line arguments and returns
+        the output bytes. Setting the cancel event gives up on the render, whether it is still
+        queued or running. Heavy jobs first queue for a place in the low-priority lane.
+        """
+        # A long-lived dot would wait forever for a graph in input that has none, so that gets
+        # the empty output a one-off dot gives for it straight away.
+        if not has_graph(code):
+            return b''
+        if not self.admit(code):
+            return self._pipe(code, engine, fmt, timeout, cancel, args)
+        heavy_slots = self._heavy_slots
+        self._acquire(heavy_slots, cancel)
+        try:
+            return self._pipe(code, engine, fmt, timeout, cancel, args)
+        finally:
+            heavy_slots.release()
+
+    def _pipe(self, code, engine, fmt, timeout, cancel, args):
+        timeout = timeout or self.job_timeout
+        if self.size < 1 or fmt not in self.FORMATS:
+            return pipe_once(code, engine, fmt, timeout, cancel, args, self.memory_limit)
+        slots = self._slots
+        self._acquire(slots, cancel)
+        try:
+            worker = self._checkout((engine, fmt, args))
+            try:
+                data = worker.run(code, timeout, cancel)
+            except BaseException:
+                worker.close()
+                raise
+            finally:
+                with self._lock:
+                    self.busy -= 1
+            self._checkin(worker)
+            return data
+        finally:
+            slots.release()
+
+    def _acquire(self, slots, cancel):
+        if slots.acquire(blocking=False):
+            return
+        with self._lock:
+            self.waiting += 1
+        try:
+            with span('queue'):
+                self._wait(slots, cancel)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def _wait(self, slots, cancel):
+        if cancel is None:
+            if not slots.acquire(timeout=self.queue_timeout):
+                raise PoolBusyError("All Graphviz workers are busy")
+            return
+        deadline = time.monotonic() + self.queue_timeout
+        while not slots.acquire(timeout=CANCEL_POLL_INTERVAL):
+            if cancel.is_set():
+                raise RenderCancelled("Render superseded by a newer revision")
+            if time.monotonic() >= deadline:
+                raise PoolBusyError("All Graphviz workers are busy")
+
+    def _checkout(self, key):
+        with self._lock:
+            self.busy += 1
+            for i, worker in enumerate(self._idle):
+                if worker.key == key:
+                    del self._idle[i]
+                    if worker.alive() and not worker.has_stray_output():
+                        return worker
+                    worker.close()
+                    break
+            # Make room by retiring the longest-idle workers of other kinds.
+            retired = []
+            while self._idle and self.busy + len(self._idle) > self.size:
+                retired.append(self._idle.pop(0))
+        for worker in retired:
+            worker.close()
+        try:
+            return DotWorker(*key, memory_limit=self.memory_limit)
+        except OSError as e:
+            with self._lock:
+                self.busy -= 1
+            raise RenderError(f"Could not start Graphviz: {e}")
+
+    def _checkin(self, worker):
+        if not worker.alive():
+            worker.close()
+            return
+        with self._lock:
+            self._idle.append(worker)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.close()
+
+def pipe_once(code, engine, fmt, timeout, cancel=None, args=(), memory_limit=DOT_MEMORY_LIMIT):
+    """
+    Renders code with a one-off Graphviz process, for formats the worker pool can't frame.
+    """
+    try:
+        process = subprocess.Popen(graphviz_command(engine, fmt, args), stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise RenderError(f"Could not start Graphviz: {e}")
+    limit_dot_process(process.pid, memory_limit, timeout)
+    payload = code.encode('utf-8')
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        try:
+            out, err = process.communicate(payload, timeout=max(min(remaining, CANCEL_POLL_INTERVAL)
+                                                                if cancel is not None else remaining, 0))
+            break
+        except subprocess.TimeoutExpired:
+            # communicate() keeps feeding the input it was first given; it can't be given again.
+            payload = None
+            if cancel is not None and cancel.is_set():
+                error = RenderCancelled("Render superseded by a newer revision")
+            elif time.monotonic() >= deadline:
+                error = RenderTimeout(f"Graphviz did not finish within {timeout} seconds")
+            else:
+                continue
+            process.kill()
+            process.communicate()
+            raise error
+    if process.returncode != 0:
+        raise graphviz_failure(err, process.returncode)
+    return out
+
+dot_pool = DotWorkerPool()
+atexit.register(dot_pool.close)
+
+# What the startup probe found out about Graphviz, reported by /healthz.
+graphviz_status = {'status': 'starting'}
+
+def probe_graphviz():
+    """
+    Finds the dot binary and renders a tiny graph with it through the pool, so Graphviz has loaded
+    its plugins and fonts before the first real request. Returns the status /healthz reports.
+    """
+    status = {'status': 'error', 'dot': shutil.which('dot')}
+    if status['dot'] is None:
+        status['error'] = "dot was not found on the PATH"
+    else:
+        try:
+            version = subprocess.run([status['dot'], '-V'], capture_output=True, timeout=DOT_JOB_TIMEOUT)
+            status['version'] = version.stderr.decode('utf-8', 'replace').strip()
+            start = time.perf_counter()
+            dot_pool.pipe('digraph { a -> b }', 'dot', 'svg')
+            status.update(status='ok', warmup_seconds=round(time.perf_counter() - start, 3))
+        except (OSError, subprocess.SubprocessError, RenderError) as e:
+            status['error'] = str(e)
+    graphviz_status.clear()
+    graphviz_status.update(status)
+    return status
+
+def warm_up():
+    """
+    Compiles the page template, then bundles the page's assets and probes Graphviz in the
+    background, so the server starts answering straight away and the first requests don't pay
+    for any of it.
+    """
+    page_template()
+
+    def warm():
+        for name in PAGE_ASSETS:
+            static_asset(name)
+        probe_graphviz()
+
+    threading.Thread(target=warm, daemon=True).start()
+
+class EditorSessions:
+    """
+    Remembers the newest revision each editor session has sent, so renders of older revisions
+    can be skipped or killed. Each render registers a cancel event that is set as soon as a
+    newer revision of the same session comes in.
+    """
+    def __init__(self, max_sessions=MAX_EDITOR_SESSIONS):
+        self.max_sessions = max_sessions
+        self._latest = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def revision(self, session, revision):
+        """
+        Wraps the render of one revision, yielding its cancel event.
+        Raises RenderCancelled straight away if the session has already moved past this revision.
+        """
+        cancel = threading.Event()
+        with self._lock:
+            if revision < self._latest.get(session, revision):
+                raise RenderCancelled("Render superseded by a newer revision")
+            self._latest[session] = revision
+            self._latest.move_to_end(session)
+            while len(self._latest) > self.max_sessions:
+                forgotten, _ = self._latest.popitem(last=False)
+                self._inflight.pop(forgotten, None)
+            inflight = self._inflight.setdefault(session, [])
+            for older_revision, event in inflight:
+                if older_revision < revision:
+                    event.set()
+            inflight.append((revision, cancel))
+        try:
+            yield cancel
+            if cancel.is_set():
+                raise RenderCancelled("Render superseded by a newer revision")
+        finally:
+            with self._lock:
+                inflight = self._inflight.get(session, [])
+                if (revision, cancel) in inflight:
+                    inflight.remove((revision, cancel))
+                if not inflight:
+                    self._inflight.pop(session, None)
+
+editor_sessions = EditorSessions()
+
+def editor_revision(data):
+    """
+    Returns the editor_sessions context for a request that names its session and revision,
+    or a no-op context for requests that don't.
+    """
+    session = data.get('session')
+    revision = data.get('revision')
+    if session is None or revision is None:
+        return nullcontext()
+    return editor_sessions.revision(str(session), int(revision))
+
+def render(code, engine='dot', fmt='svg', cancel=None, args=()):
+    """
+    Runs the code through Graphviz and returns the raw output bytes.
+    Identical (code, engine, format) requests are answered from render_cache, so linting
+    and then rendering the same code only lays it out once.
+    """
+    key = RenderCache.key(code, ' '.join((engine,) + args), fmt)
+    data = render_cache.get(key)
+    if data is None:
+        error = render_cache.get_error(key)
+        if error is not None:
+            raise RenderSyntaxError(error)
+        try:
+            with span('graphviz', engine=engine, format=fmt):
+                data = dot_pool.pipe(code, engine, fmt, cancel=cancel, args=args)
+        except RenderError as e:
+            metrics.inc('techlines_render_errors_total', engine=engine, error=type(e).__name__)
+            # Timeouts, cancellations, a busy pool and killed processes say nothing about the code itself.
+            if isinstance(e, RenderSyntaxError):
+                render_cache.put_error(key, str(e))
+            raise
+        metrics.observe('techlines_output_bytes', len(data), SIZE_BUCKETS, engine=engine, format=fmt)
+        render_cache.put(key, data)
+    if has_request_context():
+        g.engine = engine
+    return data
+
+class UnknownEngine(ValueError):
+    """
+    Raised when a request asks for a layout engine that isn't in ENGINES.
+    """
+
+def requested_engine(data):
+    """
+    The layout engine a request or batch item asked for, 'dot' by default.
+    """
+    engine = data.get('engine') or 'dot'
+    if engine != 'auto' and engine not in ENGINES:
+        raise UnknownEngine(f"Unknown layout engine {engine!r}, use one of {', '.join(ENGINES)} or auto")
+    return engine
+
+def layout_engine(engine, code, preview):
+    """
+    Resolves a requested engine to the (engine, extra arguments) Graphviz runs with. Only 'auto'
+    needs resolving: previews of big graphs get the draft layout, anything else gets dot.
+    """
+    if engine != 'auto':
+        return engine, ()
+    if preview and estimate_graph_cost(code) > AUTO_ENGINE_MIN_COST:
+        return DRAFT_ENGINE
+    return 'dot', ()
+
+class DotSyntaxError(Exception):
+    """
+    A syntax error found by parse_dot, with the zero-based line/column range it covers.
+    """
+    def __init__(self, message, line, col, end_line, end_col):
+        super().__init__(message)
+        self.message = message
+        self.line = line
+        self.col = col
+        self.end_line = end_line
+        self.end_col = end_col
+
+class DotToken:
+    """
+    One token of DOT source. kind is 'id', 'number', 'string', 'html', 'keyword', 'edgeop',
+    a punctuation character or 'eof'. Positions are zero-based lines and columns.
+    """
+    __slots__ = ('kind', 'value', 'line', 'col', 'end_line', 'end_col')
+
+    def __init__(self, kind, value, line, col, end_line, end_col):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.col = col
+        self.end_line = end_line
+        self.end_col = end_col
+
+    def __repr__(self):
+        return f"DotToken({self.kind!r}, {self.value!r}, {self.line}, {self.col})"
+
+    def describe(self):
+        return "end of input" if self.kind == 'eof' else f"'{self.value}'"
+
+DOT_KEYWORDS = ('strict', 'graph', 'digraph', 'subgraph', 'node', 'edge')
+
+DOT_TOKEN_RE = re.compile(r'''
+    (?P<space>[ \t\r\n\f\v]+)
+  | (?P<comment>//[^\n]*|/\*(?:[^*]|\*(?!/))*\*/|(?:(?<=\n)|^)\#[^\n]*)
+  | (?P<unclosed_comment>/\*)
+  | (?P<string>"(?:[^"\\]|\\.|\\\n)*")
+  | (?P<unclosed_string>")
+  | (?P<html><)
+  | (?P<edgeop>->|--)
+  | (?P<number>-?(?:\.[0-9]+|[0-9]+(?:\.[0-9]*)?))
+  | (?P<id>[A-Za-z_\x80-\U0010ffff][A-Za-z_0-9\x80-\U0010ffff]*)
+  | (?P<punct>[{}\[\];,=:+])
+''', re.VERBOSE | re.DOTALL)
+
+def tokenize_dot(code):
+    """
+    Splits DOT source into DotTokens, ending with an 'eof' token. Raises DotSyntaxError
+    for unterminated strings, comments and HTML labels, and for stray characters.
+    """
+    tokens = []
+    append = tokens.append
+    match_token = DOT_TOKEN_RE.match
+    # Files saved by some editors start with a byte order mark, which Graphviz skips too.
+    pos = 1 if code.startswith('\ufeff') else 0
+    line = 0
+    line_start = 0
+    length = len(code)
+    while pos < length:
+        match = match_token(code, pos)
+        if match is None:
+            col = pos - line_start
+            raise DotSyntaxError(f"Unexpected character '{code[pos]}'", line, col, line, col + 1)
+        kind = match.lastgroup
+        end = match.end()
+        if kind == 'space' or kind == 'comment':
+            newlines = code.count('\n', pos, end)
+            if newlines:
+                line += newlines
+                line_start = code.rfind('\n', pos, end) + 1
+            pos = end
+            continue
+        value = match.group()
+        if kind == 'id':
+            lowered = value.lower()
+            if lowered in DOT_KEYWORDS:
+                kind = 'keyword'
+                value = lowered
+        elif kind == 'punct':
+            kind = value
+        elif kind == 'string' or kind == 'html':
+            if kind == 'html':
+                end = html_string_end(code, pos)
+                if end is None:
+                    col = pos - line_start
+                    raise DotSyntaxError("Unterminated HTML label, missing '>'", line, col, line, col + 1)
+            value = code[pos + 1:end - 1]
+            newlines = code.count('\n', pos, end)
+            if newlines:
+                start_line, start_col = line, pos - line_start
+                line += newlines
+                line_start = code.rfind('\n', pos, end) + 1
+                append(DotToken(kind, value, start_line, start_col, line, end - line_start))
+                pos = end
+                continue
+        elif kind != 'number' and kind != 'edgeop':
+            col = pos - line_start
+            what = "comment, missing '*/'" if kind == 'unclosed_comment' else "string, missing '\"'"
+            raise DotSyntaxError(f"Unterminated {what}", line, col, line, col + len(value))
+        append(DotToken(kind, value, line, pos - line_start, line, end - line_start))
+        pos = end
+    col = length - line_start
+    append(DotToken('eof', '', line, col, line, col))
+    return tokens
+
+def html_string_end(code, start):
+    """
+    Returns the offset just past the '>' that closes the HTML string starting at start, or None.
+    """
+    depth = 0
+    for match in re.compile('[<>]').finditer(code, start):
+        depth += 1 if match.group() == '<' else -1
+        if depth == 0:
+            return match.end()
+    return None
+
+class DotGraph:
+    """
+    A parsed graph or subgraph. stmts holds its statements in order, as tuples:
+    ('attr', 'graph'|'node'|'edge', attrs), ('assign', key, value), ('node', node_id, attrs),
+    ('edge', endpoints, attrs) and ('subgraph', DotGraph). IDs are DotTokens, attrs are lists of
+    (key, value) token pairs, node_ids are (id, port) with port a list of tokens, and each edge
+    endpoint is either a node_id or a DotGraph.
+    """
+    def __init__(self, name=None, strict=False, directed=False, subgraph=False):
+        self.name = name
+        self.strict = strict
+        self.directed = directed
+        self.subgraph = subgraph
+        self.stmts = []
+
+class DotParser:
+    """
+    A recursive descent parser for the DOT language, following the grammar at
+    https://graphviz.org/doc/info/lang.html.
+    """
+    ID_KINDS = ('id', 'number', 'string', 'html')
+
+    def __init__(self, code):
+        self.tokens = tokenize_dot(code)
+        self.pos = 0
+        self.directed = False
+
+    def peek(self, offset=0):
+        # The eof token is never consumed, so the position never runs off the end.
+        return self.tokens[self.pos + offset]
+
+    def advance(self):
+        token = self.tokens[self.pos]
+        if token.kind != 'eof':
+            self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token.kind == kind and (value is None or token.value == value):
+            return self.advance()
+        return None
+
+    def expect(self, kind, what):
+        token = self.accept(kind)
+        if token is None:
+            self.fail(f"Expected {what} but found {self.peek().describe()}")
+        return token
+
+    def fail(self, message, token=None):
+        token = token or self.peek()
+        raise DotSyntaxError(message, token.line, token.col, token.end_line, token.end_col)
+
+    def parse(self):
+        graphs = []
+        while self.peek().kind != 'eof':
+            graphs.append(self.graph())
+        return graphs
+
+    def graph(self):
+        strict = self.accept('keyword', 'strict') is not None
+        token = self.peek()
+        if token.kind != 'keyword' or token.value not in ('graph', 'digraph'):
+            self.fail(f"Expected 'graph' or 'digraph' but found {token.describe()}")
+        self.advance()
+        self.directed = token.value == 'digraph'
+        graph = DotGraph(self.id(optional=True), strict, self.directed)
+        self.body(graph)
+        return graph
+
+    def body(self, graph):
+        opening = self.expect('{', "'{'")
+        while not self.accept('}'):
+            if self.peek().kind == 'eof':
+                self.fail(f"Missing '}}' to close the '{{' on line {opening.line + 1}", opening)
+            self.stmt(graph)
+            self.accept(';')
+
+    def stmt(self, graph):
+        token = self.peek()
+        if token.kind == 'keyword' and token.value in ('graph', 'node', 'edge'):
+            self.advance()
+            if self.peek().kind != '[':
+                self.fail(f"Expected '[' after '{token.value}' but found {self.peek().describe()}")
+            graph.stmts.append(('attr', token.value, self.attr_list()))
+        elif token.kind == '{' or (token.kind == 'keyword' and token.value == 'subgraph'):
+            subgraph = self.subgraph()
+            if self.peek().kind == 'edgeop':
+                self.edge_stmt(graph, subgraph)
+            else:
+                graph.stmts.append(('subgraph', subgraph))
+        elif token.kind in self.ID_KINDS:
+            if self.peek(1).kind == '=':
+                key = self.id()
+                self.advance()
+                graph.stmts.append(('assign', key, self.id()))
+                return
+            node_id = self.node_id()
+            if self.peek().kind == 'edgeop':
+                self.edge_stmt(graph, node_id)
+            else:
+                attrs = self.attr_list() if self.peek().kind == '[' else []
+                graph.stmts.append(('node', node_id, attrs))
+        else:
+            self.fail(f"Unexpected {token.describe()}, expected a statement")
+
+    def edge_stmt(self, graph, first):
+        endpoints = [first]
+        while self.peek().kind == 'edgeop':
+            op = self.advance()
+            if op.value != ('->' if self.directed else '--'):
+                kind = 'a directed' if self.directed else 'an undirected'
+                self.fail(f"'{op.value}' can't be used in {kind} graph, use "
+                          f"'{'->' if self.directed else '--'}'", op)
+            token = self.peek()
+            if token.kind == '{' or (token.kind == 'keyword' and token.value == 'subgraph'):
+                endpoints.append(self.subgraph())
+            elif token.kind in self.ID_KINDS or token.kind == 'keyword':
+                endpoints.append(self.node_id())
+            else:
+                self.fail(f"Expected a node or subgraph after '{op.value}' but found {token.describe()}")
+        attrs = self.attr_list() if self.peek().kind == '[' else []
+        graph.stmts.append(('edge', endpoints, attrs))
+
+    def subgraph(self):
+        name = None
+        if self.accept('keyword', 'subgraph'):
+            name = self.id(optional=True)
+        graph = DotGraph(name, directed=self.directed, subgraph=True)
+        self.body(graph)
+        return graph
+
+    def node_id(self):
+        name = self.id()
+        port = []
+        while len(port) < 2 and self.accept(':'):
+            port.append(self.id())
+        return (name, port)
+
+    def attr_list(self):
+        attrs = []
+        while self.accept('['):
+            while not self.accept(']'):
+                if self.peek().kind == 'eof':
+                    self.fail("Missing ']' to close the attribute list")
+                key = self.id()
+                self.expect('=', f"'=' after attribute '{key.value}'")
+                attrs.append((key, self.id()))
+                self.accept(';') or self.accept(',')
+        return attrs
+
+    def id(self, optional=False):
+        token = self.peek()
+        if token.kind not in self.ID_KINDS:
+            if optional:
+                return None
+            if token.kind == 'keyword':
+                self.fail(f"'{token.value}' is a keyword, quote it to use it as a name")
+            self.fail(f"Expected a name or value but found {token.describe()}")
+        self.advance()
+        if token.kind == 'string':
+            # "a" + "b" concatenates quoted strings.
+            while self.peek().kind == '+':
+                self.advance()
+                following = self.expect('string', "a quoted string after '+'")
+                token = DotToken('string', token.value + following.value, token.line, token.col,
+                                 following.end_line, following.end_col)
+        return token
+
+def parse_dot(code):
+    """
+    Parses DOT source into a list of DotGraphs (a file may hold several, or none).
+    Raises DotSyntaxError with the exact location of the first syntax error.
+    """
+    return DotParser(code).parse()
+
+def has_graph(code):
+    """
+    Tells whether code holds anything but whitespace and comments, i.e. whether parse_dot() would
+    find a graph (or an error) in it rather than return []. Only the leading tokens are looked at.
+    """
+    pos = 1 if code.startswith('\ufeff') else 0
+    while pos < len(code):
+        match = DOT_TOKEN_RE.match(code, pos)
+        if match is None or match.lastgroup not in ('space', 'comment'):
+            return True
+        pos = match.end()
+    return False
+
+# Graph attributes that only change how a graph looks, not where anything goes.
+COSMETIC_GRAPH_ATTRS = {
+    'bgcolor', 'class', 'color', 'colorscheme', 'comment', 'fillcolor', 'fontcolor', 'fontname',
+    'fontsize', 'href', 'id', 'label', 'labeljust', 'labelloc', 'pencolor', 'penwidth', 'style',
+    'target', 'tooltip', 'url',
+}
+# Node and edge attributes that feed into the layout itself.
+LAYOUT_ATTRS = {
+    'constraint', 'group', 'headport', 'lhead', 'ltail', 'minlen', 'ordering', 'pin', 'pos',
+    'rank', 'samehead', 'sametail', 'tailport', 'weight',
+}
+
+class GraphOutline:
+    """
+    The structure of a parsed graph: its nodes, its edges as (tail, head) names in creation order,
+    the members of each subgraph, and every attribute that affects the layout.
+    Two graphs with equal signatures differ only in labels and styling.
+    """
+    def __init__(self, graph):
+        self.directed = graph.directed
+        self.strict = graph.strict
+        self.nodes = {}
+        self.edges = []
+        self.subgraphs = []
+        self.layout_attrs = []
+        self._visit(graph, ())
+
+    def signature(self):
+        return (self.directed, self.strict, tuple(self.nodes), tuple(self.edges),
+                tuple(self.subgraphs), tuple(self.layout_attrs))
+
+    def _attrs(self, target, attrs):
+        for key, value in attrs:
+            name = key.value.lower()
+            if name in LAYOUT_ATTRS or (target == 'graph' and name not in COSMETIC_GRAPH_ATTRS):
+                self.layout_attrs.append((target, name, value.value))
+
+    def _visit(self, graph, path):
+        members = {}
+        for index, stmt in enumerate(graph.stmts):
+            kind = stmt[0]
+            if kind == 'attr':
+                self._attrs(stmt[1], stmt[2])
+            elif kind == 'assign':
+                self._attrs('graph', [(stmt[1], stmt[2])])
+            elif kind == 'node':
+                members[stmt[1][0].value] = None
+                self._attrs('node', stmt[2])
+            elif kind == 'subgraph':
+                members.update(self._visit(stmt[1], path + (subgraph_label(stmt[1], index),)))
+            else:
+                groups = []
+                for position, endpoint in enumerate(stmt[1]):
+                    if isinstance(endpoint, DotGraph):
+                        names = self._visit(endpoint, path + (subgraph_label(endpoint, f'{index}.{position}'),))
+                    else:
+                        names = {endpoint[0].value: None}
+                    members.update(names)
+                    groups.append(list(names))
+                for tails, heads in zip(groups, groups[1:]):
+                    self.edges.extend((tail, head) for tail in tails for head in heads)
+                self._attrs('edge', stmt[2])
+        self.nodes.update(members)
+        self.subgraphs.append((path, tuple(members)))
+        return members
+
+def subgraph_label(graph, index):
+    return graph.name.value if graph.name is not None else f'#{index}'
+
+def dot_id(token):
+    """
+    Writes a DotToken back out as a DOT ID.
+    """
+    if token.kind == 'string':
+        return f'"{token.value}"'
+    if token.kind == 'html':
+        return f'<{token.value}>'
+    return token.value
+
+def write_pinned_dot(graph, layout):
+    """
+    Writes graph back out as DOT with the node, edge and cluster positions of layout, a previous
+    Graphviz -Tdot layout of a graph with the same structure, so `neato -n2` can draw it without
+    laying it out again. Edge statements are expanded to one edge per statement so each edge can
+    carry its own position.
+    """
+    node_positions = {}
+    edge_positions = {}
+    graph_positions = {}
+    counts = {}
+
+    def collect(g, subgraph_name):
+        for stmt in g.stmts:
+            if stmt[0] == 'attr' and stmt[1] == 'graph':
+                graph_positions.setdefault(subgraph_name, []).extend(
+                    (k, v) for k, v in stmt[2] if k.value in ('bb', 'lp', 'lwidth', 'lheight'))
+            elif stmt[0] == 'node':
+                node_positions[stmt[1][0].value] = [(k, v) for k, v in stmt[2] if k.value == 'pos']
+            elif stmt[0] == 'edge' and not isinstance(stmt[1][0], DotGraph) and not isinstance(stmt[1][-1], DotGraph):
+                tail, head = stmt[1][0][0].value, stmt[1][-1][0].value
+                n = counts[(tail, head)] = counts.get((tail, head), -1) + 1
+                edge_positions[(tail, head, n)] = [(k, v) for k, v in stmt[2] if k.value in ('pos', 'lp')]
+            elif stmt[0] == 'subgraph':
+                collect(stmt[1], subgraph_label(stmt[1], None))
+    collect(layout, None)
+
+    lines = []
+    counts.clear()
+    def attr_list(attrs):
+        return f" [{', '.join(f'{dot_id(k)}={dot_id(v)}' for k, v in attrs)}]" if attrs else ''
+
+    def endpoint(node_id):
+        return ':'.join(dot_id(part) for part in [node_id[0]] + node_id[1])
+
+    def members(g):
+        names = {}
+        for stmt in g.stmts:
+            if stmt[0] == 'node':
+                names[stmt[1][0].value] = stmt[1]
+            elif stmt[0] == 'subgraph':
+                names.update(members(stmt[1]))
+            elif stmt[0] == 'edge':
+                for point in stmt[1]:
+                    names.update(members(point) if isinstance(point, DotGraph) else {point[0].value: point})
+        return names
+
+    def write(g, depth, subgraph_name):
+        indent = '\t' * depth
+        for stmt in g.stmts:
+            kind = stmt[0]
+            if kind == 'attr':
+                lines.append(f"{indent}{stmt[1]}{attr_list(stmt[2])};")
+            elif kind == 'assign':
+                lines.append(f"{indent}{dot_id(stmt[1])}={dot_id(stmt[2])};")
+            elif kind == 'node':
+                lines.append(f"{indent}{endpoint(stmt[1])}{attr_list(stmt[2])};")
+            elif kind == 'subgraph':
+                write_subgraph(stmt[1], depth)
+            else:
+                groups = []
+                for point in stmt[1]:
+                    if isinstance(point, DotGraph):
+                        write_subgraph(point, depth)
+                        groups.append(list(members(point).values()))
+                    else:
+                        groups.append([point])
+                op = '->' if graph.directed else '--'
+                for tails, heads in zip(groups, groups[1:]):
+                    for tail in tails:
+                        for head in heads:
+                            key = (tail[0].value, head[0].value)
+                            n = counts[key] = counts.get(key, -1) + 1
+                            attrs = stmt[2] + edge_positions.get(key + (n,), [])
+                            lines.append(f"{indent}{endpoint(tail)} {op} {endpoint(head)}{attr_list(attrs)};")
+        if graph_positions.get(subgraph_name):
+            lines.append(f"{indent}graph{attr_list(graph_positions[subgraph_name])};")
+
+    def write_subgraph(g, depth):
+        name = f"subgraph {dot_id(g.name)} " if g.name is not None else ''
+        lines.append('\t' * depth + name + '{')
+        write(g, depth + 1, subgraph_label(g, None) if g.name is not None else '')
+        lines.append('\t' * depth + '}')
+
+    header = ('strict ' if graph.strict else '') + ('digraph' if graph.directed else 'graph')
+    lines.append(f"{header} {dot_id(graph.name) + ' ' if graph.name is not None else ''}{{")
+    write(graph, 1, None)
+    for name, attrs in node_positions.items():
+        if attrs:
+            lines.append(f"\t{dot_id(DotToken('string', name, 0, 0, 0, 0))}{attr_list(attrs)};")
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+class LayoutStore:
+    """
+    The last full layout of each editor session's graph, along with the signature of the graph it
+    was made for. Bounded like EditorSessions, forgetting the least recently used sessions first.
+    """
+    def __init__(self, max_sessions=MAX_EDITOR_SESSIONS):
+        self.max_sessions = max_sessions
+        self._layouts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session):
+        with self._lock:
+            entry = self._layouts.get(session)
+            if entry is not None:
+                self._layouts.move_to_end(session)
+            return entry
+
+    def put(self, session, signature, layout):
+        with self._lock:
+            self._layouts[session] = (signature, layout)
+            self._layouts.move_to_end(session)
+            while len(self._layouts) > self.max_sessions:
+                self._layouts.popitem(last=False)
+
+layout_store = LayoutStore()
+
+def incremental_outline(code, graphs, session):
+    """
+    Returns the GraphOutline of the graph if render_preview should lay it out incrementally,
+    i.e. it belongs to an editor session and is big enough to be worth it, otherwise None.
+    The outline is only built when estimate_graph_cost(), which never counts fewer names than
+    there are nodes, says the graph might be big enough, so small graphs skip it on every keystroke.
+    """
+    if session is None or len(graphs) != 1 or estimate_graph_cost(code) < INCREMENTAL_LAYOUT_MIN_NODES:
+        return None
+    outline = GraphOutline(graphs[0])
+    return outline if len(outline.nodes) >= INCREMENTAL_LAYOUT_MIN_NODES else None
+
+def render_preview(code, graphs, session=None, cancel=None, engine='dot'):
+    """
+    Renders the SVG for the editor preview of already parsed code.
+    For big graphs the session's last layout is kept, and when an edit only changed labels or
+    styling the graph is drawn at the old coordinates with `neato -n2` instead of laid out again.
+    """
+    engine, args = layout_engine(engine, code, preview=True)
+    outline = incremental_outline(code, graphs, session)
+    if outline is None:
+        return render(code, engine, 'svg', cancel, args)
+    signature = (engine, args, outline.signature())
+    previous = layout_store.get(str(session))
+    if previous is not None and previous[0] == signature:
+        pinned = write_pinned_dot(graphs[0], parse_dot(previous[1].decode('utf-8'))[0])
+        try:
+            return render(pinned, 'neato', 'svg', cancel, ('-n2',))
+        except (PoolBusyError, RenderCancelled):
+            raise
+        except RenderError:
+            # Fall back to a full layout if the pinned graph is somehow rejected.
+            pass
+    # One layout gives both the SVG and the positions to reuse next time.
+    output = render(code, engine, 'svg+dot', cancel, args)
+    end = output.index(b'</svg>') + len(b'</svg>\n')
+    layout_store.put(str(session), signature, output[end:])
+    return output[:end]
+
+# The root <svg> tag of Graphviz output, its viewBox and namespaces, and the group holding the graph.
+SVG_ROOT_RE = re.compile(rb'<svg\b[^>]*>')
+SVG_VIEWBOX_RE = re.compile(rb'viewBox="([-\d.]+) ([-\d.]+) ([-\d.]+) ([-\d.]+)"')
+SVG_XMLNS_RE = re.compile(rb'xmlns(?::\w+)?="[^"]*"')
+SVG_GRAPH_GROUP_RE = re.compile(rb'<g id="graph0" class="graph" transform="scale\(([-\d.]+) ([-\d.]+)\) '
+                                rb'rotate\(([-\d.]+)\) translate\(([-\d.]+) ([-\d.]+)\)">')
+# The group Graphviz writes for every cluster, node and edge, and what their bounding boxes come from.
+SVG_ELEMENT_RE = re.compile(rb'<g id="[^"]*" class="(?:node|edge|cluster)">')
+SVG_COORDS_RE = re.compile(rb' (?:points|d)="([^"]*)"')
+SVG_NUMBER_RE = re.compile(rb'-?\d+(?:\.\d*)?(?:e[-+]?\d+)?')
+SVG_ELLIPSE_RE = re.compile(rb'<ellipse\b[^>]* cx="([-\d.]+)" cy="([-\d.]+)" rx="([-\d.]+)" ry="([-\d.]+)"')
+SVG_TEXT_RE = re.compile(rb'<text\b([^>]*)>([^<]*)</text>\n?')
+SVG_ATTR_RE = re.compile(rb' (x|y|font-size)="([-\d.]+)"')
+
+class TileSet:
+    """
+    A laid out graph cut into square tiles for the preview of very large graphs.
+    The SVG is split into its clusters, nodes and edges, each with its bounding box in viewBox
+    units, and indexed on a TILE_GRID x TILE_GRID grid so a tile only looks at the elements near it.
+    Tiles at zoom level z split the longer side of the graph into 2**z. Zoomed out, labels too
+    small to read and elements smaller than a pixel are left out.
+    """
+    def __init__(self, svg, layout):
+        self.layout = layout
+        root = SVG_ROOT_RE.search(svg)
+        group = SVG_GRAPH_GROUP_RE.search(svg)
+        view_box = SVG_VIEWBOX_RE.search(root.group(0)) if root else None
+        if view_box is None or group is None or float(group.group(3)) != 0:
+            raise ValueError("Only unrotated Graphviz SVGs can be tiled")
+        self.width, self.height = float(view_box.group(3)), float(view_box.group(4))
+        self.extent = max(self.width, self.height, 1.0)
+        self.scale = float(group.group(1)), float(group.group(2))
+        self.translate = float(group.group(4)), float(group.group(5))
+        self.group_tag = group.group(0)
+        self.namespaces = b' '.join(SVG_XMLNS_RE.findall(root.group(0)))
+        # At the deepest zoom level a point of the graph is TILE_MAX_SCALE pixels.
+        self.max_zoom = max(0, math.ceil(math.log2(TILE_MAX_SCALE * self.extent / TILE_SIZE)))
+
+        starts = [m.start() for m in SVG_ELEMENT_RE.finditer(svg, group.end())]
+        ends = starts[1:] + [svg.rfind(b'</g>\n</svg>')]
+        self.elements = []
+        for start, end in zip(starts, ends):
+            segment = svg[start:end]
+            box = self._bounds(segment)
+            if box is not None:
+                self.elements.append((segment,) + box)
+        self._cell = self.extent / TILE_GRID
+        self._grid = {}
+        self._large = []
+        for index, (_, x0, y0, x1, y1) in enumerate(self.elements):
+            cells = [(cx, cy) for cx in self._cells(x0, x1) for cy in self._cells(y0, y1)]
+            if len(cells) > TILE_GRID:
+                # Long edges and big clusters would be in too many cells; every tile checks them.
+                self._large.append(index)
+            for cell in cells if len(cells) <= TILE_GRID else ():
+                self._grid.setdefault(cell, []).append(index)
+
+    def info(self):
+        return {'width': self.width, 'height': self.height, 'extent': self.extent,
+                'tile_size': TILE_SIZE, 'max_zoom': self.max_zoom}
+
+    def _cells(self, low, high):
+        return range(max(int(low / self._cell), 0), min(int(high / self._cell), TILE_GRID - 1) + 1)
+
+    def _bounds(self, segment):
+        """
+        The bounding box of an element's drawing in viewBox units, or None if it draws nothing.
+        """
+        xs, ys = [], []
+        for coords in SVG_COORDS_RE.findall(segment):
+            numbers = [float(n) for n in SVG_NUMBER_RE.findall(coords)]
+            xs.extend(numbers[0::2])
+            ys.extend(numbers[1::2])
+        for cx, cy, rx, ry in SVG_ELLIPSE_RE.findall(segment):
+            cx, cy, rx, ry = float(cx), float(cy), float(rx), float(ry)
+            xs.extend((cx - rx, cx + rx))
+            ys.extend((cy - ry, cy + ry))
+        for attrs, text in SVG_TEXT_RE.findall(segment):
+            attrs = {name: float(value) for name, value in SVG_ATTR_RE.findall(attrs)}
+            if b'x' in attrs and b'y' in attrs:
+                # Wide enough for any anchor, as tall as the font.
+                size = attrs.get(b'font-size', 14.0)
+                half = len(text) * size * 0.6
+                xs.extend((attrs[b'x'] - half, attrs[b'x'] + half))
+                ys.extend((attrs[b'y'] - size, attrs[b'y'] + size / 3))
+        if not xs or not ys:
+            return None
+        (sx, sy), (tx, ty) = self.scale, self.translate
+        return sx * (min(xs) + tx), sy * (min(ys) + ty), sx * (max(xs) + tx), sy * (max(ys) + ty)
+
+    def check(self, z, x, y):
+        if not (0 <= z <= self.max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise KeyError((z, x, y))
+
+    def tile_svg(self, z, x, y):
+        """
+        The part of the SVG that falls on tile (x, y) of zoom level z, scaled to TILE_SIZE pixels.
+        """
+        self.check(z, x, y)
+        size = self.extent / 2 ** z
+        left, top = x * size, y * size
+        pixels = TILE_SIZE / size
+        parts = [b'<svg %s width="%d" height="%d" viewBox="%.2f %.2f %.2f %.2f">\n'
+                 % (self.namespaces, TILE_SIZE, TILE_SIZE, left, top, size, size), self.group_tag, b'\n']
+        candidates = set(self._large)
+        for cx in self._cells(left, left + size):
+            for cy in self._cells(top, top + size):
+                candidates.update(self._grid.get((cx, cy), ()))
+        for index in sorted(candidates):
+            segment, x0, y0, x1, y1 = self.elements[index]
+            if x1 < left or x0 > left + size or y1 < top or y0 > top + size:
+                continue
+            if (x1 - x0) * pixels < TILE_MIN_ELEMENT_PX and (y1 - y0) * pixels < TILE_MIN_ELEMENT_PX:
+                continue
+            if pixels < TILE_TEXT_MIN_SCALE:
+                segment = SVG_TEXT_RE.sub(b'', segment)
+            parts.append(segment)
+        parts.append(b'</g>\n</svg>\n')
+        return b''.join(parts)
+
+    def tile_png(self, z, x, y, cancel=None):
+        """
+        Tile (x, y) of zoom level z as a PNG. Graphviz draws it from the kept layout with
+        `neato -n2`, clipped to the tile with the viewport attribute, so nothing is laid out again.
+        """
+        self.check(z, x, y)
+        size = self.extent / 2 ** z
+        (sx, sy), (tx, ty) = self.scale, self.translate
+        # The center of the tile in graph coordinates, where y points up.
+        center_x = (x + 0.5) * size / sx - tx
+        center_y = -((y + 0.5) * size / sy - ty)
+        zoom = TILE_SIZE / size * sx
+        end = self.layout.rfind(b'}')
+        viewport = f'\ngraph [dpi=72, viewport="{TILE_SIZE},{TILE_SIZE},{zoom:.6f},{center_x:.2f},{center_y:.2f}"];\n'
+        code = (self.layout[:end] + viewport.encode('ascii') + self.layout[end:]).decode('utf-8')
+        return render(code, 'neato', 'png', cancel, ('-n2',))
+
+class TileStore:
+    """
+    The TileSets of the graphs previewed last, by tile id, forgetting the least recently used first.
+    """
+    def __init__(self, max_sets=MAX_TILE_SETS):
+        self.max_sets = max_sets
+        self._sets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tile_id):
+        with self._lock:
+            tiles = self._sets.get(tile_id)
+            if tiles is not None:
+                self._sets.move_to_end(tile_id)
+            return tiles
+
+    def put(self, tile_id, tiles):
+        with self._lock:
+            self._sets[tile_id] = tiles
+            self._sets.move_to_end(tile_id)
+            while len(self._sets) > self.max_sets:
+                self._sets.popitem(last=False)
+
+tile_store = TileStore()
+
+def tile_set(code, engine='dot', cancel=None):
+    """
+    Lays the graph out once, or finds its layout in render_cache, and returns (tile id, TileSet).
+    The tile id is a hash of the code and engine, so tiles can be cached forever.
+    """
+    engine, args = layout_engine(engine, code, preview=True)
+    tile_id = RenderCache.key(code, ' '.join((engine,) + args), 'tiles')
+    tiles = tile_store.get(tile_id)
+    if tiles is None:
+        output = render(code, engine, 'svg+dot', cancel, args)
+        end = output.index(b'</svg>') + len(b'</svg>\n')
+        tiles = TileSet(output[:end], output[end:])
+        tile_store.put(tile_id, tiles)
+    return tile_id, tiles
+
+DEFAULT_CODE = "digraph G {\n    A -> B;\n    B -> C;\n    C -> A;\n}"
+
+def common_prefix_length(a, b):
+    """
+    Length of the longest common prefix of two strings, found by bisecting on slice comparisons
+    so the character comparisons run in C.
+    """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def text_delta(old, new):
+    """
+    Describes the change from old to new as a single replacement of old[start:end] by text.
+    """
+    start = common_prefix_length(old, new)
+    # Compare the remainders back to front, without letting the suffix overlap the prefix.
+    suffix = common_prefix_length(old[start:][::-1], new[start:][::-1])
+    return {'start': start, 'end': len(old) - suffix, 'text': new[start:len(new) - suffix]}
+
+def next_revision(revision, delta):
+    """
+    Revision ids are chained hashes of the edits, so computing one costs as much as the edit is big.
+    """
+    digest = hashlib.sha256(revision.encode('ascii'))
+    digest.update(json.dumps(delta, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()[:20]
+
+def checked_changes(changes, length):
+    """
+    Checks a list of {'start', 'end', 'text'} changes, each relative to the text left by the one
+    before, against a text of the given length and returns them as deltas.
+    Raises ValueError if a change doesn't fit the text.
+    """
+    deltas = []
+    for change in changes:
+        start, end, text = change.get('start'), change.get('end'), change.get('text', '')
+        if not (isinstance(start, int) and isinstance(end, int) and isinstance(text, str)
+                and 0 <= start <= end <= length):
+            raise ValueError(f"Change {change!r} doesn't fit a text of length {length}")
+        deltas.append({'start': start, 'end': end, 'text': text})
+        length += len(text) - (end - start)
+    return deltas
+
+def apply_deltas(code, deltas):
+    for delta in deltas:
+        code = code[:delta['start']] + delta['text'] + code[delta['end']:]
+    return code
+
+class StaleRevision(Exception):
+    """
+    Raised when changes are based on a revision of a document other than its current one.
+    """
+    def __init__(self, revision):
+        super().__init__(f"Document is at revision {revision}")
+        self.revision = revision
+
+def write_atomically(path, text):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class WorkspaceStore:
+    """
+    Named documents for every user, kept under root/<user>/.
+    Each document is a snapshot (<id>.json, holding the code as of revision seq) and an append-only
+    log (<id>.log) with one JSON line per save since then, holding only the range that changed.
+    Every compact_every saves the log is folded into a new snapshot. index.json maps each user's
+    document ids to their names, so a document is found without scanning the directory.
+    Snapshots and the index are replaced atomically. Each save re-reads the document, checks its
+    base, appends and compacts under an flock on the user's .lock file, as do index changes, so
+    several processes can share the store.
+    """
+    NAME_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+    def __init__(self, root=WORKSPACE_DIR, compact_every=WORKSPACE_COMPACT_EVERY, max_open=256):
+        self.root = root
+        self.compact_every = compact_every
+        self.max_open = max_open
+        self._open = OrderedDict()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def valid_id(cls, value):
+        return isinstance(value, str) and cls.NAME_RE.match(value) is not None
+
+    def _dir(self, user):
+        if not self.valid_id(user):
+            raise KeyError(user)
+        return os.path.join(self.root, user)
+
+    def _read_index(self, user):
+        try:
+            with open(os.path.join(self._dir(user), 'index.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def has_users(self):
+        """
+        Returns whether any user has a workspace yet.
+        """
+        try:
+            return any(self.valid_id(name) for name in os.listdir(self.root))
+        except FileNotFoundError:
+            return False
+
+    def list_documents(self, user):
+        """
+        Returns the user's documents as {'id', 'name', 'engine'} dicts, most recently created first.
+        """
+        index = self._read_index(user)
+        return [{'id': doc_id, 'name': entry['name'], 'engine': entry.get('engine', 'dot')}
+                for doc_id, entry in sorted(index.items(), key=lambda item: -item[1]['created'])]
+
+    def create_document(self, user, name, code=DEFAULT_CODE):
+        """
+        Creates a document and returns its id.
+        """
+        directory = self._dir(user)
+        os.makedirs(directory, exist_ok=True)
+        doc_id = secrets.token_urlsafe(8)
+        revision = next_revision('', {'start': 0, 'end': 0, 'text': code})
+        write_atomically(os.path.join(directory, f'{doc_id}.json'),
+                         json.dumps({'seq': 0, 'revision': revision, 'code': code}))
+        with self._lock, self._locked(user):
+            index = self._read_index(user)
+            index[doc_id] = {'name': name, 'created': time.time()}
+            write_atomically(os.path.join(directory, 'index.json'), json.dumps(index))
+        return doc_id
+
+    def update_document(self, user, doc_id, **fields):
+        """
+        Changes the name or layout engine of a document. Raises KeyError if it doesn't exist.
+        """
+        with self._lock, self._locked(user):
+            index = self._read_index(user)
+            if doc_id not in index:
+                raise KeyError(doc_id)
+            index[doc_id].update(fields)
+            write_atomically(os.path.join(self._dir(user), 'index.json'), json.dumps(index))
+
+    def load(self, user, doc_id):
+        """
+        Returns (code, revision) of a document. Raises KeyError if it doesn't exist.
+        """
+        with self._lock:
+            state = self._state(user, doc_id)
+            return state['code'], state['revision']
+
+    def save(self, user, doc_id, code):
+        """
+        Saves the full text of a document, logging only what changed. Returns the new revision.
+        """
+        with self._lock, self._locked(user):
+            state = self._state(user, doc_id)
+            if code == state['code']:
+                return state['revision']
+            return self._append(user, doc_id, state, [text_delta(state['code'], code)])
+
+    def apply_changes(self, user, doc_id, base, changes):
+        """
+        Applies a list of {'start', 'end', 'text'} changes, each relative to the text left by the one
+        before, to the document at revision base. Returns the new revision. Raises StaleRevision if
+        the document has moved on from base and ValueError if a change doesn't fit the text.
+        """
+        with self._lock, self._locked(user):
+            state = self._state(user, doc_id)
+            if base != state['revision']:
+                raise StaleRevision(state['revision'])
+            deltas = checked_changes(changes, len(state['code']))
+            if not deltas:
+                return state['revision']
+            return self._append(user, doc_id, state, deltas)
+
+    def _paths(self, user, doc_id):
+        if not self.valid_id(doc_id):
+            raise KeyError(doc_id)
+        base = os.path.join(self._dir(user), doc_id)
+        return base + '.json', base + '.log'
+
+    @contextmanager
+    def _locked(self, user):
+        """
+        Holds an flock on the user's .lock file for a whole read-modify-write, so another process
+        can't change their files in between. The lock file is never replaced, unlike snapshots, logs
+        and the index, so every process locks the same inode. There is one per user, however many
+        document ids requests make up.
+        """
+        try:
+            f = open(os.path.join(self._dir(user), '.lock'), 'a')
+        except FileNotFoundError:
+            raise KeyError(user)
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _state(self, user, doc_id):
+        """
+        Returns the in-memory state of a document, reloading it if another process changed the files.
+        """
+        snapshot_path, log_path = self._paths(user, doc_id)
+        try:
+            stamp = os.stat(snapshot_path).st_mtime_ns
+        except FileNotFoundError:
+            raise KeyError(doc_id)
+        try:
+            log_size = os.stat(log_path).st_size
+        except FileNotFoundError:
+            log_size = 0
+        key = (user, doc_id)
+        state = self._open.get(key)
+        if state is None or state['stamp'] != stamp or state['log_size'] != log_size:
+            state = self._replay(snapshot_path, log_path)
+            self._open[key] = state
+        self._open.move_to_end(key)
+        while len(self._open) > self.max_open:
+            self._open.popitem(last=False)
+        return state
+
+    def _replay(self, snapshot_path, log_path):
+        with open(snapshot_path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+        code, seq, revision = snapshot['code'], snapshot['seq'], snapshot['revision']
+        pending = good_size = 0
+        try:
+            with open(log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("unfinished line")
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A save cut short by a crash; everything before it is intact, and
+                        # _append() cuts it off before writing after it.
+                        break
+                    good_size += len(line)
+                    # Entries already folded into the snapshot are skipped.
+                    if entry['seq'] <= snapshot['seq']:
+                        continue
+                    code = code[:entry['start']] + entry['text'] + code[entry['end']:]
+                    seq, revision = entry['seq'], entry['revision']
+                    pending += 1
+        except FileNotFoundError:
+            pass
+        return {'code': code, 'seq': seq, 'revision': revision, 'pending': pending,
+                'stamp': os.stat(snapshot_path).st_mtime_ns, 'good_size': good_size,
+                'log_size': os.path.getsize(log_path) if os.path.exists(log_path) else 0}
 
-@app.route('/')
-def index():
-    # On startup, load saved editor code if it exists.
-    try:
-        with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
-            saved_code = f.read()
-    except FileNotFoundError:
-        saved_code = "digraph G {\n    A -> B;\n    B -> C;\n    C -> A;\n}"
-    # Pass the saved code into the template.
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-       <meta charset="UTF-8">
-       <title>TechLines</title>
-       <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.5/codemirror.min.css">
-       <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.5/theme/dracula.min.css">
-       <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.5/addon/lint/lint.min.css">
-       <style>
-           html, body {
-              height: 100%;
-              margin: 0;
-              padding: 0;
-              overflow: hidden;
-              font-family: sans-serif;
-           }
-           #container {
-              display: flex;
-              height: 100%;
-           }
-           #editor-pane {
-              width: 50%;
-              height: 100%;
-              background-color: #2b2b2b;
-           }
-           #viewer-pane {
-              width: 50%;
-              height: 100%;
-              background-color: #fff;
-              display: flex;
-              flex-direction: column;
-           }
-           #toolbar {
-              padding: 10px;
-              background-color: #f0f0f0;
-              border-bottom: 1px solid #ccc;
-           }
-           #graph-container {
-              flex-grow: 1;
-              overflow: auto;
-              padding: 10px;
-           }
-           .CodeMirror {
-              height: 100%;
-           }
-       </style>
-    </head>
-    <body>
-       <div id="container">
-           <div id="editor-pane"></div>
-           <div id="viewer-pane">
-              <div id="toolbar">
-                  <button id="download-svg">Download SVG</button>
-                  <button id="download-png">Download PNG</button>
-                  <button id="load-svg">Load SVG</button>
-                  <!-- Hidden file input for loading an SVG -->
-                  <input type="file" id="load-svg-input" accept="image/svg+xml" style="display:none">
-              </div>
-              <div id="graph-container"></div>
-           </div>
+    def _append(self, user, doc_id, state, deltas):
+        """
+        Applies deltas to the document, appends them to its log and returns the new revision.
+        Called under _locked(), with state fresh from _state().
+        """
+        snapshot_path, log_path = self._paths(user, doc_id)
+        code, seq, revision = state['code'], state['seq'], state['revision']
+        lines = []
+        for delta in deltas:
+            code = code[:delta['start']] + delta['text'] + code[delta['end']:]
+            seq += 1
+            revision = next_revision(revision, delta)
+            lines.append(json.dumps(dict(delta, seq=seq, revision=revision)) + '\n')
+        with open(log_path, 'a', encoding='utf-8') as f:
+            if state['good_size'] < state['log_size']:
+                f.truncate(state['good_size'])
+            f.write(''.join(lines))
+            f.flush()
+            log_size = f.tell()
+        state.update(code=code, seq=seq, revision=revision, pending=state['pending'] + len(deltas),
+                     log_size=log_size, good_size=log_size)
+        if state['pending'] >= self.compact_every:
+            self._compact(snapshot_path, log_path, state)
+        return revision
+
+    def _compact(self, snapshot_path, log_path, state):
+        """
+        Folds the log into a new snapshot. The snapshot records its seq, so if the process dies
+        before the log is emptied, replaying skips the entries it already contains.
+        """
+        write_atomically(snapshot_path, json.dumps(
+            {'seq': state['seq'], 'revision': state['revision'], 'code': state['code']}))
+        write_atomically(log_path, '')
+        state.update(pending=0, log_size=0, good_size=0, stamp=os.stat(snapshot_path).st_mtime_ns)
+
+workspace = WorkspaceStore()
+
+def workspace_user(cookies=None):
+    """
+    The user a request acts for, from the cookie index() hands out. Requests without one share
+    the 'default' user, which is what a single-user local install sees. Outside a Flask request
+    the parsed cookies are passed in.
+    """
+    user = (request.cookies if cookies is None else cookies).get(WORKSPACE_USER_COOKIE)
+    return user if WorkspaceStore.valid_id(user) else 'default'
+
+def default_document(user):
+    """
+    Returns the id of the user's newest document, creating the first one if needed. The code of the
+    old single-file backup, if there is one, becomes the first document of the first user the
+    workspace gets (browsers get a random user from index(), so that is rarely 'default').
+    """
+    documents = workspace.list_documents(user)
+    if documents:
+        return documents[0]['id']
+    code = DEFAULT_CODE
+    if user == 'default' or not workspace.has_users():
+        try:
+            with open(BACKUP_FILE, 'r', encoding='utf-8') as f:
+                code = f.read()
+        except FileNotFoundError:
+            pass
+    return workspace.create_document(user, 'Untitled', code)
+
+class PreviewChannel:
+    """
+    The live preview of one document, shared by every browser tab showing it.
+    Tabs send their edits with edit(). A background thread waits for the edits to pause for
+    PREVIEW_DEBOUNCE, renders only the newest revision (cancelling a render that an edit made
+    stale) and hands the result to every tab waiting in next_result(), so any number of tabs
+    cost one Graphviz run per revision.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.code = None
+        self.engine = 'dot'
+        self.revision = 0
+        self.latest = None
+        self.subscribers = 0
+        self._rendered = 0
+        self._edited = 0
+        self._rendering = False
+        self._cancel = threading.Event()
+        self._cond = threading.Condition()
+        # Futures of event loops waiting in wait_result(), woken with each new result.
+        self._waiters = []
+
+    def edit(self, base=None, changes=None, code=None, engine='dot'):
+        """
+        Applies changes made to revision base, or replaces the whole text with code, and schedules
+        a render. Returns the new revision. Raises StaleRevision if the channel isn't at base and
+        ValueError if a change doesn't fit the text.
+        """
+        if code is not None and not isinstance(code, str):
+            raise ValueError("code must be a string")
+        with self._cond:
+            if code is None:
+                if self.code is None or base != self.revision:
+                    raise StaleRevision(self.revision)
+                code = apply_deltas(self.code, checked_changes(changes, len(self.code)))
+            if code == self.code and engine == self.engine:
+                return self.revision
+            self.code, self.engine = code, engine
+            self.revision += 1
+            self._edited = time.monotonic()
+            self._cancel.set()
+            if not self._rendering:
+                self._rendering = True
+                threading.Thread(target=self._run, daemon=True).start()
+            self._cond.notify_all()
+            return self.revision
+
+    def next_result(self, seen, timeout):
+        """
+        Waits up to timeout seconds for a result newer than revision seen and returns it, or None.
+        Results that were overtaken while a tab waited are skipped.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.latest is not None and self.latest['revision'] > seen, timeout)
+            if self.latest is not None and self.latest['revision'] > seen:
+                return self.latest
+            return None
+
+    async def wait_result(self, seen, timeout):
+        """
+        next_result() for an event loop: waits without holding a thread.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.latest is not None and self.latest['revision'] > seen:
+                return self.latest
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._waiters.remove(waiter)
+        with self._cond:
+            if self.latest is not None and self.latest['revision'] > seen:
+                return self.latest
+            return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Wait for the edits to pause, starting over whenever another one comes in.
+                while True:
+                    if self._rendered == self.revision:
+                        self._rendering = False
+                        return
+                    remaining = self._edited + PREVIEW_DEBOUNCE - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                code, engine, revision = self.code, self.engine, self.revision
+                cancel = self._cancel = threading.Event()
+            try:
+                result = compile_preview(code, engine, self.session, cancel, tiles=True)
+            except RenderCancelled:
+                continue
+            except PoolBusyError:
+                # Try again in a second, or as soon as there is a newer revision.
+                with self._cond:
+                    self._cond.wait(1)
+                continue
+            with self._cond:
+                self._rendered = revision
+                if revision == self.revision:
+                    self.latest = dict(result, revision=revision)
+                    self._cond.notify_all()
+                    for loop, future in self._waiters:
+                        loop.call_soon_threadsafe(resolve_future, future)
+
+def resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+class PreviewChannels:
+    """
+    The PreviewChannel of every document being edited, by (user, document id). Channels nobody
+    is listening to are forgotten, least recently used first, once there are more than max_channels.
+    """
+    def __init__(self, max_channels=MAX_PREVIEW_CHANNELS):
+        self.max_channels = max_channels
+        self._channels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user, doc_id):
+        with self._lock:
+            key = (user, doc_id)
+            channel = self._channels.get(key)
+            if channel is None:
+                channel = self._channels[key] = PreviewChannel(f'preview:{user}/{doc_id}')
+            self._channels.move_to_end(key)
+            excess = len(self._channels) - self.max_channels
+            if excess > 0:
+                idle = [k for k, c in self._channels.items() if c.subscribers == 0 and k != key]
+                for forgotten in idle[:excess]:
+                    del self._channels[forgotten]
+            return channel
+
+    @contextmanager
+    def subscribe(self, user, doc_id):
+        """
+        Yields the document's channel, keeping it from being forgotten while in use.
+        """
+        channel = self.get(user, doc_id)
+        with self._lock:
+            channel.subscribers += 1
+        try:
+            yield channel
+        finally:
+            with self._lock:
+                channel.subscribers -= 1
+
+preview_channels = PreviewChannels()
+
+# The editor page. Its stylesheet and script are served separately from /assets/, under names
+# that change with their content, so browsers cache them for good.
+PAGE_TEMPLATE = '''
+<!DOCTYPE html>
+<html>
+<head>
+   <meta charset="UTF-8">
+   <title>TechLines</title>
+   {% if inline_css %}
+   <style>{{ inline_css|safe }}</style>
+   {% else %}
+   <link rel="stylesheet" href="{{ assets['techlines.css'] }}">
+   {% endif %}
+</head>
+<body>
+   <div id="container">
+       <div id="editor-pane"></div>
+       <div id="pane-divider"></div>
+       <div id="viewer-pane">
+          <div id="toolbar">
+              <select id="document-select">
+              {% for document in documents %}
+                  <option value="{{ document.id }}"{% if document.id == doc_id %} selected{% endif %}>{{ document.name }}</option>
+              {% endfor %}
+              </select>
+              <button id="new-document">New</button>
+              <select id="engine-select" title="Layout engine">
+              {% for name in engines %}
+                  <option value="{{ name }}"{% if name == engine %} selected{% endif %}>{{ name }}</option>
+              {% endfor %}
+              </select>
+              <button id="download-svg">Download SVG</button>
+              <button id="download-png">Download PNG</button>
+              <button id="load-svg">Load SVG</button>
+              <!-- Hidden file input for loading an SVG -->
+              <input type="file" id="load-svg-input" accept="image/svg+xml" style="display:none">
+          </div>
+          <div id="graph-container"></div>
        </div>
+   </div>
 
-       <script src="https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.5/codemirror.min.js"></script>
-       <script src="https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.5/addon/mode/simple.min.js"></script>
-       <script src="https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.5/mode/clike/clike.min.js"></script>
-       <script src="https://cdnjs.cloudflare.com/ajax/libs/codemirror/5.65.5/addon/lint/lint.min.js"></script>
-       <script src="https://unpkg.com/split.js/dist/split.min.js"></script>
-
-       <script>
-           // Debounce helper function.
-           function debounce(func, wait, immediate) {
-              var timeout;
-              return function() {
-                  var context = this, args = arguments;
-                  var later = function() {
-                      timeout = null;
-                      if (!immediate) func.apply(context, args);
-                  };
-                  var callNow = immediate && !timeout;
-                  clearTimeout(timeout);
-                  timeout = setTimeout(later, wait);
-                  if (callNow) func.apply(context, args);
-              };
-           }
+   <script>
+       // The document being edited, as the server has it.
+       var docId = {{ doc_id|tojson }};
+       var savedCode = {{ saved_code|tojson }};
+       var savedRevision = {{ saved_revision|tojson }};
+       // The layout engine the document is drawn with.
+       var engine = {{ engine|tojson }};
+       var livePreview = {{ live_preview|tojson }};
+   </script>
+   <script src="{{ assets['techlines.js'] }}"></script>
+</body>
+</html>
+'''
+
+PAGE_CSS = r'''
+html, body {
+   height: 100%;
+   margin: 0;
+   padding: 0;
+   overflow: hidden;
+   font-family: sans-serif;
+}
+#container {
+   display: flex;
+   height: 100%;
+}
+#editor-pane {
+   width: 50%;
+   height: 100%;
+   background-color: #2b2b2b;
+}
+#pane-divider {
+   flex: none;
+   width: 8px;
+   background-color: #ccc;
+   cursor: col-resize;
+}
+#viewer-pane {
+   flex: 1;
+   min-width: 0;
+   height: 100%;
+   background-color: #fff;
+   display: flex;
+   flex-direction: column;
+}
+#toolbar {
+   padding: 10px;
+   background-color: #f0f0f0;
+   border-bottom: 1px solid #ccc;
+}
+#graph-container {
+   flex-grow: 1;
+   overflow: auto;
+   padding: 10px;
+}
+.CodeMirror {
+   height: 100%;
+}
+'''
+
+PAGE_JS = r'''
+// Debounce helper function.
+function debounce(func, wait, immediate) {
+   var timeout;
+   return function() {
+       var context = this, args = arguments;
+       var later = function() {
+           timeout = null;
+           if (!immediate) func.apply(context, args);
+       };
+       var callNow = immediate && !timeout;
+       clearTimeout(timeout);
+       timeout = setTimeout(later, wait);
+       if (callNow) func.apply(context, args);
+   };
+}
+
+// Define a simple CodeMirror mode for Graphviz DOT language.
+CodeMirror.defineSimpleMode("dot", {
+    start: [
+        {regex: /"(?:[^\\"]|\\.)*"?/, token: "string"},
+        {regex: /\b(?:digraph|graph|subgraph|node|edge)\b/, token: "keyword"},
+        {regex: /\/\/.*/, token: "comment"},
+        {regex: /\/\*/, token: "comment", next: "comment"},
+        {regex: /->|--/, token: "operator"},
+        {regex: /[{}[\];,]/, token: "bracket"},
+        {regex: /[a-zA-Z_]\w*/, token: "variable"},
+        {regex: /\s+/, token: null}
+    ],
+    comment: [
+        {regex: /.*?\*\//, token: "comment", next: "start"},
+        {regex: /.*/, token: "comment"}
+    ],
+    meta: {
+        lineComment: "//"
+    }
+});
+
+// Every lint request carries this session's next revision number, so the server can
+// drop work on older revisions while the user keeps typing.
+var sessionId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+var revision = 0;
+
+// Live preview: edits are sent to /preview and the server pushes the rendered graph
+// back over /events, to every tab showing this document. Without it, every lint asks
+// /compile instead.
+var preview = livePreview && window.EventSource ?
+   new EventSource('/events?doc=' + encodeURIComponent(docId)) : null;
+// The revision of the text the server's preview has, and the edits made since.
+var previewRevision = null;
+var previewChanges = [];
+var previewSending = false;
+// CodeMirror's callback for the newest lint, which pushed results update.
+var previewLinting = null;
 
-           // Define a simple CodeMirror mode for Graphviz DOT language.
-           CodeMirror.defineSimpleMode("dot", {
-               start: [
-                   {regex: /"(?:[^\\"]|\\.)*"?/, token: "string"},
-                   {regex: /\b(?:digraph|graph|subgraph|node|edge)\b/, token: "keyword"},
-                   {regex: /\/\/.*/, token: "comment"},
-                   {regex: /\/\*/, token: "comment", next: "comment"},
-                   {regex: /->|--/, token: "operator"},
-                   {regex: /[{}[\];,]/, token: "bracket"},
-                   {regex: /[a-zA-Z_]\w*/, token: "variable"},
-                   {regex: /\s+/, token: null}
-               ],
-               comment: [
-                   {regex: /.*?\*\//, token: "comment", next: "start"},
-                   {regex: /.*/, token: "comment"}
-               ],
-               meta: {
-                   lineComment: "//"
+// Custom linter: sends the edits to the live preview, or the code to /compile, which
+// lints and renders in one round trip, then updates the lint gutter and the graph.
+function customLinter(text, updateLinting, options, cm) {
+   if (preview) {
+       previewLinting = updateLinting;
+       sendPreviewEdits();
+       return [];
+   }
+   revision += 1;
+   fetch('/compile', {
+       method: 'POST',
+       headers: {'Content-Type': 'application/json'},
+       body: JSON.stringify({ code: text, session: sessionId, revision: revision, engine: engine, tiles: true })
+   })
+   .then(response => response.json())
+   .then(data => {
+       if (data.status === 'superseded') return;
+       showCompiled(data, updateLinting);
+   })
+   .catch(error => {
+       console.error('Error linting code:', error);
+       updateLinting([]);
+       renderGraph();
+   });
+   return [];
+}
+
+// Show the lint annotations and the graph, or its tiles.
+function showCompiled(data, updateLinting) {
+   if (updateLinting) updateLinting(data.annotations);
+   if (data.annotations.length > 0) {
+       tileView = null;
+       document.getElementById('graph-container').innerHTML =
+          "<div style='color:red; font-size:18px; text-align:center; margin-top:20px;'>syntax error</div>";
+   } else if (data.tiles) {
+       showTiles(data.tiles);
+   } else {
+       tileView = null;
+       document.getElementById('graph-container').innerHTML = data.svg;
+   }
+}
+
+// Send the edits made since the preview's revision, or the whole text if they're bigger
+// or the server's preview has moved on. One request is in flight at a time.
+function sendPreviewEdits() {
+   if (previewSending) return;
+   previewSending = true;
+   var changes = previewChanges.splice(0, previewChanges.length);
+   var sentEngine = engine;
+   var post = function(body) {
+       body.doc = docId;
+       body.engine = sentEngine;
+       return fetch('/preview', {
+           method: 'POST',
+           headers: {'Content-Type': 'application/json'},
+           body: JSON.stringify(body)
+       });
+   };
+   var resync = function() {
+       // The whole text covers the changes made since, too.
+       previewChanges = [];
+       return post({ code: editor.getValue() });
+   };
+   var request = previewRevision === null || JSON.stringify(changes).length > editor.getValue().length ?
+       resync() : post({ base: previewRevision, changes: changes });
+   request
+   .then(response => response.status === 409 ? resync() : response)
+   .then(response => {
+       if (!response.ok) throw new Error('status ' + response.status);
+       return response.json();
+   })
+   .then(data => {
+       previewRevision = data.revision;
+       previewSending = false;
+       if (previewChanges.length > 0 || sentEngine !== engine) sendPreviewEdits();
+   })
+   .catch(error => {
+       // The next lint sends the whole text.
+       console.error('Error sending edits to the preview:', error);
+       previewRevision = null;
+       previewSending = false;
+   });
+}
+
+if (preview) {
+   preview.addEventListener('svg', function(e) {
+       showCompiled({ annotations: [], svg: e.data }, previewLinting);
+   });
+   preview.addEventListener('tiles', function(e) {
+       showCompiled({ annotations: [], tiles: JSON.parse(e.data) }, previewLinting);
+   });
+   preview.addEventListener('lint', function(e) {
+       showCompiled({ annotations: JSON.parse(e.data) }, previewLinting);
+   });
+}
+
+// Very large graphs come back as tiles: the viewer only loads the ones in view as <img>
+// elements, one zoom level at a time, so the page never holds the whole SVG.
+var tileView = null;
+// Layouts already laid out anew once after their tiles failed to load.
+var tileRetried = {};
+
+function showTiles(info) {
+   if (tileView && tileView.info.id === info.id) return;
+   var container = document.getElementById('graph-container');
+   var zoom = tileView ? Math.min(tileView.zoom, info.max_zoom) : 0;
+   container.innerHTML = '<div id="tile-layer" style="position:relative; background:#fff"></div>';
+   tileView = { info: info, zoom: zoom, tiles: {}, failed: false };
+   layoutTiles();
+}
+
+function layoutTiles() {
+   var info = tileView.info;
+   var scale = info.tile_size * Math.pow(2, tileView.zoom) / info.extent;
+   var layer = document.getElementById('tile-layer');
+   layer.innerHTML = '';
+   tileView.tiles = {};
+   layer.style.width = Math.ceil(info.width * scale) + 'px';
+   layer.style.height = Math.ceil(info.height * scale) + 'px';
+   updateTiles();
+}
+
+function updateTiles() {
+   if (!tileView) return;
+   var container = document.getElementById('graph-container');
+   var layer = document.getElementById('tile-layer');
+   var info = tileView.info, size = info.tile_size, count = Math.pow(2, tileView.zoom);
+   var first = function(offset) { return Math.max(Math.floor(offset / size), 0); };
+   var last = function(offset, length) { return Math.min(Math.floor((offset + length) / size), count - 1); };
+   var wanted = {};
+   for (var x = first(container.scrollLeft); x <= last(container.scrollLeft, container.clientWidth); x++) {
+       for (var y = first(container.scrollTop); y <= last(container.scrollTop, container.clientHeight); y++) {
+           var key = tileView.zoom + '/' + x + '/' + y;
+           wanted[key] = true;
+           if (tileView.tiles[key]) continue;
+           var img = document.createElement('img');
+           img.src = '/tiles/' + info.id + '/' + key + '.svg';
+           img.style.cssText = 'position:absolute; left:' + (x * size) + 'px; top:' + (y * size) +
+                               'px; width:' + size + 'px; height:' + size + 'px';
+           img.onerror = function() {
+               // The server forgot this layout; lint again to have it laid out anew, but only
+               // once, in case the tiles are being asked of a server that never had them.
+               if (!tileView.failed && !tileRetried[tileView.info.id]) {
+                   tileRetried[tileView.info.id] = true;
+                   tileView.failed = true;
+                   tileView.info.id = null;
+                   editor.performLint();
                }
-           });
-
-           // Custom linter: sends code to /lint and updates the lint gutter.
-           function customLinter(text, updateLinting, options, cm) {
-              fetch('/lint', {
-                  method: 'POST',
-                  headers: {'Content-Type': 'application/json'},
-                  body: JSON.stringify({ code: text })
-              })
-              .then(response => response.json())
-              .then(data => {
-                  updateLinting(data.annotations);
-                  if (data.annotations.length > 0) {
-                      document.getElementById('graph-container').innerHTML =
-                         "<div style='color:red; font-size:18px; text-align:center; margin-top:20px;'>syntax error</div>";
-                  } else {
-                      renderGraph();
-                  }
-              })
-              .catch(error => {
-                  console.error('Error linting code:', error);
-                  updateLinting([]);
-                  renderGraph();
-              });
-              return [];
-           }
+           };
+           layer.appendChild(img);
+           tileView.tiles[key] = img;
+       }
+   }
+   for (var key in tileView.tiles) {
+       if (!wanted[key]) {
+           tileView.tiles[key].remove();
+           delete tileView.tiles[key];
+       }
+   }
+}
 
-           // Initialize CodeMirror in the left pane with linting and our custom "dot" mode.
-           var editor = CodeMirror(document.getElementById('editor-pane'), {
-              value: {{ saved_code|tojson }},
-              mode: "dot",
-              theme: "dracula",
-              lineNumbers: true,
-              gutters: ["CodeMirror-lint-markers", "CodeMirror-linenumbers"],
-              lint: {
-                 getAnnotations: customLinter,
-                 async: true
-              }
-           });
-
-           // Auto-save: send the current code to /save (debounced).
-           var autoSave = debounce(function() {
-              var code = editor.getValue();
-              fetch('/save', {
-                  method: 'POST',
-                  headers: {'Content-Type': 'application/json'},
-                  body: JSON.stringify({ code: code })
-              }).catch(err => console.error('Auto-save failed:', err));
-           }, 1000);
-
-           // Trigger auto-save on every change.
-           editor.on("change", function() {
-              autoSave();
-           });
-
-           // Render the graph by sending code to the /render endpoint.
-           function renderGraph() {
-              var code = editor.getValue();
-              fetch('/render', {
-                  method: 'POST',
-                  headers: {'Content-Type': 'application/json'},
-                  body: JSON.stringify({ code: code })
-              })
-              .then(response => response.json())
-              .then(data => {
-                  document.getElementById('graph-container').innerHTML = data.svg;
-              })
-              .catch(error => {
-                  console.error('Error rendering graph:', error);
-              });
+// Ctrl + mouse wheel zooms the tiles in and out around the pointer.
+document.getElementById('graph-container').addEventListener('wheel', function(e) {
+   if (!tileView || !e.ctrlKey) return;
+   e.preventDefault();
+   var zoom = Math.max(0, Math.min(tileView.info.max_zoom, tileView.zoom + (e.deltaY < 0 ? 1 : -1)));
+   if (zoom === tileView.zoom) return;
+   var factor = Math.pow(2, zoom - tileView.zoom);
+   var rect = this.getBoundingClientRect();
+   var px = e.clientX - rect.left, py = e.clientY - rect.top;
+   var left = (this.scrollLeft + px) * factor - px, top = (this.scrollTop + py) * factor - py;
+   tileView.zoom = zoom;
+   layoutTiles();
+   this.scrollLeft = left;
+   this.scrollTop = top;
+   updateTiles();
+}, { passive: false });
+document.getElementById('graph-container').addEventListener('scroll', updateTiles);
+
+// Initialize CodeMirror in the left pane with linting and our custom "dot" mode.
+var editor = CodeMirror(document.getElementById('editor-pane'), {
+   value: savedCode,
+   mode: "dot",
+   theme: "dracula",
+   lineNumbers: true,
+   gutters: ["CodeMirror-lint-markers", "CodeMirror-linenumbers"],
+   lint: {
+      getAnnotations: customLinter,
+      async: true
+   }
+});
+
+// Edits not saved yet, as {start, end, text} replacements in the order they were made.
+var pendingChanges = [];
+var saving = false;
+
+function saveRequest(changes) {
+   // Send the changes, unless the whole text is smaller than they are (after a paste or
+   // loading an SVG, say).
+   var code = editor.getValue();
+   if (JSON.stringify(changes).length > code.length) {
+       return { doc: docId, code: code };
+   }
+   return { doc: docId, base: savedRevision, changes: changes };
+}
+
+// Auto-save: send the changes since the last save to /save (debounced). If the server's
+// copy has moved on, resend the whole text.
+function saveChanges() {
+   if (saving || pendingChanges.length === 0) return;
+   saving = true;
+   var changes = pendingChanges.splice(0, pendingChanges.length);
+   var post = function(body) {
+       return fetch('/save', {
+           method: 'POST',
+           headers: {'Content-Type': 'application/json'},
+           body: JSON.stringify(body)
+       });
+   };
+   var resync = function() {
+       // The whole text covers the changes made since, too.
+       pendingChanges = [];
+       return post({ doc: docId, code: editor.getValue() });
+   };
+   post(saveRequest(changes))
+   .then(response => response.status === 409 ? resync() : response)
+   .then(response => {
+       if (!response.ok) throw new Error('status ' + response.status);
+       return response.json();
+   })
+   .then(data => {
+       savedRevision = data.revision;
+       saving = false;
+       saveChanges();
+   })
+   .catch(err => {
+       // Retry with the next edit. If the server did save something, the old base
+       // revision makes that attempt resync.
+       console.error('Auto-save failed:', err);
+       pendingChanges = changes.concat(pendingChanges);
+       saving = false;
+   });
+}
+var autoSave = debounce(saveChanges, 1000);
+
+// Switch the layout engine, remember it with the document and redraw.
+document.getElementById('engine-select').addEventListener('change', function() {
+   engine = this.value;
+   fetch('/documents/' + encodeURIComponent(docId), {
+       method: 'PATCH',
+       headers: {'Content-Type': 'application/json'},
+       body: JSON.stringify({ engine: engine })
+   }).catch(err => console.error('Saving the engine failed:', err));
+   editor.performLint();
+});
+
+// Switch documents by reloading the page with the chosen one. The unload handler
+// below saves the one being left.
+document.getElementById('document-select').addEventListener('change', function() {
+   window.location.search = '?doc=' + encodeURIComponent(this.value);
+});
+
+// Create a new document and open it.
+document.getElementById('new-document').addEventListener('click', function() {
+   var name = prompt('Document name', 'Untitled');
+   if (!name) {
+       return;
+   }
+   fetch('/documents', {
+       method: 'POST',
+       headers: {'Content-Type': 'application/json'},
+       body: JSON.stringify({ name: name })
+   })
+   .then(response => response.json())
+   .then(data => { window.location.search = '?doc=' + encodeURIComponent(data.id); })
+   .catch(err => console.error('Creating a document failed:', err));
+});
+
+// Record every change as a replacement of a range of the text, for auto-save and the
+// live preview, then trigger auto-save.
+editor.on("change", function(cm, change) {
+   var start = cm.indexFromPos(change.from);
+   var replacement = {
+       start: start,
+       end: start + change.removed.join('\n').length,
+       text: change.text.join('\n')
+   };
+   pendingChanges.push(replacement);
+   if (preview) previewChanges.push(replacement);
+   autoSave();
+});
+
+// Render the graph by sending code to the /render endpoint.
+function renderGraph() {
+   var code = editor.getValue();
+   fetch('/render', {
+       method: 'POST',
+       headers: {'Content-Type': 'application/json'},
+       body: JSON.stringify({ code: code, session: sessionId, revision: revision, engine: engine })
+   })
+   .then(response => response.json())
+   .then(data => {
+       if (data.status === 'superseded') return;
+       tileView = null;
+       document.getElementById('graph-container').innerHTML = data.svg;
+   })
+   .catch(error => {
+       console.error('Error rendering graph:', error);
+   });
+}
+
+// Download SVG file.
+document.getElementById('download-svg').addEventListener('click', function() {
+   var code = editor.getValue();
+   fetch('/download-svg', {
+       method: 'POST',
+       headers: {'Content-Type': 'application/json'},
+       body: JSON.stringify({ code: code, engine: engine })
+   })
+   .then(response => response.blob())
+   .then(blob => {
+       var url = window.URL.createObjectURL(blob);
+       var a = document.createElement('a');
+       a.href = url;
+       a.download = 'graph.svg';
+       document.body.appendChild(a);
+       a.click();
+       a.remove();
+       window.URL.revokeObjectURL(url);
+   })
+   .catch(error => {
+       console.error('Error downloading SVG:', error);
+   });
+});
+
+// Download PNG file.
+document.getElementById('download-png').addEventListener('click', function() {
+   var code = editor.getValue();
+   fetch('/download-png', {
+       method: 'POST',
+       headers: {'Content-Type': 'application/json'},
+       body: JSON.stringify({ code: code, engine: engine })
+   })
+   .then(response => response.blob())
+   .then(blob => {
+       var url = window.URL.createObjectURL(blob);
+       var a = document.createElement('a');
+       a.href = url;
+       a.download = 'graph.png';
+       document.body.appendChild(a);
+       a.click();
+       a.remove();
+       window.URL.revokeObjectURL(url);
+   })
+   .catch(error => {
+       console.error('Error downloading PNG:', error);
+   });
+});
+
+// Load SVG: when the user clicks "Load SVG", trigger the file input.
+document.getElementById('load-svg').addEventListener('click', function() {
+   document.getElementById('load-svg-input').click();
+});
+
+// Ask the server for the DOT source embedded in an SVG file. Exports have it right after
+// the <svg> tag, so the first megabyte is usually enough; otherwise send as much as the
+// server takes (EXTRACT_MAX_UPLOAD).
+function extractDot(file) {
+   var head = 1024 * 1024, most = 64 * 1024 * 1024;
+   var post = function(body) {
+       return fetch('/extract', {
+           method: 'POST',
+           headers: {'Content-Type': 'image/svg+xml'},
+           body: body
+       });
+   };
+   return post(file.slice(0, head))
+   .then(response => response.json())
+   .then(data => data.code || file.size <= head ? data : post(file.slice(0, most)).then(response => response.json()));
+}
+
+// When an SVG file is selected, load the DOT source embedded in it.
+document.getElementById('load-svg-input').addEventListener('change', function(e) {
+   var file = e.target.files[0];
+   if (!file) return;
+   extractDot(file)
+   .then(data => {
+       if (data.error) throw new Error(data.error);
+       if (!data.code) {
+           alert("No embedded Graphviz DOT code found in this SVG file.");
+           return;
+       }
+       var dotCode = data.code;
+       // Validate the code by sending it to /lint.
+       return fetch('/lint', {
+           method: 'POST',
+           headers: {'Content-Type': 'application/json'},
+           body: JSON.stringify({ code: dotCode })
+       })
+       .then(response => response.json())
+       .then(data => {
+           if (data.annotations && data.annotations.length > 0) {
+               alert("The embedded DOT code in the SVG has syntax errors and will not be loaded.");
+           } else {
+               // Load the valid DOT code into the editor.
+               editor.setValue(dotCode);
+               editor.performLint();
            }
+       });
+   })
+   .catch(err => {
+       console.error("Error loading the DOT code from the SVG:", err);
+       alert("Error loading the DOT code from the SVG.");
+   });
+   // Let the same file be picked again.
+   this.value = '';
+});
 
-           // Download SVG file.
-           document.getElementById('download-svg').addEventListener('click', function() {
-              var code = editor.getValue();
-              fetch('/download-svg', {
-                  method: 'POST',
-                  headers: {'Content-Type': 'application/json'},
-                  body: JSON.stringify({ code: code })
-              })
-              .then(response => response.blob())
-              .then(blob => {
-                  var url = window.URL.createObjectURL(blob);
-                  var a = document.createElement('a');
-                  a.href = url;
-                  a.download = 'graph.svg';
-                  document.body.appendChild(a);
-                  a.click();
-                  a.remove();
-                  window.URL.revokeObjectURL(url);
-              })
-              .catch(error => {
-                  console.error('Error downloading SVG:', error);
-              });
-           });
-
-           // Download PNG file.
-           document.getElementById('download-png').addEventListener('click', function() {
-              var code = editor.getValue();
-              fetch('/download-png', {
-                  method: 'POST',
-                  headers: {'Content-Type': 'application/json'},
-                  body: JSON.stringify({ code: code })
-              })
-              .then(response => response.blob())
-              .then(blob => {
-                  var url = window.URL.createObjectURL(blob);
-                  var a = document.createElement('a');
-                  a.href = url;
-                  a.download = 'graph.png';
-                  document.body.appendChild(a);
-                  a.click();
-                  a.remove();
-                  window.URL.revokeObjectURL(url);
-              })
-              .catch(error => {
-                  console.error('Error downloading PNG:', error);
-              });
-           });
-
-           // Load SVG: when the user clicks "Load SVG", trigger the file input.
-           document.getElementById('load-svg').addEventListener('click', function() {
-              document.getElementById('load-svg-input').click();
-           });
-
-           // When an SVG file is selected, read and parse it.
-           document.getElementById('load-svg-input').addEventListener('change', function(e) {
-              var file = e.target.files[0];
-              if (!file) return;
-              var reader = new FileReader();
-              reader.onload = function(e) {
-                  var svgText = e.target.result;
-                  // Parse the SVG text to a DOM object.
-                  var parser = new DOMParser();
-                  var xmlDoc = parser.parseFromString(svgText, "image/svg+xml");
-                  // Look for our embedded dot code.
-                  var metadataElem = xmlDoc.getElementById("graphviz-dot");
-                  if (metadataElem) {
-                      var dotCode = metadataElem.textContent;
-                      // Validate the code by sending it to /lint.
-                      fetch('/lint', {
-                          method: 'POST',
-                          headers: {'Content-Type': 'application/json'},
-                          body: JSON.stringify({ code: dotCode })
-                      })
-                      .then(response => response.json())
-                      .then(data => {
-                          if (data.annotations && data.annotations.length > 0) {
-                              alert("The embedded DOT code in the SVG has syntax errors and will not be loaded.");
-                          } else {
-                              // Load the valid DOT code into the editor.
-                              editor.setValue(dotCode);
-                              editor.performLint();
-                          }
-                      })
-                      .catch(err => {
-                          console.error("Error validating the loaded DOT code:", err);
-                          alert("Error validating the loaded DOT code.");
-                      });
-                  } else {
-                      alert("No embedded Graphviz DOT code found in this SVG file.");
-                  }
-              };
-              reader.readAsText(file);
-           });
-
-           // Also attempt a final save on unload.
-           window.addEventListener('unload', function() {
-               var code = editor.getValue();
-               if (navigator.sendBeacon) {
-                   var blob = new Blob([JSON.stringify({ code: code })], { type: 'application/json' });
-                   navigator.sendBeacon('/save', blob);
-               } else {
-                   var xhr = new XMLHttpRequest();
-                   xhr.open("POST", "/save", false);
-                   xhr.setRequestHeader("Content-Type", "application/json");
-                   xhr.send(JSON.stringify({ code: code }));
-               }
-           });
-
-           // Initialize Split.js to allow resizing between the editor and viewer panes.
-           Split(['#editor-pane', '#viewer-pane'], {
-              sizes: [50, 50],
-              minSize: 200,
-              gutterSize: 8,
-              cursor: 'col-resize'
-           });
-
-           // Trigger an initial lint to render the graph.
-           setTimeout(function(){ editor.performLint(); }, 100);
-       </script>
-    </body>
-    </html>
-    ''', saved_code=saved_code)
+// Also attempt a final save on unload. There is no reply to resync with, so the whole text
+// goes along and the server falls back to it if the changes don't apply. While a save is
+// still in flight the pending changes aren't based on savedRevision yet, so only the text goes.
+window.addEventListener('unload', function() {
+    if (pendingChanges.length === 0 && !saving) return;
+    var body = saving ? { doc: docId } : saveRequest(pendingChanges);
+    body.code = editor.getValue();
+    if (navigator.sendBeacon) {
+        var blob = new Blob([JSON.stringify(body)], { type: 'application/json' });
+        navigator.sendBeacon('/save', blob);
+    } else {
+        var xhr = new XMLHttpRequest();
+        xhr.open("POST", "/save", false);
+        xhr.setRequestHeader("Content-Type", "application/json");
+        xhr.send(JSON.stringify(body));
+    }
+});
+
+// Drag the divider between the editor and viewer panes to resize them. Neither gets narrower
+// than 200 pixels.
+document.getElementById('pane-divider').addEventListener('mousedown', function(e) {
+   e.preventDefault();
+   var divider = this;
+   var pane = document.getElementById('editor-pane');
+   var container = pane.parentNode.getBoundingClientRect();
+   var move = function(e) {
+       var width = Math.max(200, Math.min(e.clientX - container.left, container.width - divider.offsetWidth - 200));
+       pane.style.width = (width / container.width * 100) + '%';
+       editor.refresh();
+   };
+   var stop = function() {
+       document.removeEventListener('mousemove', move);
+       document.removeEventListener('mouseup', stop);
+   };
+   document.addEventListener('mousemove', move);
+   document.addEventListener('mouseup', stop);
+});
+
+// Trigger an initial lint to render the graph.
+setTimeout(function(){ editor.performLint(); }, 100);
+'''
+
+PAGE_ASSETS = {
+    'techlines.css': (VENDOR_STYLES, PAGE_CSS, 'text/css; charset=utf-8'),
+    'techlines.js': (VENDOR_SCRIPTS, PAGE_JS, 'application/javascript; charset=utf-8'),
+}
+
+@lru_cache(maxsize=None)
+def page_template():
+    """
+    The editor page template, compiled on first use instead of on every page load.
+    """
+    return app.jinja_env.from_string(PAGE_TEMPLATE)
+
+@lru_cache(maxsize=None)
+def vendored_version():
+    """
+    The version of the vendored CodeMirror, as its lib/codemirror.js declares it.
+    """
+    with open(os.path.join(VENDOR_DIR, 'codemirror/lib/codemirror.js'), encoding='utf-8') as f:
+        return VENDOR_VERSION_RE.search(f.read()).group(1)
+
+@lru_cache(maxsize=None)
+def static_asset(name):
+    """
+    Builds one of PAGE_ASSETS from the vendored files and the page's own code, minified if rjsmin
+    and rcssmin are installed, and named after a hash of the result. The gzip and brotli copies
+    are made here once, at the highest compression levels.
+    Returns (file name, {content encoding: bytes}, mimetype), with the plain bytes under None.
+    """
+    vendored, own, mimetype = PAGE_ASSETS[name]
+    sources = []
+    for path in vendored:
+        with open(os.path.join(VENDOR_DIR, path), encoding='utf-8') as f:
+            sources.append(f.read())
+    sources.append(own)
+    minifier = rcssmin.cssmin if name.endswith('.css') and rcssmin else \
+        rjsmin.jsmin if name.endswith('.js') and rjsmin else None
+    if minifier is not None:
+        sources = [minifier(source) for source in sources]
+    notice = VENDOR_NOTICE.format(version=vendored_version())
+    data = '\n'.join([f'/* {notice} */'] + sources).encode('utf-8')
+    variants = {None: data, 'gzip': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    stem, extension = os.path.splitext(name)
+    return f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}', variants, mimetype
+
+def asset_url(name):
+    return '/assets/' + static_asset(name)[0]
+
+@app.route('/')
+def index():
+    # New visitors get their own workspace, remembered in a cookie.
+    user = request.cookies.get(WORKSPACE_USER_COOKIE)
+    new_user = not WorkspaceStore.valid_id(user)
+    if new_user:
+        user = secrets.token_urlsafe(12)
+    doc_id = request.args.get('doc')
+    try:
+        saved_code, saved_revision = workspace.load(user, doc_id)
+    except KeyError:
+        doc_id = default_document(user)
+        saved_code, saved_revision = workspace.load(user, doc_id)
+    # Pass the saved code and the list of documents into the template.
+    documents = workspace.list_documents(user)
+    response = make_response(page_template().render(
+        saved_code=saved_code, saved_revision=saved_revision, doc_id=doc_id, documents=documents,
+        engine=next((d['engine'] for d in documents if d['id'] == doc_id), 'dot'), engines=ENGINES + ('auto',),
+        live_preview=LIVE_PREVIEW, assets={name: asset_url(name) for name in PAGE_ASSETS},
+        inline_css=static_asset('techlines.css')[1][None].decode('utf-8') if INLINE_CSS else None))
+    # The page holds the user's code, so browsers may keep it but have to check it is still current.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    response.make_conditional(request)
+    if new_user:
+        response.set_cookie(WORKSPACE_USER_COOKIE, user, max_age=10 * 365 * 24 * 3600, samesite='Lax')
+    return response
+
+@app.route('/assets/<filename>')
+def page_asset(filename):
+    """
+    Serves the page's script and stylesheet, compressed ahead of time. Their file names carry a
+    hash of the content, so a response never goes stale and can be cached for good.
+    """
+    for name in PAGE_ASSETS:
+        fingerprinted, variants, mimetype = static_asset(name)
+        if fingerprinted == filename:
+            encoding = accepted_encoding()
+            etag = f'{fingerprinted}-{encoding}' if encoding else fingerprinted
+            if etag_matches(etag):
+                return not_modified(etag)
+            response = make_response(variants[encoding])
+            response.headers['Content-Type'] = mimetype
+            response.headers['Vary'] = 'Accept-Encoding'
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+            return response
+    return jsonify({'error': 'Unknown asset'}), 404
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """
+    Records the latency and status of every request and, with SERVER_TIMING on, tells the browser
+    how long each phase of it took.
+    """
+    elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+    labels = {'route': request.endpoint or 'unknown'}
+    if 'engine' in g:
+        labels['engine'] = g.engine
+    metrics.observe('techlines_request_seconds', elapsed, **labels)
+    metrics.inc('techlines_requests_total', route=labels['route'], status=response.status_code)
+    if SERVER_TIMING:
+        totals = OrderedDict()
+        for phase, seconds in g.get('timings', ()):
+            totals[phase] = totals.get(phase, 0) + seconds
+        totals['total'] = elapsed
+        response.headers['Server-Timing'] = ', '.join(f'{phase};dur={seconds * 1000:.1f}'
+                                                      for phase, seconds in totals.items())
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Request and render metrics in the Prometheus text format, along with the current state of
+    the worker pool and render cache.
+    """
+    gauges = [
+        ('techlines_pool_busy_workers', dot_pool.busy, {}),
+        ('techlines_pool_idle_workers', len(dot_pool._idle), {}),
+        ('techlines_pool_queued_jobs', dot_pool.waiting, {}),
+        ('techlines_render_cache_bytes', render_cache.size, {}),
+        ('techlines_render_cache_hits', render_cache.hits, {}),
+        ('techlines_render_cache_misses', render_cache.misses, {}),
+    ]
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/healthz')
+def healthz():
+    """
+    Readiness probe: 200 once the startup probe has rendered a graph with Graphviz, 503 while it
+    is still running or if Graphviz is missing or broken.
+    """
+    status = dict(graphviz_status)
+    return jsonify(status), 200 if status['status'] == 'ok' else 503
+
+@app.errorhandler(PoolBusyError)
+def pool_busy(error):
+    response = make_response(str(error), 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.errorhandler(UnknownEngine)
+def unknown_engine(error):
+    return jsonify({'error': str(error)}), 400
+
+@app.errorhandler(RenderCancelled)
+def render_cancelled(error):
+    # Only the newest revision is shown, so the browser just drops this reply.
+    return jsonify({'status': 'superseded'})
 
 @app.route('/render', methods=['POST'])
 def render_graph():
+    """
+    Renders the graph for the preview. Returns JSON by default, or the SVG itself (with an ETag and
+    compression) to clients that ask for image/svg+xml.
+    """
     data = request.get_json()
     code = data.get('code', '')
+    engine = requested_engine(data)
+    raw = request.accept_mimetypes.best_match(['application/json', 'image/svg+xml']) == 'image/svg+xml'
     try:
-        src = graphviz.Source(code, engine='dot')
-        svg_data = src.pipe(format='svg').decode('utf-8')
+        with span('parse'):
+            graphs = parse_dot(code)
+        # Incremental previews depend on the session's history, not just the code, so they get no ETag.
+        etag = None
+        if raw and incremental_outline(code, graphs, data.get('session')) is None:
+            etag = response_etag(code, engine, 'svg')
+            if etag_matches(etag):
+                return not_modified(etag)
+        with editor_revision(data) as cancel:
+            svg_data = render_preview(code, graphs, data.get('session'), cancel, engine)
         # Fix any relative URLs in the SVG.
-        svg_data = fix_svg_urls(svg_data)
-        return jsonify({'svg': svg_data})
-    except Exception as e:
+        with span('postprocess'):
+            svg_data = fix_svg_urls(svg_data)
+        with span('serialize'):
+            if raw:
+                return image_response(svg_data, 'image/svg+xml', etag)
+            return jsonify({'svg': svg_data.decode('utf-8')})
+    except (PoolBusyError, RenderCancelled):
+        raise
+    except Exception:
         error_svg = ("<svg xmlns='http://www.w3.org/2000/svg' width='400' height='50'>"
                      "<text x='10' y='25' fill='red'>Error: syntax error</text></svg>")
+        if raw:
+            return error_svg, 400, {'Content-Type': 'image/svg+xml'}
         return jsonify({'svg': error_svg})
 
 @app.route('/lint', methods=['POST'])
 def lint_code():
     """
-    Attempts to render the Graphviz code. If an error occurs, returns an annotation with a line number (if available).
+    Checks the syntax of the Graphviz code, then attempts to render it to catch any other errors.
+    If an error occurs, returns an annotation pointing at where it happened.
     """
     data = request.get_json()
     code = data.get('code', '')
+    engine, args = layout_engine(requested_engine(data), code, preview=True)
     try:
-        src = graphviz.Source(code, engine='dot')
-        src.pipe(format='svg')
+        # Syntax errors are caught in Python without running Graphviz at all.
+        with span('parse'):
+            parse_dot(code)
+        # The SVG is cached, so a /render of the same code right after this is free.
+        with editor_revision(data) as cancel:
+            render(code, engine, 'svg', cancel, args)
         return jsonify({'annotations': []})
+    except (PoolBusyError, RenderCancelled):
+        raise
+    except Exception as e:
+        count_lint_error(e)
+        return jsonify({'annotations': [error_annotation(e)]})
+
+def compile_preview(code, engine='dot', session=None, cancel=None, tiles=False):
+    """
+    Lints and renders code for the editor preview with a single Graphviz run. Returns the lint
+    annotations and, when there are none, the finished SVG, or with tiles set the tile set of a
+    very large graph instead. A busy pool or a cancelled render raise; other errors become annotations.
+    """
+    try:
+        with span('parse'):
+            graphs = parse_dot(code)
+        # Editors that can show tiles get them for very large graphs instead of one huge SVG.
+        if tiles and TILED_PREVIEW and estimate_graph_cost(code) > TILED_PREVIEW_MIN_COST:
+            try:
+                tile_id, layout = tile_set(code, engine, cancel)
+                return {'annotations': [], 'svg': None, 'tiles': dict(layout.info(), id=tile_id)}
+            except ValueError:
+                pass
+        svg_data = render_preview(code, graphs, session, cancel, engine)
+    except (PoolBusyError, RenderCancelled):
+        raise
+    except Exception as e:
+        count_lint_error(e)
+        return {'annotations': [error_annotation(e)], 'svg': None}
+    with span('postprocess'):
+        return {'annotations': [], 'svg': fix_svg_urls(svg_data).decode('utf-8')}
+
+@app.route('/compile', methods=['POST'])
+def compile_code():
+    """
+    Lints and renders the code with a single Graphviz run.
+    Returns the lint annotations and, when there are none, the finished SVG.
+    """
+    data = request.get_json()
+    engine = requested_engine(data)
+    with editor_revision(data) as cancel:
+        result = compile_preview(data.get('code', ''), engine, data.get('session'), cancel, data.get('tiles'))
+    with span('serialize'):
+        return jsonify(result)
+
+@app.route('/preview', methods=['POST'])
+def preview_edit():
+    """
+    Sends edits to the live preview of a document, either as {'base', 'changes'} like /save or as
+    the whole text in 'code'. Replies with the preview's new revision straight away; the rendered
+    result is pushed to /events. A 409 means the preview isn't at base, and the client resends
+    the whole text.
+    """
+    if not LIVE_PREVIEW:
+        return jsonify({'error': 'Live preview is off'}), 404
+    data = request.get_json()
+    doc_id = data.get('doc')
+    if not WorkspaceStore.valid_id(doc_id):
+        return jsonify({'error': 'Unknown document'}), 404
+    engine = requested_engine(data)
+    channel = preview_channels.get(workspace_user(), doc_id)
+    try:
+        revision = channel.edit(data.get('base'), data.get('changes'), data.get('code'), engine)
+    except StaleRevision as e:
+        return jsonify({'status': 'resync', 'revision': e.revision}), 409
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'revision': revision})
+
+def preview_event(result):
+    """
+    Encodes a live preview result as a server-sent event: 'svg' with the SVG itself as the data,
+    'tiles' with the tile set info or 'lint' with the annotations, both as JSON.
+    """
+    if result['annotations']:
+        name, data = 'lint', json.dumps(result['annotations'])
+    elif result.get('tiles'):
+        name, data = 'tiles', json.dumps(result['tiles'])
+    else:
+        name, data = 'svg', result['svg']
+    lines = ''.join(f'data: {line}\n' for line in data.splitlines())
+    return f'event: {name}\n{lines}\n'.encode('utf-8')
+
+@app.route('/events', methods=['GET'])
+def preview_events():
+    """
+    Streams the live preview of a document (?doc=<id>) as server-sent events. A new stream starts
+    with the latest result, then gets every newer one, whichever tab sent the edits.
+    """
+    if not LIVE_PREVIEW:
+        return jsonify({'error': 'Live preview is off'}), 404
+    doc_id = request.args.get('doc')
+    if not WorkspaceStore.valid_id(doc_id):
+        return jsonify({'error': 'Unknown document'}), 404
+    user = workspace_user()
+
+    def stream():
+        with preview_channels.subscribe(user, doc_id) as channel:
+            seen = 0
+            yield b'retry: 1000\n\n'
+            while True:
+                result = channel.next_result(seen, PREVIEW_KEEPALIVE)
+                if result is None:
+                    yield b': keepalive\n\n'
+                    continue
+                seen = result['revision']
+                yield preview_event(result)
+
+    response = app.response_class(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies from holding events back.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/tiles', methods=['POST'])
+def create_tiles():
+    """
+    Lays out the graph for tiled viewing and returns the tile id, the size of the graph and the
+    deepest zoom level, for fetching tiles from /tiles/<id>/<zoom>/<x>/<y>.svg (or .png).
+    """
+    data = request.get_json()
+    code = data.get('code', '')
+    engine = requested_engine(data)
+    try:
+        parse_dot(code)
+        tile_id, tiles = tile_set(code, engine)
+    except (PoolBusyError, RenderCancelled):
+        raise
     except Exception as e:
-        message = str(e)
-        match = re.search(r'line\s+(\d+)', message, re.IGNORECASE)
-        line = int(match.group(1)) - 1 if match else 0
-        annotation = {
-            'from': {'line': line, 'ch': 0},
-            'to': {'line': line, 'ch': 0},
-            'message': "Syntax error",
+        return jsonify({'error': str(e)}), 400
+    return jsonify(dict(tiles.info(), id=tile_id))
+
+@app.route('/tiles/<tile_id>/<int:z>/<int:x>/<int:y>.<fmt>', methods=['GET'])
+def get_tile(tile_id, z, x, y, fmt):
+    """
+    Returns one tile. Tile ids are content hashes, so a tile never changes and can be cached for
+    good. A 404 means the layout was forgotten; POST the code to /tiles again.
+    """
+    tiles = tile_store.get(tile_id)
+    if tiles is None or fmt not in ('svg', 'png'):
+        return jsonify({'error': 'Unknown tile'}), 404
+    etag = f'{tile_id}-{z}-{x}-{y}-{RESPONSE_VERSION}.{fmt}'
+    if fmt == 'svg' and accepted_encoding():
+        etag = f'{etag}-{accepted_encoding()}'
+    if etag_matches(etag):
+        return not_modified(etag)
+    try:
+        if fmt == 'svg':
+            response = image_response(tiles.tile_svg(z, x, y), 'image/svg+xml', etag)
+        else:
+            response = image_response(tiles.tile_png(z, x, y), 'image/png', etag)
+    except KeyError:
+        return jsonify({'error': 'No such tile'}), 404
+    except PoolBusyError:
+        raise
+    except RenderError as e:
+        return str(e), 500
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+def count_lint_error(error):
+    """
+    Counts code that failed to lint, by whether the parser or Graphviz rejected it.
+    """
+    kind = 'syntax' if isinstance(error, DotSyntaxError) else 'graphviz'
+    route = request.endpoint if has_request_context() else 'preview_events'
+    metrics.inc('techlines_lint_errors_total', route=route, kind=kind)
+
+def error_annotation(error):
+    """
+    Builds a CodeMirror lint annotation from a DotSyntaxError, or from a Graphviz error pointing at
+    its line number (if available).
+    """
+    if isinstance(error, DotSyntaxError):
+        return {
+            'from': {'line': error.line, 'ch': error.col},
+            'to': {'line': error.end_line, 'ch': error.end_col},
+            'message': error.message,
             'severity': "error"
         }
-        return jsonify({'annotations': [annotation]})
+    message = str(error)
+    match = re.search(r'line\s+(\d+)', message, re.IGNORECASE)
+    line = int(match.group(1)) - 1 if match else 0
+    # Graphviz prefixes its messages with "Error: <stdin>: ", which says nothing to the user.
+    errors = re.findall(r'^Error:\s*(?:<stdin>:\s*)?(.+)$', message, re.MULTILINE)
+    return {
+        'from': {'line': line, 'ch': 0},
+        'to': {'line': line, 'ch': 0},
+        'message': "\n".join(errors) or (message if isinstance(error, GraphTooLarge) else "Syntax error"),
+        'severity': "error"
+    }
+
+SVG_REWRITE_CHUNK = 65536
+# A bare URL at the start of an (xlink:)href attribute value.
+SVG_BARE_HREF_RE = re.compile(rb'href="(?!https?://)(?=[^"])')
+# An <a ...> tag without a target attribute.
+SVG_UNTARGETED_LINK_RE = re.compile(rb'<a\b(?![^>]*target=)([^>]*)>')
+
+def rewrite_svg_links(svg):
+    """
+    The rewrite behind fix_svg_urls. Both substitutions are plain templates, so the regex engine
+    does all the work in C without calling back into Python for every link.
+    """
+    svg = SVG_BARE_HREF_RE.sub(b'href="http://', svg)
+    return SVG_UNTARGETED_LINK_RE.sub(rb'<a\1 target="_blank">', svg)
 
-# Add target="_blank" to all <a ...> tags if not already present.
-def add_target(match):
-    tag = match.group(0)
-    if 'target=' in tag:
-        return tag
-    # Insert target="_blank" before the closing '>'.
-    return tag[:-1] + ' target="_blank">'
+class SvgLinkRewriter:
+    """
+    Does the work of fix_svg_urls on SVG bytes arriving in chunks, e.g. from a pipe.
+    feed() returns the rewritten output for everything up to the last complete tag and holds on to
+    the rest until the next chunk, and close() returns whatever is left.
+    """
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, chunk):
+        data = self._pending + chunk if self._pending else chunk
+        cut = data.rfind(b'<')
+        if cut != -1 and data.find(b'>', cut) == -1:
+            data, self._pending = data[:cut], data[cut:]
+        else:
+            self._pending = b''
+        return rewrite_svg_links(data)
 
-def fix_svg_urls(svg_text):
+    def close(self):
+        data, self._pending = self._pending, b''
+        return rewrite_svg_links(data)
+
+def fix_svg_urls(svg):
     """
     1. Converts any bare URL (in xlink:href or href) that does not start with "http://" or "https://"
        by prepending "http://".
     2. Adds target="_blank" to all <a> tags so that links open in a new window.
+    Takes and returns either bytes or str. Big documents are rewritten in cache-sized chunks,
+    which is measurably faster than running over the whole thing at once (see bench.py).
+    """
+    if isinstance(svg, str):
+        return fix_svg_urls(svg.encode('utf-8')).decode('utf-8')
+    if len(svg) <= SVG_REWRITE_CHUNK:
+        return rewrite_svg_links(svg)
+    rewriter = SvgLinkRewriter()
+    pieces = [rewriter.feed(svg[i:i + SVG_REWRITE_CHUNK]) for i in range(0, len(svg), SVG_REWRITE_CHUNK)]
+    pieces.append(rewriter.close())
+    return b''.join(pieces)
+
+def accepted_encoding():
+    """
+    Picks the compression for a response: brotli if it's installed and the client takes it, else gzip.
+    """
+    encodings = request.accept_encodings
+    if brotli is not None and encodings['br']:
+        return 'br'
+    if encodings['gzip']:
+        return 'gzip'
+    return None
+
+def response_etag(code, engine, kind):
+    """
+    Builds the strong ETag of a rendered response from the code alone, so a matching If-None-Match
+    can be answered before anything is rendered. Each compressed variant gets its own tag.
+    """
+    etag = RenderCache.key(code, engine, f'{kind}/{RESPONSE_VERSION}')
+    if kind != 'png':
+        encoding = accepted_encoding()
+        if encoding:
+            etag = f'{etag}-{encoding}'
+    return etag
+
+def etag_matches(etag):
+    return etag is not None and request.if_none_match.contains(etag)
+
+def not_modified(etag):
+    response = make_response('', 304)
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    return response
+
+def image_response(data, mimetype, etag=None, filename=None):
+    """
+    Returns rendered bytes as they are, compressed when the client accepts it (PNGs are compressed
+    already). Compressed copies are kept in render_cache under their ETag.
     """
-    # Fix bare URLs in xlink:href attributes.
-    svg_text = re.sub(
-        r'(xlink:href)="(?!https?://)([^"]+)"',
-        r'\1="http://\2"',
-        svg_text
-    )
-    # Fix bare URLs in href attributes.
-    svg_text = re.sub(
-        r'(href)="(?!https?://)([^"]+)"',
-        r'\1="http://\2"',
-        svg_text
-    )
-    svg_text = re.sub(r'<a\b[^>]*>', add_target, svg_text)
-    return svg_text
+    encoding = accepted_encoding() if mimetype != 'image/png' else None
+    if encoding:
+        compressed = render_cache.get(etag) if etag else None
+        if compressed is None:
+            compressed = brotli.compress(data, quality=5) if encoding == 'br' else gzip.compress(data, 6)
+            if etag:
+                render_cache.put(etag, compressed)
+        data = compressed
+    response = make_response(data)
+    response.headers['Content-Type'] = mimetype
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag)
+    if filename:
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+# Embedded DOT sources of at least this many bytes are gzipped and base64 encoded (None never compresses them).
+DOT_METADATA_COMPRESS_MIN = 65536
+# Bytes of an SVG read at a time while looking for the embedded DOT source.
+EXTRACT_CHUNK = 65536
+# Compressed DOT sources that unpack to more than this many bytes are refused, and so are
+# /extract request bodies of more than EXTRACT_MAX_UPLOAD bytes.
+DOT_METADATA_MAX_SIZE = 16 * 1024 * 1024
+EXTRACT_MAX_UPLOAD = 64 * 1024 * 1024
+# The start tag of the element holding the DOT source, and how its content is encoded.
+DOT_METADATA_RE = re.compile(rb"""<metadata id=['"]graphviz-dot['"]([^>]*)>""")
+DOT_METADATA_ENCODING_RE = re.compile(rb"""data-encoding=['"]([^'"]*)['"]""")
+DOT_METADATA_END = b'</metadata>'
+DOT_CDATA_START, DOT_CDATA_END = b'<![CDATA[', b']]>'
+DOT_CDATA_RE = re.compile(rb'<!\[CDATA\[(.*?)\]\]>', re.DOTALL)
+
+def dot_metadata(code):
+    """
+    Builds the <metadata id="graphviz-dot"> element holding code. Big sources are gzipped and
+    base64 encoded, others go in a CDATA section (split wherever the code itself contains "]]>").
+    """
+    data = code.encode('utf-8')
+    if DOT_METADATA_COMPRESS_MIN is not None and len(data) >= DOT_METADATA_COMPRESS_MIN:
+        payload = base64.b64encode(gzip.compress(data, 9, mtime=0))
+        return b"<metadata id='graphviz-dot' data-encoding='gzip+base64'>" + payload + DOT_METADATA_END
+    return b"<metadata id='graphviz-dot'><![CDATA[" + data.replace(b']]>', b']]]]><![CDATA[>') + b"]]>" + DOT_METADATA_END
+
+def embed_dot_metadata(svg_data, code):
+    """
+    Puts the DOT source into a <metadata id="graphviz-dot"> element right after the <svg> tag,
+    where extract_dot_metadata() looks for it. The SVG is copied once, straight into the output.
+    """
+    metadata = dot_metadata(code)
+    match = SVG_ROOT_RE.search(svg_data)
+    if match is None:
+        return metadata + svg_data
+    view = memoryview(svg_data)
+    return b''.join((view[:match.end()], metadata, view[match.end():]))
+
+def extract_dot_metadata(stream, chunk_size=EXTRACT_CHUNK):
+    """
+    Reads an SVG from a binary file object up to the end of its graphviz-dot metadata element
+    and returns the DOT source in it, or None if there is none. Exports have the element right
+    after the <svg> tag, so only the start of even a huge file is read.
+    The end tag only counts outside CDATA sections, so a source containing "</metadata>" survives.
+    Raises ValueError if the file ends inside the element or its content can't be decoded.
+    """
+    buffer = b''
+    match = None
+    while match is None:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return None
+        # Keep the end of the previous chunk, in case the start tag was cut in two.
+        buffer = buffer[-256:] + chunk
+        match = DOT_METADATA_RE.search(buffer)
+    content = bytearray(buffer[match.end():])
+    searched, in_cdata = 0, False
+    while True:
+        if in_cdata:
+            close = content.find(DOT_CDATA_END, searched)
+            if close != -1:
+                searched, in_cdata = close + len(DOT_CDATA_END), False
+                continue
+            searched = max(len(content) - len(DOT_CDATA_END) + 1, searched)
+        else:
+            end = content.find(DOT_METADATA_END, searched)
+            start = content.find(DOT_CDATA_START, searched, len(content) if end == -1 else end)
+            if start != -1:
+                searched, in_cdata = start + len(DOT_CDATA_START), True
+                continue
+            if end != -1:
+                return decode_dot_metadata(bytes(content[:end]), match.group(1))
+            # Keep enough of the end to find either tag if the next chunk completes it.
+            searched = max(len(content) - len(DOT_METADATA_END) + 1, searched)
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            raise ValueError("The SVG ends inside its graphviz-dot metadata")
+        content += chunk
+
+def decode_dot_metadata(content, attributes):
+    """
+    Decodes the content of a graphviz-dot metadata element, given the attributes of its start tag.
+    """
+    encoding = DOT_METADATA_ENCODING_RE.search(attributes)
+    if encoding is not None:
+        if encoding.group(1) != b'gzip+base64':
+            raise ValueError(f"Unknown DOT source encoding {encoding.group(1).decode('utf-8', 'replace')!r}")
+        # Unpacked with a limit, since a small upload could otherwise unpack to gigabytes.
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = inflater.decompress(base64.b64decode(content), DOT_METADATA_MAX_SIZE + 1)
+        except (ValueError, zlib.error) as e:
+            raise ValueError(f"The embedded DOT source can't be decoded: {e}")
+        if len(data) > DOT_METADATA_MAX_SIZE:
+            raise ValueError(f"The embedded DOT source is larger than {DOT_METADATA_MAX_SIZE} bytes")
+        if not inflater.eof:
+            raise ValueError("The embedded DOT source can't be decoded: it is cut short")
+        try:
+            return data.decode('utf-8')
+        except ValueError as e:
+            raise ValueError(f"The embedded DOT source can't be decoded: {e}")
+    # CDATA sections alternate with text, which is escaped instead if another tool rewrote the file.
+    pieces = DOT_CDATA_RE.split(content)
+    return ''.join(piece.decode('utf-8') if i % 2 else html.unescape(piece.decode('utf-8'))
+                   for i, piece in enumerate(pieces))
 
 @app.route('/download-svg', methods=['POST'])
 def download_svg():
     data = request.get_json()
     code = data.get('code', '')
+    engine = requested_engine(data)
     try:
-        src = graphviz.Source(code, engine='dot')
-        svg_data = src.pipe(format='svg').decode('utf-8')
-        # Fix relative URLs.
-        svg_data = fix_svg_urls(svg_data)
-
-        metadata = f"<metadata id='graphviz-dot'><![CDATA[{code}]]></metadata>"
-        start_index = svg_data.find("<svg")
-        if start_index != -1:
-            tag_end = svg_data.find(">", start_index)
-            if tag_end != -1:
-                svg_data = svg_data[:tag_end+1] + metadata + svg_data[tag_end+1:]
-            else:
-                svg_data += metadata
-        else:
-            svg_data = metadata + svg_data
-
-        response = make_response(svg_data)
-        response.headers['Content-Type'] = 'image/svg+xml'
-        response.headers['Content-Disposition'] = 'attachment; filename=graph.svg'
-        return response
+        etag = response_etag(code, engine, 'download-svg')
+        if etag_matches(etag):
+            return not_modified(etag)
+        svg_data = export_graph(code, 'svg', engine)
+        with span('serialize'):
+            return image_response(svg_data, 'image/svg+xml', etag, 'graph.svg')
+    except PoolBusyError:
+        raise
     except Exception as e:
         return str(e), 500
 
@@ -419,34 +3301,554 @@ def download_png():
     """
     data = request.get_json()
     code = data.get('code', '')
+    engine = requested_engine(data)
     try:
-        src = graphviz.Source(code, engine='dot')
-        png_data = src.pipe(format='png')
-        response = make_response(png_data)
-        response.headers['Content-Type'] = 'image/png'
-        response.headers['Content-Disposition'] = 'attachment; filename=graph.png'
-        return response
+        etag = response_etag(code, engine, 'png')
+        if etag_matches(etag):
+            return not_modified(etag)
+        png_data = export_graph(code, 'png', engine)
+        with span('serialize'):
+            return image_response(png_data, 'image/png', etag, 'graph.png')
+    except PoolBusyError:
+        raise
     except Exception as e:
         return str(e), 500
 
+@app.route('/extract', methods=['POST'])
+def extract_dot():
+    """
+    Returns the DOT source embedded in an exported SVG, sent as the request body, as {'code'}
+    (null if there is none). The body is only parsed as far as the source.
+    """
+    request.max_content_length = EXTRACT_MAX_UPLOAD
+    try:
+        return jsonify({'code': extract_dot_metadata(request.stream)})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        # Read the rest, so the client isn't cut off in the middle of sending it.
+        while request.stream.read(EXTRACT_CHUNK):
+            pass
+
 @app.route('/save', methods=['POST'])
 def save_code():
     """
-    Saves the current editor content to disk.
+    Saves the current editor content to its workspace document.
     This is triggered by auto-save and when the browser unloads the page.
+    Auto-save sends the changes made since the revision it last saved as {'base', 'changes'}.
+    If the document isn't at that revision any more the reply is a 409 with the current revision,
+    and the client resyncs by sending the whole text as 'code' instead. The unload beacon sends
+    both, and the text is saved if the changes don't apply for any reason.
     """
     data = request.get_json()
-    code = data.get('code', '')
+    user = workspace_user()
+    doc_id = data.get('doc') or default_document(user)
     try:
-        with open(BACKUP_FILE, 'w', encoding='utf-8') as f:
-            f.write(code)
-        return ('', 204)
+        if 'changes' in data:
+            try:
+                revision = workspace.apply_changes(user, doc_id, data.get('base'), data['changes'])
+            except (StaleRevision, ValueError, TypeError, AttributeError) as e:
+                # The unload beacon sends the whole text too, since it can't resync.
+                if 'code' in data:
+                    revision = workspace.save(user, doc_id, data['code'])
+                elif isinstance(e, StaleRevision):
+                    return jsonify({'status': 'resync', 'revision': e.revision}), 409
+                else:
+                    raise
+        else:
+            revision = workspace.save(user, doc_id, data.get('code', ''))
+        return jsonify({'revision': revision})
+    except KeyError:
+        return jsonify({'error': 'Unknown document'}), 404
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return str(e), 500
 
+@app.route('/documents', methods=['GET'])
+def list_documents():
+    """
+    Lists the documents in the caller's workspace.
+    """
+    return jsonify({'documents': workspace.list_documents(workspace_user())})
+
+@app.route('/documents', methods=['POST'])
+def create_document():
+    """
+    Creates a document in the caller's workspace and returns its id.
+    """
+    data = request.get_json(silent=True) or {}
+    name = str(data.get('name') or 'Untitled')[:200]
+    doc_id = workspace.create_document(workspace_user(), name, data.get('code', DEFAULT_CODE))
+    return jsonify({'id': doc_id, 'name': name}), 201
+
+@app.route('/documents/<doc_id>', methods=['PATCH'])
+def update_document(doc_id):
+    """
+    Renames a document or changes the layout engine it is drawn with.
+    """
+    data = request.get_json(silent=True) or {}
+    fields = {}
+    if data.get('name'):
+        fields['name'] = str(data['name'])[:200]
+    if 'engine' in data:
+        fields['engine'] = requested_engine(data)
+    try:
+        workspace.update_document(workspace_user(), doc_id, **fields)
+    except KeyError:
+        return jsonify({'error': 'Unknown document'}), 404
+    return ('', 204)
+
+BATCH_FORMATS = ('svg', 'png')
+DOT_EXTENSIONS = ('.dot', '.gv')
+
+def export_graph(code, fmt='svg', engine='dot'):
+    """
+    Renders code the way the download routes hand it out: SVGs get absolute links and the
+    DOT source embedded, so they can be loaded back into the editor. Exports are never drafts,
+    so 'auto' means dot here.
+    """
+    engine, args = layout_engine(engine, code, preview=False)
+    if fmt == 'svg':
+        svg_data = render(code, engine, 'svg', args=args)
+        with span('postprocess'):
+            return embed_dot_metadata(fix_svg_urls(svg_data), code)
+    return render(code, engine, fmt, args=args)
+
+def render_batch_item(item):
+    """
+    Renders one {'name', 'code', 'format', 'engine'} item and returns the item with either
+    'data' (bytes) or 'error' (a message) added. Failures stay with their item.
+    """
+    result = {'name': item['name'], 'format': item.get('format', 'svg')}
+    if 'error' in item:
+        result['error'] = item['error']
+        return result
+    try:
+        if result['format'] not in BATCH_FORMATS:
+            raise ValueError(f"Unsupported format {result['format']!r}")
+        parse_dot(item['code'])
+        result['data'] = export_graph(item['code'], result['format'], requested_engine(item))
+    except DotSyntaxError as e:
+        result['error'] = f"line {e.line + 1}: {e.message}"
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+def render_batch(items, workers=None):
+    """
+    Renders items concurrently and yields the results in the order they finish. Each thread
+    drives a Graphviz process from dot_pool, so workers defaults to the size of the pool.
+    Items are read lazily and only a few more than workers are in flight at once, so items
+    can come from a stream.
+    """
+    workers = workers or max(dot_pool.size, 1)
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = set()
+        for item in items:
+            running.add(executor.submit(render_batch_item, item))
+            if len(running) >= workers * 2:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(running):
+            yield future.result()
+
+def ndjson_batch_items(lines):
+    """
+    Reads batch items from lines of JSON objects with 'code' and optionally 'name', 'format'
+    and 'engine'. A line that isn't such an object becomes an item that reports the error.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            if not isinstance(item.get('code'), str):
+                raise ValueError("'code' is missing")
+        except (ValueError, AttributeError) as e:
+            yield {'name': f'line {number}', 'error': f'Invalid item: {e}'}
+            continue
+        item.setdefault('name', f'line {number}')
+        yield item
+
+def tar_batch_items(fileobj, formats):
+    """
+    Reads the .dot and .gv files out of a (possibly compressed) tar stream, one item per format.
+    """
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith(DOT_EXTENSIONS):
+                continue
+            code = archive.extractfile(member).read().decode('utf-8', errors='replace')
+            name = os.path.splitext(member.name)[0]
+            for fmt in formats:
+                yield {'name': name, 'code': code, 'format': fmt}
+
+def batch_result_json(result):
+    """
+    One line of the /batch response. SVGs are sent as text and PNGs base64 encoded.
+    """
+    data = result.pop('data', None)
+    if data is not None:
+        if result['format'] == 'svg':
+            result['data'] = data.decode('utf-8')
+        else:
+            result['data'] = base64.b64encode(data).decode('ascii')
+            result['encoding'] = 'base64'
+    return json.dumps(result) + '\n'
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Renders many graphs in one request. The body is either newline delimited JSON items
+    ({"name", "code", "format", "engine"} per line) or, with Content-Type application/x-tar,
+    a tar archive of .dot/.gv files rendered to the formats listed in ?format= (svg by default).
+    The response is newline delimited JSON with one line per graph as it finishes, holding
+    either 'data' or 'error'.
+    """
+    if request.mimetype in ('application/x-tar', 'application/gzip', 'application/x-gzip'):
+        formats = request.args.get('format', 'svg').split(',')
+        items = tar_batch_items(request.stream, formats)
+    else:
+        items = ndjson_batch_items(request.stream)
+
+    def results():
+        for result in render_batch(items):
+            yield batch_result_json(result)
+    return app.response_class(stream_with_context(results()), mimetype='application/x-ndjson')
+
+async def render_async(code, engine='dot', fmt='svg', cancel=None, slots=None, args=()):
+    """
+    The asyncio counterpart of render(). Runs a one-off Graphviz process without blocking the event
+    loop and leaves the output, or the error message, in render_cache.
+    """
+    key = RenderCache.key(code, ' '.join((engine,) + args), fmt)
+    if render_cache.get(key) is not None or render_cache.get_error(key) is not None:
+        return
+    try:
+        heavy = dot_pool.admit(code)
+    except GraphTooLarge:
+        heavy = True
+    if heavy:
+        # Left to the worker pool's low-priority lane, which render() queues it in.
+        return
+    async with slots or nullcontext():
+        with span('graphviz', engine=engine, format=fmt):
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *graphviz_command(engine, fmt, args), stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            except OSError:
+                return
+            limit_dot_process(process.pid, dot_pool.memory_limit, dot_pool.job_timeout)
+            communicate = asyncio.ensure_future(process.communicate(code.encode('utf-8')))
+            deadline = time.monotonic() + dot_pool.job_timeout
+            try:
+                while not communicate.done():
+                    remaining = deadline - time.monotonic()
+                    if cancel is not None:
+                        remaining = min(remaining, CANCEL_POLL_INTERVAL)
+                    await asyncio.wait({communicate}, timeout=max(remaining, 0))
+                    if communicate.done():
+                        break
+                    if cancel is not None and cancel.is_set():
+                        raise RenderCancelled("Render superseded by a newer revision")
+                    if time.monotonic() >= deadline:
+                        raise RenderTimeout(f"Graphviz did not finish within {dot_pool.job_timeout} seconds")
+            except BaseException:
+                if process.returncode is None:
+                    process.kill()
+                await asyncio.gather(communicate, return_exceptions=True)
+                raise
+            out, err = communicate.result()
+    if process.returncode != 0:
+        error = graphviz_failure(err, process.returncode)
+        # Anything else is left for render() to run into again and report.
+        if isinstance(error, RenderSyntaxError):
+            render_cache.put_error(key, str(error))
+    else:
+        render_cache.put(key, out)
+
+class AsyncRenderApp:
+    """
+    The ASGI application behind --async mode.
+    Requests to the render routes get their graph rendered on the event loop first and are then handed
+    to the Flask app, which finds the result in render_cache, so a thread is only tied up for building
+    the response and never while Graphviz runs. Live preview streams from /events are served
+    right here on the event loop, so an open tab doesn't hold a thread. Everything else goes
+    straight to Flask, which runs on a pool of threads, so one slow request doesn't hold up the others.
+    """
+    RENDER_FORMATS = {
+        '/render': 'svg',
+        '/lint': 'svg',
+        '/compile': 'svg',
+        '/download-svg': 'svg',
+        '/download-png': 'png',
+    }
+
+    def __init__(self, wsgi_app, max_renders=ASYNC_MAX_RENDERS, threads=ASYNC_WSGI_THREADS):
+        from asgiref.sync import sync_to_async
+        from asgiref.wsgi import WsgiToAsgiInstance
+        executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        run = WsgiToAsgiInstance.__dict__['run_wsgi_app'].func
+
+        class PooledWsgiInstance(WsgiToAsgiInstance):
+            # asgiref runs every WSGI call on one shared thread by default.
+            run_wsgi_app = sync_to_async(run, thread_sensitive=False, executor=executor)
+
+        async def wsgi(scope, receive, send):
+            await PooledWsgiInstance(wsgi_app)(scope, receive, send)
+
+        self.wsgi = wsgi
+        self.max_renders = max_renders
+        self._slots = None
+
+    async def __call__(self, scope, receive, send):
+        fmt = None
+        if scope['type'] == 'http' and scope['method'] == 'POST':
+            fmt = self.RENDER_FORMATS.get(scope['path'])
+        elif scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/events' \
+                and LIVE_PREVIEW:
+            doc_id = parse_qs(scope['query_string'].decode('latin-1')).get('doc', [None])[0]
+            # Unknown documents get their 404 from Flask.
+            if WorkspaceStore.valid_id(doc_id):
+                return await self.preview_events(scope, receive, send, doc_id)
+        if fmt is None:
+            return await self.wsgi(scope, receive, send)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_renders)
+        body = bytearray()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        try:
+            data = json.loads(body)
+            code = data.get('code', '')
+            graphs = parse_dot(code)
+            # Incremental previews go through the worker pool from the Flask side.
+            preview = scope['path'] in ('/render', '/compile')
+            engine, args = layout_engine(requested_engine(data), code, preview or scope['path'] == '/lint')
+            if not preview or incremental_outline(code, graphs, data.get('session')) is None:
+                with editor_revision(data) as cancel:
+                    await render_async(code, engine, fmt, cancel, self._slots, args)
+        except Exception:
+            # Bad, superseded and failed requests get their proper response from Flask.
+            pass
+
+        replayed = False
+        async def replay():
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            replayed = True
+            return {'type': 'http.request', 'body': bytes(body), 'more_body': False}
+        await self.wsgi(scope, replay, send)
+
+    async def preview_events(self, scope, receive, send, doc_id):
+        """
+        The /events stream of the Flask app, waiting on the channel from the event loop.
+        It ends when the client disconnects.
+        """
+        headers = dict(scope['headers'])
+        user = workspace_user(parse_cookie(headers.get(b'cookie', b'').decode('latin-1')))
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        async def push(data):
+            await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+        watcher = asyncio.ensure_future(disconnected())
+        try:
+            with preview_channels.subscribe(user, doc_id) as channel:
+                await send({'type': 'http.response.start', 'status': 200, 'headers': [
+                    (b'content-type', b'text/event-stream; charset=utf-8'),
+                    (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no')]})
+                await push(b'retry: 1000\n\n')
+                seen = 0
+                while True:
+                    waiting = asyncio.ensure_future(channel.wait_result(seen, PREVIEW_KEEPALIVE))
+                    await asyncio.wait((waiting, watcher), return_when=asyncio.FIRST_COMPLETED)
+                    if watcher.done():
+                        waiting.cancel()
+                        return
+                    result = waiting.result()
+                    if result is None:
+                        await push(b': keepalive\n\n')
+                        continue
+                    seen = result['revision']
+                    await push(preview_event(result))
+        finally:
+            watcher.cancel()
+
+def configure(settings):
+    """
+    Applies command line settings (as a dict) to the render cache and worker pool.
+    """
+    global SERVER_TIMING, AUTO_ENGINE_MIN_COST, LIVE_PREVIEW, TILED_PREVIEW, INLINE_CSS
+    AUTO_ENGINE_MIN_COST = settings.get('auto_engine_threshold', AUTO_ENGINE_MIN_COST)
+    dot_pool.resize(settings.get('pool_size', DOT_POOL_SIZE))
+    dot_pool.job_timeout = settings.get('render_timeout', DOT_JOB_TIMEOUT)
+    dot_pool.memory_limit = settings.get('render_memory', DOT_MEMORY_LIMIT)
+    dot_pool.max_cost = settings.get('max_graph_size', MAX_RENDER_COST)
+    SERVER_TIMING = settings.get('server_timing', SERVER_TIMING)
+    LIVE_PREVIEW = settings.get('workers', 1) == 1
+    TILED_PREVIEW = settings.get('workers', 1) == 1
+    INLINE_CSS = settings.get('inline_css', INLINE_CSS)
+    render_cache.max_bytes = settings.get('cache_size', RENDER_CACHE_MAX_BYTES // (1024 * 1024)) * 1024 * 1024
+    render_cache.cache_dir = settings.get('cache_dir', RENDER_CACHE_DIR)
+    workspace.root = settings.get('workspace', WORKSPACE_DIR)
+
+def create_asgi_app():
+    """
+    Builds the ASGI application for --async mode. uvicorn calls this in every worker process,
+    which picks up the command line settings from the TECHLINES_SETTINGS environment variable.
+    """
+    settings = json.loads(os.environ.get('TECHLINES_SETTINGS', '{}'))
+    configure(settings)
+    warm_up()
+    return AsyncRenderApp(app, settings.get('max_renders', ASYNC_MAX_RENDERS))
+
+def dot_file_items(path, name, formats):
+    try:
+        with open(path, encoding='utf-8') as f:
+            code = f.read()
+    except OSError as e:
+        yield {'name': name, 'error': str(e)}
+        return
+    for fmt in formats:
+        yield {'name': name, 'code': code, 'format': fmt}
+
+def file_batch_items(sources, formats):
+    """
+    Batch items for the batch command: .dot/.gv files, directories searched for them, tar
+    archives of them, and '-' for newline delimited JSON items on standard input. Files found
+    in a directory are named by their path relative to it.
+    """
+    for source in sources:
+        if source == '-':
+            yield from ndjson_batch_items(sys.stdin)
+        elif os.path.isdir(source):
+            for directory, _, files in sorted(os.walk(source)):
+                for filename in sorted(files):
+                    if filename.endswith(DOT_EXTENSIONS):
+                        path = os.path.join(directory, filename)
+                        name = os.path.splitext(os.path.relpath(path, source))[0]
+                        yield from dot_file_items(path, name, formats)
+        elif os.path.isfile(source) and tarfile.is_tarfile(source):
+            with open(source, 'rb') as f:
+                yield from tar_batch_items(f, formats)
+        else:
+            name = os.path.splitext(os.path.basename(source))[0]
+            yield from dot_file_items(source, name, formats)
+
+def write_assets(output):
+    """
+    Writes the page's script and stylesheet, along with their .gz and .br copies, to a directory
+    that a web server in front of TechLines can serve as /assets/.
+    """
+    os.makedirs(output, exist_ok=True)
+    suffixes = {None: '', 'gzip': '.gz', 'br': '.br'}
+    for name in PAGE_ASSETS:
+        fingerprinted, variants, _ = static_asset(name)
+        for encoding, data in variants.items():
+            path = os.path.join(output, fingerprinted + suffixes[encoding])
+            with open(path, 'wb') as f:
+                f.write(data)
+            print(path)
+
+def run_batch(args):
+    """
+    The batch command: renders every source into args.output, keeping the relative paths,
+    and prints each file as it is written. Returns 1 if any graph failed.
+    """
+    dot_pool.resize(args.jobs)
+    failed = 0
+    items = file_batch_items(args.sources, args.format.split(','))
+    for result in render_batch(items, args.jobs):
+        name = os.path.normpath(result['name']).lstrip(os.sep)
+        if name.startswith(os.pardir):
+            result.setdefault('error', 'Name points outside the output directory')
+        if 'error' in result:
+            failed += 1
+            print(f"{result['name']}: {result['error']}", file=sys.stderr)
+            continue
+        path = os.path.join(args.output, f"{name}.{result['format']}")
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(result['data'])
+        print(path)
+    return 1 if failed else 0
+
+def run_async_server(args):
+    try:
+        import uvicorn
+    except ImportError:
+        uvicorn = None
+    # asgiref is only needed by the worker processes uvicorn starts, but it is better missed now.
+    if uvicorn is None or importlib.util.find_spec('asgiref') is None:
+        sys.exit("--async needs uvicorn and asgiref: pip install uvicorn asgiref")
+    os.environ['TECHLINES_SETTINGS'] = json.dumps(vars(args))
+    uvicorn.run('main:create_asgi_app', factory=True, host=args.host, port=args.port, workers=args.workers)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Graphviz Live Viewer')
     parser.add_argument('--host', default='127.0.0.1', help='IP address to bind on')
     parser.add_argument('--port', default=5000, type=int, help='Port to bind on')
+    parser.add_argument('--cache-size', default=RENDER_CACHE_MAX_BYTES // (1024 * 1024), type=int,
+                        help='Size of the in-memory render cache in MB')
+    parser.add_argument('--cache-dir', default=RENDER_CACHE_DIR,
+                        help='Directory to persist rendered graphs in (disabled by default)')
+    parser.add_argument('--workspace', default=WORKSPACE_DIR,
+                        help='Directory to store every user\'s documents in')
+    parser.add_argument('--pool-size', default=DOT_POOL_SIZE, type=int,
+                        help='Number of Graphviz worker processes (0 starts a new process per render)')
+    parser.add_argument('--render-timeout', default=DOT_JOB_TIMEOUT, type=float,
+                        help='Seconds a single render may run before it is killed')
+    parser.add_argument('--render-memory', default=DOT_MEMORY_LIMIT, type=int,
+                        help='MB of memory a single Graphviz process may use (0 for no limit)')
+    parser.add_argument('--max-graph-size', default=MAX_RENDER_COST, type=int,
+                        help='Refuse to render graphs with more nodes and edges than this')
+    parser.add_argument('--auto-engine-threshold', default=AUTO_ENGINE_MIN_COST, type=int,
+                        help='With the auto engine, graphs with more nodes and edges than this get a draft preview')
+    parser.add_argument('--server-timing', action='store_true',
+                        help='Send a Server-Timing header with the time spent in each phase of a request')
+    parser.add_argument('--inline-css', action='store_true',
+                        help='Put the stylesheet into the page instead of linking to it')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of server processes (more than one implies --async)')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Serve with uvicorn and render on an asyncio event loop')
+    parser.add_argument('--max-renders', default=ASYNC_MAX_RENDERS, type=int,
+                        help='Renders each server process runs at once in --async mode')
+    commands = parser.add_subparsers(dest='command')
+    batch_parser = commands.add_parser('batch', help='Render DOT files to SVG/PNG without starting the server')
+    batch_parser.add_argument('sources', nargs='+',
+                              help='.dot/.gv files, directories, tar archives, or - for JSON lines on stdin')
+    batch_parser.add_argument('-o', '--output', default='.', help='Directory to write the rendered files to')
+    batch_parser.add_argument('--format', default='svg', help='Comma separated output formats: svg, png')
+    batch_parser.add_argument('--jobs', default=DOT_POOL_SIZE, type=int,
+                              help='Number of graphs rendered at once')
+    assets_parser = commands.add_parser('assets', help='Write the page\'s script and stylesheet for a web server to serve')
+    assets_parser.add_argument('-o', '--output', default='.', help='Directory to write the files to')
     args = parser.parse_args()
-    app.run(debug=True, host=args.host, port=args.port)
+    configure(vars(args))
+    if args.command == 'batch':
+        sys.exit(run_batch(args))
+    elif args.command == 'assets':
+        write_assets(args.output)
+    elif args.use_async or args.workers > 1:
+        # Several processes are always served by uvicorn. Werkzeug's forking server would start a
+        # new process, with empty caches and its parent's Graphviz workers, for every request.
+        run_async_server(args)
+    else:
+        warm_up()
+        app.run(debug=True, host=args.host, port=args.port)
@@ -1,12 +1,30 @@
 import unittest
 import re
-from main import app, fix_svg_urls
-from unittest.mock import patch, mock_open
+import asyncio
+import importlib.util
+import json
+import gzip
+import io
+import os
+from main import app, fix_svg_urls, render_cache, RenderCache, PoolBusyError, output_complete, \
+    EditorSessions, RenderCancelled, RenderError, RenderSyntaxError, AsyncRenderApp, \
+    parse_dot, DotSyntaxError, GraphOutline, write_pinned_dot, SvgLinkRewriter, \
+    workspace, WorkspaceStore, text_delta, DotWorkerPool, GraphTooLarge, metrics, TileSet, \
+    embed_dot_metadata, extract_dot_metadata, probe_graphviz, pipe_once, incremental_outline
+from unittest.mock import patch, MagicMock
+import tempfile
+import threading
 
 class GraphvizAppTestCase(unittest.TestCase):
     def setUp(self):
         app.config['TESTING'] = True
         self.client = app.test_client()
+        render_cache.clear()
+        self.workspace_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workspace_dir.cleanup)
+        patcher = patch.object(workspace, 'root', self.workspace_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_index(self):
         # Test that the index route loads and contains expected text.
@@ -14,6 +32,58 @@ class GraphvizAppTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         # self.assertIn(b'Graphviz Live Viewer', response.data)
 
+    def test_page_caching(self):
+        # The page is revalidated by ETag, its script and stylesheet are cached for good.
+        response = self.client.get('/')
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        page = response.get_data(as_text=True)
+        again = self.client.get('/', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(again.status_code, 304)
+        script = re.search(r'<script src="(/assets/techlines\.[0-9a-f]{12}\.js)">', page).group(1)
+        response = self.client.get(script)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn(b'function customLinter', response.data)
+        self.assertIn(b'CodeMirror', response.data)
+        self.assertEqual(self.client.get('/assets/techlines.000000000000.js').status_code, 404)
+
+    def test_self_hosted_assets(self):
+        # Nothing comes from a CDN, assets are served precompressed, and the CSS can be inlined.
+        page = self.client.get('/').get_data(as_text=True)
+        self.assertNotIn('https://', page)
+        stylesheet = re.search(r'href="(/assets/techlines\.[0-9a-f]{12}\.css)"', page).group(1)
+        response = self.client.get(stylesheet, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'.cm-s-dracula', gzip.decompress(response.data))
+        # The notice names the CodeMirror release that is actually vendored.
+        with open(os.path.join(os.path.dirname(__file__), 'vendor/codemirror/lib/codemirror.js'), encoding='utf-8') as f:
+            version = re.search(r'CodeMirror\.version = "([^"]+)"', f.read()).group(1)
+        self.assertTrue(gzip.decompress(response.data).startswith(f'/* CodeMirror {version},'.encode()))
+        response = self.client.get(stylesheet, headers={'If-None-Match': response.headers['ETag'],
+                                                         'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 304)
+        with patch("main.INLINE_CSS", True):
+            page = self.client.get('/').get_data(as_text=True)
+        self.assertNotIn(stylesheet, page)
+        self.assertIn('.cm-s-dracula', page)
+
+    @patch("main.shutil.which", return_value=None)
+    def test_healthz(self, mock_which):
+        self.assertEqual(self.client.get('/healthz').status_code, 503)
+        with patch("main.graphviz_status", {}):
+            probe_graphviz()
+            response = self.client.get('/healthz')
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('not found', response.get_json()['error'])
+        with patch("main.graphviz_status", {}), patch("main.shutil.which", return_value='/usr/bin/dot'), \
+                patch("main.subprocess.run", return_value=MagicMock(stderr=b'dot - graphviz version 9.0.0')), \
+                patch("main.dot_pool.pipe", return_value=b'<svg></svg>') as mock_pipe:
+            probe_graphviz()
+            response = self.client.get('/healthz')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['version'], 'dot - graphviz version 9.0.0')
+            mock_pipe.assert_called_once()
+
     def test_render_valid(self):
         # Provide valid DOT code and verify that an SVG is returned.
         valid_code = "digraph G { A -> B; }"
@@ -70,17 +140,711 @@ class GraphvizAppTestCase(unittest.TestCase):
         self.assertEqual(response.headers.get('Content-Type'), 'image/png')
         self.assertTrue(len(response.data) > 0)
 
-    @patch("builtins.open", new_callable=mock_open)
-    def test_save_and_reload(self, mock_file):
-        # Test that posting to /save calls open() appropriately and writes the code.
-        test_code = "digraph G { A -> B; }"
-        response = self.client.post('/save', json={'code': test_code})
+    def test_save_and_reload(self):
+        # Code posted to /save should be what the page loads next time.
+        response = self.client.get('/')
+        doc_id = re.search(r'var docId = "([^"]+)"', response.get_data(as_text=True)).group(1)
+        test_code = "digraph G { A; B; }"
+        response = self.client.post('/save', json={'code': test_code, 'doc': doc_id})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/?doc=' + doc_id)
+        self.assertIn(json.dumps(test_code), response.get_data(as_text=True))
+
+    def test_backup_migration(self):
+        # The old single-file backup becomes the first visitor's document, and only theirs.
+        backup = f'{self.workspace_dir.name}.backup'
+        with open(backup, 'w', encoding='utf-8') as f:
+            f.write("digraph G { Backup; }")
+        self.addCleanup(os.remove, backup)
+        with patch("main.BACKUP_FILE", backup):
+            self.assertIn(json.dumps("digraph G { Backup; }"), self.client.get('/').get_data(as_text=True))
+            self.assertNotIn(json.dumps("digraph G { Backup; }"),
+                             app.test_client().get('/').get_data(as_text=True))
+
+    def test_save_changes(self):
+        # Changes apply on top of the revision they are based on; anything else has to resync.
+        page = self.client.get('/').get_data(as_text=True)
+        doc_id = re.search(r'var docId = "([^"]+)"', page).group(1)
+        base = re.search(r'var savedRevision = "([^"]+)"', page).group(1)
+        self.client.post('/save', json={'code': "digraph G { A; }", 'doc': doc_id})
+        response = self.client.post('/save', json={'doc': doc_id, 'base': base, 'changes': []})
+        self.assertEqual(response.status_code, 409)
+        base = response.get_json()['revision']
+        changes = [{'start': 12, 'end': 13, 'text': 'B'}, {'start': 13, 'end': 13, 'text': '; C'}]
+        response = self.client.post('/save', json={'doc': doc_id, 'base': base, 'changes': changes})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.get_json()['revision'], base)
+        self.assertIn(json.dumps("digraph G { B; C; }"), self.client.get('/?doc=' + doc_id).get_data(as_text=True))
+        response = self.client.post('/save', json={'doc': doc_id, 'base': response.get_json()['revision'],
+                                                   'changes': [{'start': 5, 'end': 500, 'text': ''}]})
+        self.assertEqual(response.status_code, 400)
+
+    def test_save_falls_back_to_code(self):
+        # The unload beacon sends the whole text along with its changes, for when they don't apply.
+        page = self.client.get('/').get_data(as_text=True)
+        doc_id = re.search(r'var docId = "([^"]+)"', page).group(1)
+        base = re.search(r'var savedRevision = "([^"]+)"', page).group(1)
+        for changes in ([{'start': 5, 'end': 500, 'text': ''}], 'garbage'):
+            code = f"digraph G {{ {len(str(changes))}; }}"
+            response = self.client.post('/save', json={'doc': doc_id, 'base': base, 'changes': changes,
+                                                       'code': code})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(json.dumps(code), self.client.get('/?doc=' + doc_id).get_data(as_text=True))
+
+    @patch("main.dot_pool.pipe")
+    def test_batch(self, mock_pipe):
+        # Every item gets its own line, and a bad one doesn't stop the rest.
+        mock_pipe.side_effect = lambda code, engine, fmt, **kwargs: \
+            b'<svg><a href="example.com"></a></svg>' if fmt == 'svg' else b'PNG'
+        body = '\n'.join([
+            json.dumps({'name': 'a', 'code': 'digraph { a -> b }'}),
+            json.dumps({'name': 'b', 'code': 'digraph { a -> b }', 'format': 'png'}),
+            json.dumps({'name': 'c', 'code': 'digraph { a -> }'}),
+            'not json',
+        ])
+        response = self.client.post('/batch', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        results = {r['name']: r for r in map(json.loads, response.get_data(as_text=True).splitlines())}
+        self.assertEqual(set(results), {'a', 'b', 'c', 'line 4'})
+        self.assertIn("<metadata id='graphviz-dot'><![CDATA[digraph { a -> b }]]>", results['a']['data'])
+        self.assertIn('target="_blank"', results['a']['data'])
+        self.assertEqual(results['b']['data'], 'UE5H')
+        self.assertIn('error', results['c'])
+        self.assertIn('error', results['line 4'])
+
+    @patch("main.dot_pool.pipe", return_value=b"<svg></svg>")
+    def test_metrics(self, mock_pipe):
+        # Requests show up in /metrics, and with Server-Timing on, in their own headers.
+        metrics.clear()
+        with patch("main.SERVER_TIMING", True):
+            response = self.client.post('/render', json={'code': "digraph G { A -> B; }"})
+        self.assertRegex(response.headers['Server-Timing'],
+                         r'^parse;dur=[\d.]+, graphviz;dur=[\d.]+, postprocess;dur=[\d.]+, serialize;dur=[\d.]+, total;dur=')
+        self.client.post('/lint', json={'code': "digraph G { A -> }"})
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('techlines_request_seconds_count{engine="dot",route="render_graph"} 1', text)
+        self.assertIn('techlines_phase_seconds_bucket{engine="dot",format="svg",phase="graphviz",le="+Inf"} 1', text)
+        self.assertIn('techlines_lint_errors_total{kind="syntax",route="lint_code"} 1', text)
+        self.assertIn('techlines_output_bytes_sum{engine="dot",format="svg"} 11.0', text)
+        self.assertIn('techlines_render_cache_misses 1', text)
+
+    @patch("main.AUTO_ENGINE_MIN_COST", 5)
+    @patch("main.dot_pool.pipe", return_value=b"<svg></svg>")
+    def test_engines(self, mock_pipe):
+        # Engines are picked per request; 'auto' drafts previews of big graphs but not exports.
+        small, big = "graph { a -- b }", "graph { a -- b -- c -- d -- e }"
+        self.client.post('/render', json={'code': small, 'engine': 'neato'})
+        self.client.post('/render', json={'code': small, 'engine': 'auto'})
+        self.client.post('/compile', json={'code': big, 'engine': 'auto'})
+        self.client.post('/download-png', json={'code': big, 'engine': 'auto'})
+        calls = [(c.args[1], c.args[2], c.kwargs['args']) for c in mock_pipe.call_args_list]
+        self.assertEqual(calls, [('neato', 'svg', ()), ('dot', 'svg', ()),
+                                 ('sfdp', 'svg', ('-Gsplines=false',)), ('dot', 'png', ())])
+        response = self.client.post('/render', json={'code': small, 'engine': 'rm -rf'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_document_engine(self):
+        # The engine picked for a document is what the page starts with next time.
+        page = self.client.get('/').get_data(as_text=True)
+        doc_id = re.search(r'var docId = "([^"]+)"', page).group(1)
+        response = self.client.patch('/documents/' + doc_id, json={'engine': 'fdp'})
         self.assertEqual(response.status_code, 204)
-        # Verify that open() was called with the backup file name, write mode, and proper encoding.
-        mock_file.assert_called_with("editor_backup.txt", "w", encoding="utf-8")
-        # Verify that write() was called with the test code.
-        handle = mock_file()
-        handle.write.assert_called_once_with(test_code)
+        self.assertIn('var engine = "fdp"', self.client.get('/').get_data(as_text=True))
+        self.assertEqual(self.client.patch('/documents/nope', json={'engine': 'fdp'}).status_code, 404)
+
+    @patch("main.TILED_PREVIEW_MIN_COST", 0)
+    @patch("main.dot_pool.pipe")
+    def test_compile_tiles(self, mock_pipe):
+        # Big graphs come back as tiles that are then fetched one by one.
+        mock_pipe.return_value = spread_svg(20, 100) + b'digraph { }\n'
+        response = self.client.post('/compile', json={'code': "digraph { a -> b }", 'tiles': True})
+        tiles = response.get_json()['tiles']
+        self.assertIsNone(response.get_json()['svg'])
+        self.assertEqual(tiles['width'], 2000)
+        response = self.client.get(f"/tiles/{tiles['id']}/1/0/0.svg")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn(b'<ellipse', response.data)
+        self.assertEqual(self.client.get(f"/tiles/{tiles['id']}/1/5/0.svg").status_code, 404)
+        self.assertEqual(self.client.get("/tiles/forgotten/0/0/0.svg").status_code, 404)
+        # Another server process wouldn't have the tiles, so several workers get the whole SVG.
+        with patch("main.TILED_PREVIEW", False):
+            response = self.client.post('/compile', json={'code': "digraph { a -> b }", 'tiles': True})
+        self.assertNotIn('tiles', response.get_json())
+
+    def test_workspaces_are_per_user(self):
+        # Each visitor gets a cookie and their own documents.
+        self.client.get('/')
+        other = app.test_client()
+        other.get('/')
+        response = self.client.post('/documents', json={'name': 'Network'})
+        self.assertEqual(response.status_code, 201)
+        names = [d['name'] for d in self.client.get('/documents').get_json()['documents']]
+        self.assertEqual(names[0], 'Network')
+        names = [d['name'] for d in other.get('/documents').get_json()['documents']]
+        self.assertNotIn('Network', names)
+
+    @patch("main.PREVIEW_DEBOUNCE", 0.2)
+    @patch("main.dot_pool.pipe", return_value=b"<svg>\n<g/>\n</svg>\n")
+    def test_live_preview(self, mock_pipe):
+        # Edits within the debounce are coalesced and only the newest revision is rendered.
+        self.client.get('/')
+        response = self.client.post('/preview', json={'doc': 'live', 'code': "digraph live { A -> B }"})
+        self.assertEqual(response.get_json(), {'revision': 1})
+        change = {'start': 20, 'end': 21, 'text': 'C'}
+        response = self.client.post('/preview', json={'doc': 'live', 'base': 1, 'changes': [change]})
+        self.assertEqual(response.get_json(), {'revision': 2})
+        response = self.client.post('/preview', json={'doc': 'live', 'base': 1, 'changes': [change]})
+        self.assertEqual(response.status_code, 409)
+        response = self.client.post('/preview', json={'doc': 'live', 'base': 2, 'changes': [{'start': 99, 'end': 100}]})
+        self.assertEqual(response.status_code, 400)
+        # Every tab listening on /events gets the same result.
+        streams = [self.client.get('/events?doc=live').response for _ in range(2)]
+        for events in streams:
+            self.assertEqual(next(events), b'retry: 1000\n\n')
+            self.assertEqual(next(events), b'event: svg\ndata: <svg>\ndata: <g/>\ndata: </svg>\n\n')
+            events.close()
+        self.assertEqual(mock_pipe.call_count, 1)
+        self.assertEqual(mock_pipe.call_args.args[0], "digraph live { A -> C }")
+        self.assertEqual(self.client.get('/events?doc=../etc').status_code, 404)
+
+    def test_extract(self):
+        svg = embed_dot_metadata(b'<svg><g/></svg>', 'digraph { a -> b }')
+        response = self.client.post('/extract', data=svg, content_type='image/svg+xml')
+        self.assertEqual(response.get_json(), {'code': 'digraph { a -> b }'})
+        response = self.client.post('/extract', data=b'<svg><g/></svg>', content_type='image/svg+xml')
+        self.assertEqual(response.get_json(), {'code': None})
+        response = self.client.post('/extract', data=svg[:40], content_type='image/svg+xml')
+        self.assertEqual(response.status_code, 400)
+        with patch("main.EXTRACT_MAX_UPLOAD", len(svg) - 1):
+            response = self.client.post('/extract', data=svg, content_type='image/svg+xml')
+        self.assertEqual(response.status_code, 413)
+
+    @patch("main.dot_pool.pipe")
+    def test_lint_then_render_uses_cache(self, mock_pipe):
+        # Linting and then rendering the same code should only run Graphviz once.
+        mock_pipe.return_value = b"<svg></svg>"
+        code = "digraph G { A -> B; }"
+        self.client.post('/lint', json={'code': code})
+        response = self.client.post('/render', json={'code': code})
+        self.assertIn("<svg", response.get_json()['svg'])
+        self.assertEqual(mock_pipe.call_count, 1)
+        self.assertEqual(render_cache.hits, 1)
+
+    def test_compile_valid(self):
+        # Valid code should come back with no annotations and a rendered SVG.
+        valid_code = "digraph G { A -> B; }"
+        response = self.client.post('/compile', json={'code': valid_code})
+        self.assertEqual(response.status_code, 200)
+        json_data = response.get_json()
+        self.assertEqual(json_data.get('annotations'), [])
+        self.assertIn("<svg", json_data['svg'])
+
+    def test_compile_invalid(self):
+        # Invalid code should come back with annotations and no SVG.
+        invalid_code = "digraph G { A -> }"
+        response = self.client.post('/compile', json={'code': invalid_code})
+        self.assertEqual(response.status_code, 200)
+        json_data = response.get_json()
+        self.assertTrue(len(json_data.get('annotations', [])) > 0)
+        self.assertIsNone(json_data['svg'])
+
+    @patch("main.dot_pool.pipe", side_effect=PoolBusyError("All Graphviz workers are busy"))
+    def test_render_pool_busy(self, mock_pipe):
+        # When every worker is busy the client is told to retry rather than shown a syntax error.
+        response = self.client.post('/render', json={'code': "digraph G { A -> B; }"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers.get('Retry-After'), '1')
+
+    @patch("main.dot_pool.pipe", return_value=b"<svg></svg>")
+    def test_compile_superseded(self, mock_pipe):
+        # Once a session has sent revision 5, a late request for revision 3 is skipped.
+        code = "digraph G { A -> B; }"
+        self.client.post('/compile', json={'code': code, 'session': 'abc', 'revision': 5})
+        response = self.client.post('/compile', json={'code': code + " ", 'session': 'abc', 'revision': 3})
+        self.assertEqual(response.get_json(), {'status': 'superseded'})
+        self.assertEqual(mock_pipe.call_count, 1)
+
+    @patch("main.dot_pool.pipe", side_effect=RenderSyntaxError("Error: <stdin>: syntax error in line 1 near '}'"))
+    def test_render_errors_are_cached(self, mock_pipe):
+        # Linting and then rendering code Graphviz rejects should only run Graphviz once too.
+        code = "digraph G { A -> B; }"
+        self.client.post('/lint', json={'code': code})
+        response = self.client.post('/render', json={'code': code})
+        self.assertIn("syntax error", response.get_json()['svg'].lower())
+        self.assertEqual(mock_pipe.call_count, 1)
+
+    @patch("main.dot_pool.pipe", side_effect=RenderError("Graphviz exited with status -9"))
+    def test_killed_renders_are_not_cached(self, mock_pipe):
+        # A process killed for its memory use says nothing about the code, so it is tried again.
+        code = "digraph G { A -> B; }"
+        self.client.post('/lint', json={'code': code})
+        self.client.post('/render', json={'code': code})
+        self.assertEqual(mock_pipe.call_count, 2)
+
+    @patch("main.dot_pool.pipe")
+    def test_lint_syntax_error_skips_graphviz(self, mock_pipe):
+        # Syntax errors are found without running Graphviz and point at the offending token.
+        response = self.client.post('/lint', json={'code': "digraph G {\n    A -> }"})
+        annotation = response.get_json()['annotations'][0]
+        self.assertEqual(annotation['from'], {'line': 1, 'ch': 9})
+        self.assertEqual(annotation['to'], {'line': 1, 'ch': 10})
+        self.assertIn("after '->'", annotation['message'])
+        mock_pipe.assert_not_called()
+
+    @patch("main.INCREMENTAL_LAYOUT_MIN_NODES", 1)
+    @patch("main.dot_pool.pipe")
+    def test_compile_reuses_layout_for_label_edits(self, mock_pipe):
+        # A label edit is drawn at the previous coordinates instead of laid out again.
+        layout = b'digraph G {\n\tgraph [bb="0,0,54,108"];\n\ta [pos="27,90"];\n' \
+                 b'\tb [pos="27,18"];\n\ta -> b [pos="e,27,36 27,72"];\n}\n'
+        def fake_pipe(code, engine, fmt, cancel=None, args=()):
+            if fmt == 'svg+dot':
+                return b'<svg>full</svg>\n' + layout
+            return b'<svg>pinned</svg>\n'
+        mock_pipe.side_effect = fake_pipe
+        session = {'session': 'abc', 'revision': 1}
+        response = self.client.post('/compile', json=dict(session, code='digraph G { a -> b }'))
+        self.assertIn("full", response.get_json()['svg'])
+        session['revision'] = 2
+        response = self.client.post('/compile', json=dict(session, code='digraph G { a [label="A"]; a -> b }'))
+        self.assertIn("pinned", response.get_json()['svg'])
+        pinned_code, engine = mock_pipe.call_args[0][:2]
+        self.assertEqual((engine, mock_pipe.call_args[1]['args']), ('neato', ('-n2',)))
+        self.assertIn('pos="e,27,36 27,72"', pinned_code)
+        # Adding an edge changes the topology, so the graph is laid out from scratch.
+        session['revision'] = 3
+        response = self.client.post('/compile', json=dict(session, code='digraph G { a -> b; b -> a }'))
+        self.assertIn("full", response.get_json()['svg'])
+
+    @patch("main.dot_pool.pipe", return_value=b"<svg><a xlink:href=\"example.com\">x</a></svg>\n")
+    def test_render_raw_svg_with_etag(self, mock_pipe):
+        # Clients that ask for SVG get it compressed with an ETag, and a 304 once they have it.
+        headers = {'Accept': 'image/svg+xml', 'Accept-Encoding': 'gzip'}
+        code = "digraph G { A -> B; }"
+        response = self.client.post('/render', json={'code': code}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'image/svg+xml')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'http://example.com', gzip.decompress(response.data))
+        etag = response.headers['ETag']
+        headers['If-None-Match'] = etag
+        response = self.client.post('/render', json={'code': code}, headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(mock_pipe.call_count, 1)
+
+@unittest.skipUnless(importlib.util.find_spec('asgiref'), "asgiref is only needed for --async mode")
+class AsyncRenderAppTestCase(unittest.TestCase):
+    def setUp(self):
+        render_cache.clear()
+
+    async def call_async(self, asgi_app, method, path):
+        path, _, query = path.partition('?')
+        scope = {'type': 'http', 'method': method, 'path': path, 'raw_path': path.encode(),
+                 'query_string': query.encode(), 'root_path': '', 'scheme': 'http', 'http_version': '1.1',
+                 'headers': [], 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+        sent = []
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        async def send(message):
+            sent.append(message)
+        await asgi_app(scope, receive, send)
+        status = next(m['status'] for m in sent if m['type'] == 'http.response.start')
+        return status, b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+
+    def call(self, asgi_app, path, payload):
+        body = json.dumps(payload).encode('utf-8')
+        scope = {'type': 'http', 'method': 'POST', 'path': path, 'raw_path': path.encode(),
+                 'query_string': b'', 'root_path': '', 'scheme': 'http', 'http_version': '1.1',
+                 'headers': [(b'content-type', b'application/json'),
+                             (b'content-length', str(len(body)).encode())],
+                 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+        async def send(message):
+            sent.append(message)
+        asyncio.run(asgi_app(scope, receive, send))
+        return b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+
+    @patch("main.workspace.list_documents")
+    def test_flask_requests_run_concurrently(self, mock_list_documents):
+        # A request stuck in Flask doesn't hold up the next one.
+        release = threading.Event()
+        mock_list_documents.side_effect = lambda user: release.wait(5) and []
+        asgi_app = AsyncRenderApp(app)
+
+        async def requests():
+            stuck = asyncio.ensure_future(self.call_async(asgi_app, 'GET', '/documents'))
+            await asyncio.sleep(0.05)
+            status, _ = await asyncio.wait_for(self.call_async(asgi_app, 'GET', '/healthz'), 2)
+            release.set()
+            return status, await stuck
+
+        status, (stuck_status, body) = asyncio.run(requests())
+        self.assertEqual(status, 503)
+        self.assertEqual((stuck_status, json.loads(body)), (200, {'documents': []}))
+
+    @patch("main.PREVIEW_KEEPALIVE", 0.05)
+    @patch("main.PREVIEW_DEBOUNCE", 0)
+    @patch("main.dot_pool.pipe", return_value=b"<svg>\n<g/>\n</svg>\n")
+    def test_events_served_on_event_loop(self, mock_pipe):
+        # /events streams from the event loop while other requests go on, and ends on disconnect.
+        asgi_app = AsyncRenderApp(app, threads=1)
+        scope = {'type': 'http', 'method': 'GET', 'path': '/events', 'raw_path': b'/events',
+                 'query_string': b'doc=asynclive', 'root_path': '', 'scheme': 'http', 'http_version': '1.1',
+                 'headers': [], 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+        sent = []
+        keepalive, rendered, gone = asyncio.Event(), asyncio.Event(), asyncio.Event()
+        async def receive():
+            await gone.wait()
+            return {'type': 'http.disconnect'}
+        async def send(message):
+            sent.append(message)
+            if message.get('body') == b': keepalive\n\n':
+                keepalive.set()
+            elif message.get('body', b'').startswith(b'event: svg'):
+                rendered.set()
+
+        async def requests():
+            stream = asyncio.ensure_future(asgi_app(scope, receive, send))
+            await asyncio.wait_for(keepalive.wait(), 2)
+            # Flask has a single thread here, and the stream isn't holding it.
+            status, _ = await asyncio.wait_for(self.call_async(asgi_app, 'GET', '/healthz'), 2)
+            app.test_client().post('/preview', json={'doc': 'asynclive', 'code': "digraph { a }"})
+            await asyncio.wait_for(rendered.wait(), 2)
+            gone.set()
+            await asyncio.wait_for(stream, 2)
+            with patch("main.LIVE_PREVIEW", False):
+                events = await asyncio.wait_for(self.call_async(asgi_app, 'GET', '/events?doc=asynclive'), 2)
+            return status, events
+
+        status, (events_status, body) = asyncio.run(requests())
+        self.assertEqual(status, 503)
+        self.assertEqual(sent[0]['headers'][0], (b'content-type', b'text/event-stream; charset=utf-8'))
+        self.assertIn({'type': 'http.response.body', 'body': b'event: svg\ndata: <svg>\ndata: <g/>\n'
+                       b'data: </svg>\n\n', 'more_body': True}, sent)
+        self.assertEqual((events_status, json.loads(body)), (404, {'error': 'Live preview is off'}))
+
+    @patch("main.dot_pool.pipe")
+    @patch("main.render_async")
+    def test_render_routes_render_on_event_loop(self, mock_render_async, mock_pipe):
+        # The graph is rendered asynchronously, and Flask only reads the result back from the cache.
+        code = "digraph G { A -> B; }"
+        async def fake_render_async(code, engine, fmt, cancel, slots, args=()):
+            render_cache.put(RenderCache.key(code, ' '.join((engine,) + args), fmt), b"<svg></svg>")
+        mock_render_async.side_effect = fake_render_async
+        body = self.call(AsyncRenderApp(app), '/compile', {'code': code})
+        self.assertEqual(json.loads(body)['annotations'], [])
+        mock_render_async.assert_called_once()
+        mock_pipe.assert_not_called()
+
+class SvgLinkTestCase(unittest.TestCase):
+    SVG = ('<svg><g><a xlink:href="example.com" xlink:title="A">x</a>'
+           '<a href="https://secure.example.com" target="_top">y</a>'
+           '<image xlink:href="logo.png"/></g></svg>')
+    FIXED = ('<svg><g><a xlink:href="http://example.com" xlink:title="A" target="_blank">x</a>'
+             '<a href="https://secure.example.com" target="_top">y</a>'
+             '<image xlink:href="http://logo.png"/></g></svg>')
+
+    def test_fix_svg_urls(self):
+        self.assertEqual(fix_svg_urls(self.SVG), self.FIXED)
+        self.assertEqual(fix_svg_urls(self.SVG.encode('utf-8')), self.FIXED.encode('utf-8'))
+
+    def test_rewriter_handles_tags_split_across_chunks(self):
+        data = self.SVG.encode('utf-8')
+        for size in (1, 7, 64):
+            rewriter = SvgLinkRewriter()
+            output = b''.join(rewriter.feed(data[i:i + size]) for i in range(0, len(data), size))
+            self.assertEqual(output + rewriter.close(), self.FIXED.encode('utf-8'))
+
+class DotMetadataTestCase(unittest.TestCase):
+    SVG = b'<?xml version="1.0"?>\n<svg width="8pt" height="8pt">\n<g id="graph0"></g>\n</svg>\n'
+
+    def extract(self, svg, chunk_size=16):
+        stream = io.BytesIO(svg)
+        return extract_dot_metadata(stream, chunk_size), stream.tell()
+
+    def test_round_trip(self):
+        for code in ('digraph { a -> b }', 'digraph { a [label="]]>"] }', 'digraph { a [label="</metadata>"] }',
+                     'graph { \u00e9 -- "<&>" }'):
+            svg = embed_dot_metadata(self.SVG, code)
+            self.assertTrue(svg.startswith(self.SVG[:self.SVG.index(b'>\n<g') + 1] + b"<metadata id='graphviz-dot'>"))
+            self.assertEqual(self.extract(svg)[0], code)
+        self.assertIsNone(self.extract(self.SVG)[0])
+
+    def test_stops_after_metadata(self):
+        svg = embed_dot_metadata(self.SVG.replace(b'</g>', b'<path/>' * 100000 + b'</g>'), 'digraph { a }')
+        code, position = self.extract(svg, 64)
+        self.assertEqual(code, 'digraph { a }')
+        self.assertLess(position, 256)
+
+    @patch("main.DOT_METADATA_COMPRESS_MIN", 0)
+    def test_compressed(self):
+        code = 'digraph { ' + 'a -> b; ' * 1000 + '}'
+        svg = embed_dot_metadata(self.SVG, code)
+        self.assertIn(b"data-encoding='gzip+base64'", svg)
+        self.assertLess(len(svg), len(code))
+        self.assertEqual(self.extract(svg)[0], code)
+        # Sources are only unpacked up to a limit, so a small upload can't fill the memory.
+        with patch("main.DOT_METADATA_MAX_SIZE", len(code) - 1):
+            with self.assertRaises(ValueError):
+                self.extract(svg)
+
+    def test_escaped_and_broken(self):
+        svg = self.SVG.replace(b'<g', b'<metadata id="graphviz-dot">a -&gt; b</metadata><g')
+        self.assertEqual(self.extract(svg)[0], 'a -> b')
+        with self.assertRaises(ValueError):
+            self.extract(embed_dot_metadata(self.SVG, 'digraph { }')[:100])
+
+class DotParserTestCase(unittest.TestCase):
+    def assertSyntaxError(self, code, line, col, text):
+        with self.assertRaises(DotSyntaxError) as caught:
+            parse_dot(code)
+        self.assertEqual((caught.exception.line, caught.exception.col), (line, col))
+        self.assertIn(text, caught.exception.message)
+
+    def test_valid_graphs(self):
+        code = """strict digraph G {
+            // comment
+            graph [rankdir=LR]; node [shape=box]
+            a [label="x" + "y", color=red]; b [label=<<b>bold</b>>]
+            subgraph cluster_0 { c; d } -> a:n:s -> {e f}
+            /* block
+               comment */
+            size = "4,4"
+        }
+        graph { x -- y }"""
+        graphs = parse_dot(code)
+        self.assertEqual(len(graphs), 2)
+        self.assertTrue(graphs[0].strict)
+        self.assertTrue(graphs[0].directed)
+        self.assertFalse(graphs[1].directed)
+        self.assertEqual(parse_dot(""), [])
+        self.assertEqual(len(parse_dot("\ufeffdigraph { a -> b }")), 1)
+
+    def test_syntax_errors(self):
+        self.assertSyntaxError("digraph G { A -> }", 0, 17, "after '->'")
+        self.assertSyntaxError("graph { a -> b }", 0, 10, "'->' can't be used in an undirected graph")
+        self.assertSyntaxError("digraph {\n  a [label=\"x]\n}", 1, 11, "Unterminated string")
+        self.assertSyntaxError("digraph {\n  a -> b\n", 0, 8, "Missing '}'")
+        self.assertSyntaxError("digraph { a [color] }", 0, 18, "Expected '='")
+        self.assertSyntaxError("digraph { a -> node }", 0, 15, "keyword")
+        self.assertSyntaxError("digraph { a $ b }", 0, 12, "Unexpected character")
+        self.assertSyntaxError("\ufeffdigraph { a $ b }", 0, 13, "Unexpected character")
+
+class IncrementalLayoutTestCase(unittest.TestCase):
+    def test_signature_ignores_labels_and_styling(self):
+        def signature(code):
+            return GraphOutline(parse_dot(code)[0]).signature()
+        code = 'digraph G { a [label="A"]; a -> {b c}; subgraph cluster_x { d } }'
+        self.assertEqual(signature(code), signature(code.replace('"A"', '"AA", color=red')))
+        self.assertNotEqual(signature(code), signature(code.replace('{b c}', '{b d}')))
+        self.assertNotEqual(signature(code), signature(code.replace('G {', 'G { rankdir=LR')))
+
+    def test_small_graphs_skip_the_outline(self):
+        # The outline is only worked out for graphs the cost estimate says may be big enough.
+        code = "digraph { a -> b }"
+        with patch("main.GraphOutline", side_effect=AssertionError("outline built")):
+            self.assertIsNone(incremental_outline(code, parse_dot(code), 'abc'))
+        big = "digraph { " + " ".join(f"n{i} -> n{i + 1};" for i in range(300)) + " }"
+        self.assertEqual(len(incremental_outline(big, parse_dot(big), 'abc').nodes), 301)
+
+    def test_write_pinned_dot(self):
+        graph = parse_dot('digraph G { a -> {b c} [color=red]; subgraph cluster_x { d } }')[0]
+        layout = parse_dot("""digraph G {
+            graph [bb="0,0,100,100"];
+            subgraph cluster_x { graph [bb="1,1,50,50"]; d [pos="10,10"]; }
+            a [pos="20,20"]; b [pos="30,30"]; c [pos="40,40"];
+            a -> b [pos="e,1,1 2,2"]; a -> c [pos="e,3,3 4,4"];
+        }""")[0]
+        pinned = write_pinned_dot(graph, layout)
+        self.assertIn('a -> b [color=red, pos="e,1,1 2,2"];', pinned)
+        self.assertIn('a -> c [color=red, pos="e,3,3 4,4"];', pinned)
+        self.assertIn('"d" [pos="10,10"];', pinned)
+        self.assertIn('graph [bb="1,1,50,50"];', pinned)
+        # The result is still the same graph.
+        self.assertEqual(GraphOutline(parse_dot(pinned)[0]).nodes.keys(), GraphOutline(graph).nodes.keys())
+
+def spread_svg(nodes, spacing):
+    # A Graphviz-like SVG with `nodes` labelled nodes in a row, `spacing` points apart.
+    width = nodes * spacing
+    parts = [f'<svg width="{width}pt" height="100pt" viewBox="0.00 0.00 {width}.00 100.00" '
+             'xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">\n'
+             '<g id="graph0" class="graph" transform="scale(1 1) rotate(0) translate(4 96)">\n'
+             '<polygon fill="white" stroke="none" points="-4,4 -4,-96 100,-96 100,4 -4,4"/>\n']
+    for i in range(nodes):
+        parts.append(f'<!-- n{i} -->\n<g id="node{i + 1}" class="node">\n<title>n{i}</title>\n'
+                     f'<ellipse fill="none" stroke="black" cx="{i * spacing + 27}" cy="-18" rx="27" ry="18"/>\n'
+                     f'<text text-anchor="middle" x="{i * spacing + 27}" y="-14.3" font-size="14.00">n{i}</text>\n</g>\n')
+    parts.append('</g>\n</svg>\n')
+    return ''.join(parts).encode('utf-8')
+
+class TileSetTestCase(unittest.TestCase):
+    def test_tiles_hold_only_what_they_show(self):
+        tiles = TileSet(spread_svg(100, 100), b'digraph { }')
+        self.assertEqual(len(tiles.elements), 100)
+        self.assertEqual(tiles.max_zoom, 7)
+        # Zoomed out, every node is there but the labels are not.
+        overview = tiles.tile_svg(0, 0, 0)
+        self.assertEqual(overview.count(b'<ellipse'), 100)
+        self.assertNotIn(b'<text', overview)
+        # Zoomed in, a tile only holds the nodes on it, with their labels.
+        detail = tiles.tile_svg(6, 0, 0)
+        self.assertIn(b'viewBox="0.00 0.00 156.25 156.25"', detail)
+        self.assertEqual(detail.count(b'<ellipse'), 2)
+        self.assertIn(b'>n1</text>', detail)
+        with self.assertRaises(KeyError):
+            tiles.tile_svg(1, 2, 0)
+
+class EditorSessionsTestCase(unittest.TestCase):
+    def test_newer_revision_cancels_older(self):
+        sessions = EditorSessions()
+        with self.assertRaises(RenderCancelled):
+            with sessions.revision('abc', 1) as cancel:
+                with sessions.revision('abc', 2) as newer:
+                    self.assertTrue(cancel.is_set())
+                    self.assertFalse(newer.is_set())
+        with self.assertRaises(RenderCancelled):
+            with sessions.revision('abc', 1):
+                pass
+        # Other sessions are unaffected.
+        with sessions.revision('xyz', 1) as cancel:
+            self.assertFalse(cancel.is_set())
+
+class DotWorkerPoolTestCase(unittest.TestCase):
+    def test_output_complete(self):
+        # A worker's output is only handed back once the whole document has arrived.
+        self.assertFalse(output_complete('svg', b'<svg width="8pt">\n<g id="graph0">'))
+        self.assertTrue(output_complete('svg', b'<svg width="8pt">\n</svg>\n'))
+        self.assertFalse(output_complete('dot', b'digraph G {\n\tsubgraph x {\n\t}\n'))
+        self.assertTrue(output_complete('dot', b'digraph G {\n\tA -> B;\n}\n'))
+        self.assertTrue(output_complete('png', b'\x89PNG...IEND\xaeB`\x82'))
+
+    def test_admission(self):
+        # Graphs are sorted by estimated size before anything is started.
+        pool = DotWorkerPool(size=4, heavy_cost=10, max_cost=100)
+        self.assertFalse(pool.admit("digraph { a -> b }"))
+        self.assertTrue(pool.admit("digraph { " + " ".join(f"n{i} -> n{i + 1};" for i in range(10)) + " }"))
+        with self.assertRaises(GraphTooLarge):
+            pool.admit("digraph { " + " ".join(f"n{i} -> n{i + 1};" for i in range(100)) + " }")
+
+    def test_empty_input(self):
+        # Documents without a graph never reach a dot process, which would wait for one forever.
+        pool = DotWorkerPool(size=1)
+        with patch.object(pool, '_pipe', side_effect=AssertionError("dot was run")):
+            self.assertEqual(pool.pipe(""), b'')
+            self.assertEqual(pool.pipe("// nothing yet\n/* still nothing */\n"), b'')
+            self.assertEqual(pool.pipe("\ufeff"), b'')
+            with self.assertRaises(AssertionError):
+                pool.pipe("digraph { }")
+
+    def test_pipe_once_polls_for_cancel(self):
+        # A one-off render slower than the cancel poll interval still gets its output.
+        with tempfile.TemporaryDirectory() as bin_dir:
+            engine = os.path.join(bin_dir, 'slowdot')
+            with open(engine, 'w') as f:
+                f.write("#!/bin/sh\ncat > /dev/null\nsleep 0.3\necho '<svg/>'\n")
+            os.chmod(engine, 0o755)
+            cancel = threading.Event()
+            self.assertEqual(pipe_once("digraph { a }", engine, 'svg', 5, cancel), b'<svg/>\n')
+            threading.Timer(0.1, cancel.set).start()
+            with self.assertRaises(RenderCancelled):
+                pipe_once("digraph { a }", engine, 'svg', 5, cancel)
+
+    def test_heavy_lane(self):
+        # Heavy jobs only ever hold some of the workers; the rest stay free for small graphs.
+        pool = DotWorkerPool(size=4, heavy_cost=0, queue_timeout=0.01)
+        pool._heavy_slots.acquire()
+        pool._heavy_slots.acquire()
+        with patch.object(pool, '_pipe', return_value=b'<svg/>'):
+            with self.assertRaises(PoolBusyError):
+                pool.pipe("digraph { a -> b }")
+            pool.heavy_cost = 100
+            self.assertEqual(pool.pipe("digraph { a -> b }"), b'<svg/>')
+
+class WorkspaceStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.store = WorkspaceStore(self.dir.name, compact_every=3)
+
+    def test_text_delta(self):
+        # Only the changed range is described, and applying it gives the new text back.
+        old, new = "digraph G { A -> B; }", "digraph G { A -> C -> B; }"
+        delta = text_delta(old, new)
+        self.assertEqual(delta['text'], "C -> ")
+        self.assertEqual(old[:delta['start']] + delta['text'] + old[delta['end']:], new)
+        self.assertEqual(text_delta("aaa", "aa"), {'start': 2, 'end': 3, 'text': ''})
+
+    def test_log_replay_and_compaction(self):
+        # Saves survive a fresh store replaying the files, before and after compaction.
+        doc_id = self.store.create_document('alice', 'First', 'digraph G {}')
+        revisions = set()
+        for i in range(5):
+            revisions.add(self.store.save('alice', doc_id, f'digraph G {{ n{i}; }}'))
+            code, revision = WorkspaceStore(self.dir.name).load('alice', doc_id)
+            self.assertEqual(code, f'digraph G {{ n{i}; }}')
+        self.assertEqual(len(revisions), 5)
+        with open(f'{self.dir.name}/alice/{doc_id}.log') as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_saves_wait_for_other_processes(self):
+        # A save holds the document's flock from reading it to appending, so writers in other
+        # processes (here another store, with its own open file) take turns.
+        doc_id = self.store.create_document('alice', 'First', 'digraph G {}')
+        other = WorkspaceStore(self.dir.name)
+        with other._locked('alice'):
+            saver = threading.Thread(target=self.store.save, args=('alice', doc_id, 'digraph G { A; }'))
+            saver.start()
+            saver.join(0.2)
+            self.assertTrue(saver.is_alive())
+        saver.join(2)
+        self.assertEqual(other.load('alice', doc_id)[0], 'digraph G { A; }')
+        # Made-up document ids leave nothing behind.
+        with self.assertRaises(KeyError):
+            self.store.save('alice', 'madeup', 'digraph G { }')
+        self.assertEqual(sorted(os.listdir(f'{self.dir.name}/alice')),
+                         sorted(['.lock', 'index.json', f'{doc_id}.json', f'{doc_id}.log']))
+
+    def test_torn_log_line(self):
+        # A save cut short by a crash is dropped, and the saves after it still replay.
+        doc_id = self.store.create_document('alice', 'First', 'digraph G {}')
+        self.store.save('alice', doc_id, 'digraph G { A; }')
+        with open(f'{self.dir.name}/alice/{doc_id}.log', 'a') as f:
+            f.write('{"start": 10, "end": 1')
+        store = WorkspaceStore(self.dir.name, compact_every=3)
+        self.assertEqual(store.load('alice', doc_id)[0], 'digraph G { A; }')
+        store.save('alice', doc_id, 'digraph G { A; B; }')
+        self.assertEqual(WorkspaceStore(self.dir.name).load('alice', doc_id)[0], 'digraph G { A; B; }')
+
+    def test_unknown_ids(self):
+        with self.assertRaises(KeyError):
+            self.store.load('alice', 'missing')
+        with self.assertRaises(KeyError):
+            self.store.load('../alice', 'x')
+
+class RenderCacheTestCase(unittest.TestCase):
+    def test_lru_eviction_by_size(self):
+        cache = RenderCache(max_bytes=10)
+        cache.put('a', b'12345')
+        cache.put('b', b'12345')
+        # Touch 'a' so that 'b' is the least recently used entry.
+        self.assertEqual(cache.get('a'), b'12345')
+        cache.put('c', b'12345')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'12345')
+        self.assertEqual(cache.get('c'), b'12345')
+        self.assertLessEqual(cache.size, 10)
+
+    def test_disk_persistence(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            key = RenderCache.key("digraph G { A -> B; }", 'dot', 'svg')
+            RenderCache(cache_dir=cache_dir).put(key, b'<svg></svg>')
+            # A fresh cache pointed at the same directory sees the entry.
+            self.assertEqual(RenderCache(cache_dir=cache_dir).get(key), b'<svg></svg>')
 
 if __name__ == '__main__':
     unittest.main()